@@ -1,14 +1,20 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import acting_user, get_db
 from ..models import models
-from ..schemas import schemas
+from ..websockets.manager import manager
+from .cache import MISSING, TTLCache
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,8 +24,38 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes made with a different cost are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+# Backplane channel carrying "<user_id>" principal invalidations
+PRINCIPAL_CHANNEL = "principal"
+
+@dataclass(frozen=True)
+class Principal:
+    """Snapshot of the authenticated user; load models.User when more is needed"""
+    id: int
+    username: str
+    is_active: bool
+
+# Verified token -> Principal, grouped by user id. Entries never outlive the token.
+principal_cache = TTLCache(
+    max_entries=int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", "60")),
+)
+
+async def invalidate_principal(user_id: int):
+    """Forget cached principals of a user whose username, password or active flag changed"""
+    principal_cache.invalidate_group(user_id)
+    await manager.backplane.publish(PRINCIPAL_CHANNEL, b"%d" % user_id)
+
+async def _on_principal_invalidation(data: bytes):
+    principal_cache.invalidate_group(int(data))
+
+manager.backplane.subscribe(PRINCIPAL_CHANNEL, _on_principal_invalidation)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -27,6 +63,82 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+class PasswordHasher:
+    """Runs bcrypt off the event loop in a dedicated, bounded pool.
+
+    At most ``max_concurrency`` hashes are queued or running at once; a caller
+    that cannot get a slot within ``queue_timeout`` seconds gets a 503 instead
+    of piling more work onto an overloaded worker.
+    """
+
+    def __init__(self, workers: int = 4, max_concurrency: int = 32, queue_timeout: float = 5.0, processes: bool = False):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.processes = processes
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._executor: Optional[Executor] = None
+        self.rejected = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot belongs to the job, not the caller: a cancelled request
+        # must not free it while bcrypt is still running in the pool
+        job.add_done_callback(lambda _: self._release_from(loop))
+        return await asyncio.wrap_future(job)
+
+    def _release_from(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self._slots.release)
+        except RuntimeError:
+            pass  # The loop is closed, and the semaphore with it
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Verify, also returning a new hash when the stored one uses an outdated cost"""
+        return await self._run(verify_and_update_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1))),
+    max_concurrency=int(os.getenv("PASSWORD_HASH_MAX_CONCURRENCY", "32")),
+    queue_timeout=float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5")),
+    processes=os.getenv("PASSWORD_HASH_EXECUTOR", "thread") == "process",
+)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -37,26 +149,42 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
+    return await authenticate_token(token, db)
+
+async def authenticate_token(token: str, db: AsyncSession) -> Principal:
+    cached = principal_cache.get(token)
+    if cached is not MISSING:
+        acting_user.set(cached.id)
+        return cached
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    epoch = principal_cache.epoch
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        user_id: Optional[int] = payload.get("uid")
+        if username is None and user_id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.username == token_data.username).first()
+    # Tokens issued before the uid claim existed are looked up by username
+    if user_id is not None:
+        user = await db.get(models.User, user_id)
+    else:
+        user = await db.scalar(select(models.User).where(models.User.username == username))
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal(id=user.id, username=user.username, is_active=user.is_active)
+    if epoch == principal_cache.epoch:
+        principal_cache.put(token, principal, group=user.id, ttl=payload["exp"] - time.time())
+    acting_user.set(principal.id)
+    return principal
 
-async def get_current_active_user(current_user: models.User = Depends(get_current_user)):
+async def get_current_active_user(current_user: Principal = Depends(get_current_user)) -> Principal:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user 
\ No newline at end of file
+    return current_user
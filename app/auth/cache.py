@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU whose entries expire, grouped for bulk invalidation.
+
+    Each entry may belong to a group (a chat, a user, ...) so that everything
+    cached about it can be dropped in one call. ``epoch`` increases on every
+    invalidation; callers compare it before and after a slow lookup to avoid
+    caching an answer that an invalidation raced.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._groups: Dict[Hashable, Set[Hashable]] = {}
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value, or ``MISSING``"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        value, expires_at, _ = entry
+        if expires_at < time.monotonic():
+            self.discard(key)
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, group: Hashable = None, ttl: Optional[float] = None):
+        self.discard(key)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        self._entries[key] = (value, expires_at, group)
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self.discard(oldest)
+
+    def discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        group = entry[2]
+        keys = self._groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def invalidate(self, key: Hashable):
+        self.epoch += 1
+        self.discard(key)
+
+    def invalidate_group(self, group: Hashable):
+        self.epoch += 1
+        for key in self._groups.pop(group, ()):
+            self._entries.pop(key, None)
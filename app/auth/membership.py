@@ -0,0 +1,134 @@
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from ..models import models
+from .cache import MISSING, TTLCache
+from ..websockets.backplane import Backplane
+from ..websockets.manager import manager
+import os
+
+load_dotenv()
+
+# Backplane channel carrying "<chat_id>" or "<chat_id>:<user_id>" invalidations
+MEMBERSHIP_CHANNEL = "membership"
+
+
+def participants_query(chat_ids: Iterable[int]):
+    return select(models.user_chat.c.chat_id, models.user_chat.c.user_id).where(
+        models.user_chat.c.chat_id.in_(list(chat_ids))
+    )
+
+
+class MembershipCache:
+    """Bounded LRU of (user_id, chat_id) -> whether the user is a participant.
+
+    Entries expire after ``ttl`` seconds, but correctness relies on explicit
+    invalidation: every endpoint that changes participants calls
+    ``invalidate``, which also reaches the other workers over the backplane.
+    Negative answers are cached too, so probing chats one is not in is cheap.
+    The participant ids of whole chats are kept in the same cache, under
+    ``("participants", chat_id)``, and dropped with any change to the chat.
+    """
+
+    def __init__(self, max_entries: int = 100_000, ttl: float = 300.0):
+        self._cache = TTLCache(max_entries, ttl)
+        self._backplane: Optional[Backplane] = None
+
+    def attach(self, backplane: Backplane):
+        self._backplane = backplane
+        backplane.subscribe(MEMBERSHIP_CHANNEL, self._on_invalidation)
+
+    @property
+    def hits(self) -> int:
+        return self._cache.hits
+
+    @property
+    def misses(self) -> int:
+        return self._cache.misses
+
+    async def is_participant(self, db: AsyncSession, user_id: int, chat_id: int) -> bool:
+        cached = self._cache.get((user_id, chat_id))
+        if cached is not MISSING:
+            return cached
+        epoch = self._cache.epoch
+        value = await db.scalar(
+            select(models.user_chat.c.user_id).where(
+                (models.user_chat.c.user_id == user_id) &
+                (models.user_chat.c.chat_id == chat_id)
+            ).limit(1)
+        ) is not None
+        # Entries are grouped by chat so a deleted chat is dropped in one go. A
+        # lagging replica's answer serves this request but is never kept.
+        if epoch == self._cache.epoch and "replica" not in db.info:
+            self._cache.put((user_id, chat_id), value, group=chat_id)
+        return value
+
+    async def participants(self, db: AsyncSession, chat_ids: Iterable[int]) -> Dict[int, Tuple[int, ...]]:
+        """The participant ids of each chat; the misses are loaded in one query"""
+        found = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = self._cache.get(("participants", chat_id))
+            if cached is MISSING:
+                missing.append(chat_id)
+            else:
+                found[chat_id] = cached
+        if not missing:
+            return found
+        epoch = self._cache.epoch
+        loaded = {chat_id: [] for chat_id in missing}
+        for chat_id, user_id in (await db.execute(participants_query(missing))).all():
+            loaded[chat_id].append(user_id)
+        keep = epoch == self._cache.epoch and "replica" not in db.info
+        for chat_id, user_ids in loaded.items():
+            found[chat_id] = tuple(user_ids)
+            if keep:
+                self._cache.put(("participants", chat_id), found[chat_id], group=chat_id)
+        return found
+
+    @property
+    def epoch(self) -> int:
+        return self._cache.epoch
+
+    def remember(self, user_id: int, chat_ids: Iterable[int], epoch: int):
+        """Cache memberships read elsewhere, unless an invalidation raced the read"""
+        if epoch != self._cache.epoch:
+            return
+        for chat_id in chat_ids:
+            self._cache.put((user_id, chat_id), True, group=chat_id)
+
+    async def invalidate(self, chat_id: int, user_id: Optional[int] = None):
+        """Forget one user's membership of a chat, or every entry of the chat"""
+        self._invalidate_local(chat_id, user_id)
+        if self._backplane is not None:
+            payload = b"%d" % chat_id if user_id is None else b"%d:%d" % (chat_id, user_id)
+            await self._backplane.publish(MEMBERSHIP_CHANNEL, payload)
+
+    async def _on_invalidation(self, data: bytes):
+        chat_id, _, user_id = data.partition(b":")
+        self._invalidate_local(int(chat_id), int(user_id) if user_id else None)
+
+    def _invalidate_local(self, chat_id: int, user_id: Optional[int]):
+        if user_id is None:
+            self._cache.invalidate_group(chat_id)
+        else:
+            self._cache.invalidate((user_id, chat_id))
+            self._cache.discard(("participants", chat_id))
+
+
+async def require_participant(db: AsyncSession, user_id: int, chat_id: int, detail: str):
+    """Raise 404/403 unless the user is in the chat; members cost no query on a hit"""
+    if await membership.is_participant(db, user_id, chat_id):
+        return
+    if await db.get(models.Chat, chat_id) is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    raise HTTPException(status_code=403, detail=detail)
+
+
+membership = MembershipCache(
+    max_entries=int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000")),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", "300")),
+)
+membership.attach(manager.backplane)
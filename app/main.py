@@ -1,14 +1,23 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .models import models
 from .database import engine
-from fastapi.staticfiles import StaticFiles
-
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+from .websockets.manager import manager
+from .websockets.ingest import ingest
+from .websockets.read_cursors import read_cursors
+from .websockets.presence import presence
+from .auth import auth
+from .monitoring.middleware import MetricsMiddleware
+from .monitoring.tracing import instrument_engine
+from .storage.media import media
+from .storage.archive import message_archive
+from .search.search import search_index
+from .replicas import replicas
 
 app = FastAPI()
 
+# Every statement is counted and timed, per request and in /metrics
+instrument_engine(engine.sync_engine)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -17,9 +26,36 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last, so it also times CORS handling
+app.add_middleware(MetricsMiddleware)
 
 # Import and include the main API router
 from .routers.api import router as api_router
 app.include_router(api_router)
 
-app.mount("/static/uploads", StaticFiles(directory="app/routers/uploads"), name="uploads") 
\ No newline at end of file
+@app.on_event("startup")
+async def startup():
+    # The schema is managed by the migrations (alembic -c app/alembic.ini upgrade head)
+    async with engine.connect() as conn:
+        await conn.run_sync(search_index.detect)
+    await replicas.start()
+    await message_archive.start()
+    await manager.start()
+    if ingest.enabled:
+        await ingest.start()
+    await media.start()
+    await read_cursors.start()
+    await presence.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await media.stop()
+    await message_archive.stop()
+    await manager.stop()
+    # Drain write-behind messages, read cursors and last_seen before the engine goes away
+    await ingest.stop()
+    await read_cursors.stop()
+    await presence.stop()
+    auth.password_hasher.shutdown()
+    await replicas.stop()
+    await engine.dispose() 
\ No newline at end of file
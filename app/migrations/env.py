@@ -0,0 +1,61 @@
+import asyncio
+from logging.config import fileConfig
+from alembic import context
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from app.database import ASYNC_DATABASE_URL
+from app.models import models
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+# Compared against the database by ``alembic revision --autogenerate``
+target_metadata = models.Base.metadata
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # The FTS5 tables and the per-dialect indexes are written by hand in the revisions
+    if type_ == "table" and reflected and name.startswith("messages_fts"):
+        return False
+    if type_ == "index" and not reflected and getattr(object, "_ddl_if", None) is not None:
+        return False
+    return True
+
+
+def run_offline():
+    """Emit the SQL instead of running it: ``alembic upgrade head --sql``"""
+    context.configure(
+        url=ASYNC_DATABASE_URL.render_as_string(hide_password=False),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=True,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations(connection):
+    # Batch mode recreates tables where SQLite cannot ALTER them
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        render_as_batch=True,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_online():
+    engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool)
+    async with engine.connect() as connection:
+        await connection.run_sync(run_migrations)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_offline()
+else:
+    asyncio.run(run_online())
@@ -0,0 +1,67 @@
+"""Baseline: users, chats, their participants and messages
+
+The schema of the original application, which created it at startup.
+Databases created that way are at this revision; mark them with
+``alembic -c app/alembic.ini stamp 0001`` before upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String()),
+        sa.Column("email", sa.String()),
+        sa.Column("hashed_password", sa.String()),
+        sa.Column("is_active", sa.Boolean()),
+        sa.Column("last_seen", sa.DateTime()),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    op.create_table(
+        "chats",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String()),
+        sa.Column("is_group", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_chats_id", "chats", ["id"])
+    op.create_index("ix_chats_name", "chats", ["name"])
+
+    op.create_table(
+        "user_chat",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id")),
+    )
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("content", sa.String()),
+        sa.Column("timestamp", sa.DateTime()),
+        sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id")),
+        sa.Column("is_read", sa.Boolean()),
+        sa.Column("file_url", sa.String(), nullable=True),
+        sa.Column("filetype", sa.String(), nullable=True),
+        sa.Column("filename", sa.String(), nullable=True),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+
+
+def downgrade():
+    for table in ("messages", "user_chat", "chats", "users"):
+        op.drop_table(table)
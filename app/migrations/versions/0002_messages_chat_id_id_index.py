@@ -0,0 +1,20 @@
+"""Index messages by (chat_id, id) for keyset pagination of a chat's history
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_messages_chat_id_id", "messages")
@@ -0,0 +1,28 @@
+"""Content hash and size of attachments
+
+file_hash is the SHA-256 of the file and its key in storage. Attachments
+uploaded before it stay NULL here; see 0011 for their backfill.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("messages", sa.Column("file_hash", sa.String(64), nullable=True))
+    op.add_column("messages", sa.Column("file_size", sa.BigInteger(), nullable=True))
+    op.create_index("ix_messages_file_hash", "messages", ["file_hash"])
+
+
+def downgrade():
+    op.drop_index("ix_messages_file_hash", "messages")
+    op.drop_column("messages", "file_size")
+    op.drop_column("messages", "file_hash")
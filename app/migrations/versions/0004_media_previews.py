@@ -0,0 +1,27 @@
+"""Thumbnail, blurhash and dimensions of image and video attachments
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("messages", sa.Column("thumbnail_url", sa.String(), nullable=True))
+    op.add_column("messages", sa.Column("blurhash", sa.String(), nullable=True))
+    op.add_column("messages", sa.Column("media_width", sa.Integer(), nullable=True))
+    op.add_column("messages", sa.Column("media_height", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("messages", "media_height")
+    op.drop_column("messages", "media_width")
+    op.drop_column("messages", "blurhash")
+    op.drop_column("messages", "thumbnail_url")
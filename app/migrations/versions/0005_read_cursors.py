@@ -0,0 +1,36 @@
+"""Per-user read cursors and each chat's newest message id
+
+Chats get their newest message id. Cursors start there, so history from
+before per-user read state counts as read instead of every chat showing
+all its messages unread.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("chats", sa.Column("last_message_id", sa.Integer(), nullable=True))
+    op.add_column(
+        "user_chat", sa.Column("last_read_message_id", sa.Integer(), nullable=False, server_default="0")
+    )
+    op.execute(
+        "UPDATE chats SET last_message_id = (SELECT max(m.id) FROM messages m WHERE m.chat_id = chats.id)"
+    )
+    op.execute(
+        "UPDATE user_chat SET last_read_message_id = coalesce("
+        "(SELECT c.last_message_id FROM chats c WHERE c.id = user_chat.chat_id), 0)"
+    )
+
+
+def downgrade():
+    op.drop_column("user_chat", "last_read_message_id")
+    op.drop_column("chats", "last_message_id")
@@ -0,0 +1,49 @@
+"""Direct chats indexed by their ordered pair of users
+
+Existing direct chats, non-group chats of exactly two users, are indexed
+here; when a pair has several, the oldest one is kept.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "direct_chats",
+        sa.Column("user_low_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("user_high_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), nullable=False, unique=True),
+        sa.CheckConstraint("user_low_id <= user_high_id", name="ck_direct_chats_ordered_pair"),
+    )
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT min(uc.user_id), max(uc.user_id), uc.chat_id FROM user_chat uc "
+        "JOIN chats c ON c.id = uc.chat_id "
+        "WHERE NOT c.is_group AND uc.user_id IS NOT NULL "
+        "GROUP BY uc.chat_id HAVING count(DISTINCT uc.user_id) = 2 ORDER BY uc.chat_id"
+    )).all()
+    seen = set()
+    new_rows = []
+    for user_low_id, user_high_id, chat_id in rows:
+        if (user_low_id, user_high_id) not in seen:
+            seen.add((user_low_id, user_high_id))
+            new_rows.append({"user_low_id": user_low_id, "user_high_id": user_high_id, "chat_id": chat_id})
+    if new_rows:
+        bind.execute(
+            sa.text("INSERT INTO direct_chats (user_low_id, user_high_id, chat_id) "
+                    "VALUES (:user_low_id, :user_high_id, :chat_id)"),
+            new_rows,
+        )
+
+
+def downgrade():
+    op.drop_table("direct_chats")
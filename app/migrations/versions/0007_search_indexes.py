@@ -0,0 +1,85 @@
+"""Full-text message search and prefix/trigram user search
+
+SQLite gets an FTS5 table kept in sync by triggers and built from the
+existing messages; PostgreSQL an expression GIN index. Without FTS5, or
+without the rights for pg_trgm, that index is skipped and search scans.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+import logging
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+SQLITE_MESSAGE_INDEX = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+SQLITE_USER_INDEXES = [
+    "CREATE INDEX ix_users_username_lower ON users (lower(username))",
+    "CREATE INDEX ix_users_email_lower ON users (lower(email))",
+]
+POSTGRES_MESSAGE_INDEX = (
+    "CREATE INDEX ix_messages_content_tsv ON messages USING gin (to_tsvector('simple', coalesce(content, '')))"
+)
+POSTGRES_USER_INDEXES = [
+    "CREATE INDEX ix_users_username_prefix ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX ix_users_email_prefix ON users (lower(email) text_pattern_ops)",
+]
+POSTGRES_TRIGRAM_INDEX = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)",
+]
+
+
+def optional(statements):
+    bind = op.get_bind()
+    try:
+        with bind.begin_nested():
+            for statement in statements:
+                bind.execute(sa.text(statement))
+    except sa.exc.DBAPIError as e:
+        logger.warning("Skipping optional search index: %s", e.orig)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.execute(POSTGRES_MESSAGE_INDEX)
+        for statement in POSTGRES_USER_INDEXES:
+            op.execute(statement)
+        optional(POSTGRES_TRIGRAM_INDEX)
+    elif dialect == "sqlite":
+        optional(SQLITE_MESSAGE_INDEX)
+        for statement in SQLITE_USER_INDEXES:
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        for name in ("ix_users_username_trgm", "ix_users_email_prefix", "ix_users_username_prefix",
+                     "ix_messages_content_tsv"):
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+    elif dialect == "sqlite":
+        for name in ("ix_users_email_lower", "ix_users_username_lower"):
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+        for trigger in ("messages_fts_au", "messages_fts_ad", "messages_fts_ai"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
@@ -0,0 +1,36 @@
+"""Per-chat sequence numbers of messages
+
+Existing messages are numbered in id order within their chat, and each
+chat's last_seq is set to its highest number.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("chats", sa.Column("last_seq", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("messages", sa.Column("seq", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE messages SET seq = numbered.seq FROM ("
+        "SELECT id, row_number() OVER (PARTITION BY chat_id ORDER BY id) AS seq FROM messages"
+        ") AS numbered WHERE messages.id = numbered.id"
+    )
+    op.execute(
+        "UPDATE chats SET last_seq = coalesce((SELECT max(m.seq) FROM messages m WHERE m.chat_id = chats.id), 0)"
+    )
+    op.create_index("ix_messages_chat_id_seq", "messages", ["chat_id", "seq"], unique=True)
+
+
+def downgrade():
+    op.drop_index("ix_messages_chat_id_seq", "messages")
+    op.drop_column("messages", "seq")
+    op.drop_column("chats", "last_seq")
@@ -0,0 +1,96 @@
+"""Id-range partitions of messages, their archive and soft-deleted chats
+
+On PostgreSQL a unique index on a partitioned table must include the
+partition key, so (chat_id, seq) gets a plain index there. An empty
+messages table is recreated PARTITION BY RANGE (id). One that already has
+rows is left as it is, and the archive then works on logical ranges,
+deleting archived rows instead of dropping partitions.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+POSTGRES_MESSAGE_INDEX = (
+    "CREATE INDEX ix_messages_content_tsv ON messages USING gin (to_tsvector('simple', coalesce(content, '')))"
+)
+
+
+def partition_messages():
+    op.drop_table("messages")
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("content", sa.String()),
+        sa.Column("timestamp", sa.DateTime()),
+        sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id")),
+        sa.Column("is_read", sa.Boolean()),
+        sa.Column("file_url", sa.String(), nullable=True),
+        sa.Column("filetype", sa.String(), nullable=True),
+        sa.Column("filename", sa.String(), nullable=True),
+        sa.Column("file_hash", sa.String(64), nullable=True),
+        sa.Column("file_size", sa.BigInteger(), nullable=True),
+        sa.Column("thumbnail_url", sa.String(), nullable=True),
+        sa.Column("blurhash", sa.String(), nullable=True),
+        sa.Column("media_width", sa.Integer(), nullable=True),
+        sa.Column("media_height", sa.Integer(), nullable=True),
+        sa.Column("seq", sa.Integer(), nullable=True),
+        postgresql_partition_by="RANGE (id)",
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+    op.create_index("ix_messages_file_hash", "messages", ["file_hash"])
+    op.execute(POSTGRES_MESSAGE_INDEX)
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.add_column("chats", sa.Column("deleted_at", sa.DateTime(), nullable=True))
+    op.create_table(
+        "message_partitions",
+        sa.Column("low_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("high_id", sa.Integer(), nullable=False),
+        sa.Column("state", sa.String(), nullable=False),
+        sa.Column("claimed_at", sa.DateTime(), nullable=True),
+        sa.Column("archive_key", sa.String(), nullable=True),
+        sa.Column("row_count", sa.Integer(), nullable=True),
+        sa.Column("first_at", sa.DateTime(), nullable=True),
+        sa.Column("last_at", sa.DateTime(), nullable=True),
+        sa.Column("archived_at", sa.DateTime(), nullable=True),
+    )
+    op.create_table(
+        "archived_message_blocks",
+        sa.Column("chat_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("first_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("last_id", sa.Integer(), nullable=False),
+        sa.Column("partition_low_id", sa.Integer(), sa.ForeignKey("message_partitions.low_id"), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.Column("length", sa.Integer(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+    )
+    if bind.dialect.name == "postgresql":
+        if bind.execute(sa.text("SELECT NOT EXISTS (SELECT 1 FROM messages)")).scalar():
+            partition_messages()
+        else:
+            op.drop_index("ix_messages_chat_id_seq", "messages")
+        op.create_index("ix_messages_chat_id_seq_pg", "messages", ["chat_id", "seq"])
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        op.drop_index("ix_messages_chat_id_seq_pg", "messages")
+        kind = bind.execute(sa.text("SELECT relkind::text FROM pg_class WHERE oid = 'messages'::regclass")).scalar()
+        # A partitioned table cannot have it; it stays partitioned with a plain index
+        op.create_index("ix_messages_chat_id_seq", "messages", ["chat_id", "seq"], unique=kind != "p")
+    op.drop_table("archived_message_blocks")
+    op.drop_table("message_partitions")
+    op.drop_column("chats", "deleted_at")
@@ -0,0 +1,75 @@
+"""Participants with a primary key and role; indexes for the routers' queries
+
+user_chat had no key, so a user could be in a chat twice; duplicates are
+merged keeping the furthest read cursor. Nobody was ever recorded as owner,
+so every existing member of a group becomes an admin and can keep adding
+people.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_chat_new",
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("role", sa.String(16), nullable=False, server_default="member"),
+        sa.Column("joined_at", sa.DateTime(), nullable=False, server_default=sa.func.current_timestamp()),
+        sa.Column("last_read_message_id", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.execute(
+        "INSERT INTO user_chat_new (chat_id, user_id, role, joined_at, last_read_message_id) "
+        "SELECT uc.chat_id, uc.user_id, "
+        "CASE WHEN c.is_group THEN 'admin' ELSE 'member' END, "
+        "coalesce(c.created_at, current_timestamp), max(uc.last_read_message_id) "
+        "FROM user_chat uc JOIN chats c ON c.id = uc.chat_id "
+        "WHERE uc.chat_id IS NOT NULL AND uc.user_id IS NOT NULL "
+        "GROUP BY uc.chat_id, uc.user_id, c.is_group, c.created_at"
+    )
+    op.drop_table("user_chat")
+    op.rename_table("user_chat_new", "user_chat")
+    op.create_index("ix_user_chat_user_id_chat_id", "user_chat", ["user_id", "chat_id", "last_read_message_id"])
+
+    op.drop_index("ix_messages_chat_id_id", "messages")
+    op.drop_index("ix_messages_file_hash", "messages")
+    op.create_index("ix_messages_chat_id_id_sender_id", "messages", ["chat_id", "id", "sender_id"])
+    op.create_index("ix_messages_sender_id", "messages", ["sender_id"])
+    op.create_index("ix_messages_file_hash_chat_id", "messages", ["file_hash", "chat_id"])
+    op.create_index(
+        "ix_chats_deleted_at", "chats", ["deleted_at"],
+        postgresql_where=sa.text("deleted_at IS NOT NULL"), sqlite_where=sa.text("deleted_at IS NOT NULL"),
+    )
+    op.create_index("ix_archived_message_blocks_partition_low_id", "archived_message_blocks", ["partition_low_id"])
+
+
+def downgrade():
+    op.drop_index("ix_archived_message_blocks_partition_low_id", "archived_message_blocks")
+    op.drop_index("ix_chats_deleted_at", "chats")
+    op.drop_index("ix_messages_file_hash_chat_id", "messages")
+    op.drop_index("ix_messages_sender_id", "messages")
+    op.drop_index("ix_messages_chat_id_id_sender_id", "messages")
+    op.create_index("ix_messages_file_hash", "messages", ["file_hash"])
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+
+    op.create_table(
+        "user_chat_old",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id")),
+        sa.Column("last_read_message_id", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.execute(
+        "INSERT INTO user_chat_old (user_id, chat_id, last_read_message_id) "
+        "SELECT user_id, chat_id, last_read_message_id FROM user_chat"
+    )
+    op.drop_table("user_chat")
+    op.rename_table("user_chat_old", "user_chat")
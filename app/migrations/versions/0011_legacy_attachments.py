@@ -0,0 +1,93 @@
+"""Move attachments from before content-addressed storage into it
+
+The first release saved uploads as app/routers/uploads/<filename> and linked
+them as /static/uploads/<filename>, which is no longer served. Each such
+file is hashed and copied into storage under its SHA-256, and its messages
+get file_hash, file_size and the authenticated /chats/{id}/files/ URL.
+Files that are gone leave their messages as they are. LEGACY_UPLOADS_DIR
+names the old directory if it was moved.
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from alembic import op
+import sqlalchemy as sa
+from app.storage.storage import CHUNK_SIZE, content_key, storage
+
+revision = "0011"
+down_revision = "0010"
+branch_labels = None
+depends_on = None
+
+LEGACY_PREFIX = "/static/uploads/"
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+def hash_file(path: str):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def upgrade():
+    legacy_dir = os.path.realpath(os.getenv("LEGACY_UPLOADS_DIR", "app/routers/uploads"))
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT id, chat_id, file_url, filetype FROM messages "
+        "WHERE file_hash IS NULL AND file_url LIKE :prefix ORDER BY id"
+    ), {"prefix": LEGACY_PREFIX + "%"}).all()
+    stored = {}
+    updates = []
+    missing = 0
+    # Migrations run inside the event loop of env.py; storage calls get loops of their own
+    with ThreadPoolExecutor(1) as pool:
+        for message_id, chat_id, file_url, filetype in rows:
+            path = os.path.realpath(os.path.join(legacy_dir, unquote(file_url[len(LEGACY_PREFIX):])))
+            if path not in stored:
+                if os.path.dirname(path) != legacy_dir or not os.path.isfile(path):
+                    stored[path] = None
+                else:
+                    sha256, size = hash_file(path)
+                    key = content_key(sha256)
+                    if not pool.submit(asyncio.run, storage.exists(key)).result():
+                        # put consumes its file; the original stays until someone removes the old directory
+                        fd, staged = tempfile.mkstemp(dir=storage.staging_dir())
+                        os.close(fd)
+                        shutil.copyfile(path, staged)
+                        pool.submit(asyncio.run, storage.put(key, staged, filetype)).result()
+                    stored[path] = (sha256, size)
+            if stored[path] is None:
+                missing += 1
+                continue
+            sha256, size = stored[path]
+            updates.append({
+                "id": message_id,
+                "file_hash": sha256,
+                "file_size": size,
+                "file_url": f"/chats/{chat_id}/files/{sha256}",
+            })
+    if updates:
+        bind.execute(sa.text(
+            "UPDATE messages SET file_hash = :file_hash, file_size = :file_size, file_url = :file_url WHERE id = :id"
+        ), updates)
+    if missing:
+        logger.warning("%d legacy attachments not found under %s; left unchanged", missing, legacy_dir)
+
+
+def downgrade():
+    # The copies in storage and the hashes are harmless to keep
+    pass
@@ -1,15 +1,33 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Table
+from sqlalchemy import BigInteger, Boolean, CheckConstraint, Column, ForeignKey, Integer, String, DateTime, Index, func
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from ..database import Base
 
-# Association table for many-to-many relationship between users and chats
-user_chat = Table(
-    'user_chat',
-    Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id')),
-    Column('chat_id', Integer, ForeignKey('chats.id'))
-)
+# Participant roles; owners and admins may add people to a group
+OWNER = "owner"
+ADMIN = "admin"
+MEMBER = "member"
+ADMIN_ROLES = (OWNER, ADMIN)
+
+class ChatParticipant(Base):
+    """A user's membership of a chat; also the secondary of ``Chat.participants``"""
+    __tablename__ = "user_chat"
+
+    # Chat first: membership checks and room fan-out look up by chat
+    chat_id = Column(Integer, ForeignKey("chats.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    role = Column(String(16), nullable=False, default=MEMBER, server_default=MEMBER)
+    joined_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.current_timestamp())
+    # Highest message id the user has read in the chat
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default="0")
+
+    # A user's chats with their read cursors, answered from the index alone
+    __table_args__ = (
+        Index("ix_user_chat_user_id_chat_id", "user_id", "chat_id", "last_read_message_id"),
+    )
+
+# Most queries join the participants table in Core
+user_chat = ChatParticipant.__table__
 
 class User(Base):
     __tablename__ = "users"
@@ -32,24 +50,115 @@ class Chat(Base):
     name = Column(String, index=True)
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Denormalized newest message id, moved forward on every insert. No
+    # foreign key: chats and messages would reference each other.
+    last_message_id = Column(Integer, nullable=True)
+    # Last sequence number handed to a message of this chat
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
+    # Set when the chat is deleted; its messages are purged in the background
+    deleted_at = Column(DateTime, nullable=True)
     
     # Relationships
     messages = relationship("Message", back_populates="chat")
     participants = relationship("User", secondary=user_chat, back_populates="chats")
 
+    # The purge only looks for the few deleted chats
+    __table_args__ = (
+        Index(
+            "ix_chats_deleted_at", "deleted_at",
+            postgresql_where=deleted_at.isnot(None), sqlite_where=deleted_at.isnot(None),
+        ),
+    )
+
+class DirectChat(Base):
+    """The direct chat of a pair of users, stored once with the smaller id first"""
+    __tablename__ = "direct_chats"
+
+    # The composite primary key is the pair lookup index
+    user_low_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    user_high_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False, unique=True)
+
+    __table_args__ = (
+        CheckConstraint("user_low_id <= user_high_id", name="ck_direct_chats_ordered_pair"),
+    )
+
+    @staticmethod
+    def pair(user_a: int, user_b: int):
+        return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+def not_postgresql(ddl, target, bind, dialect, **kw) -> bool:
+    return dialect.name != "postgresql"
+
 class Message(Base):
     __tablename__ = "messages"
 
     id = Column(Integer, primary_key=True, index=True)
     content = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow)
-    sender_id = Column(Integer, ForeignKey("users.id"))
+    sender_id = Column(Integer, ForeignKey("users.id"), index=True)
     chat_id = Column(Integer, ForeignKey("chats.id"))
     is_read = Column(Boolean, default=False)
     file_url = Column(String, nullable=True)
     filetype = Column(String, nullable=True)
     filename = Column(String, nullable=True)
+    # SHA-256 of the attachment; also its storage key
+    file_hash = Column(String(64), nullable=True)
+    file_size = Column(BigInteger, nullable=True)
+    # Filled in by the preview pipeline once the thumbnail exists
+    thumbnail_url = Column(String, nullable=True)
+    blurhash = Column(String, nullable=True)
+    media_width = Column(Integer, nullable=True)
+    media_height = Column(Integer, nullable=True)
+    # Position of the message in its chat; clients resume from the last one they saw
+    seq = Column(Integer, nullable=True)
     
     # Relationships
     sender = relationship("User", back_populates="messages")
-    chat = relationship("Chat", back_populates="messages") 
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
+
+    # Keyset pagination of a chat's history walks (chat_id, id); sender_id lets
+    # unread counts skip the user's own messages without reading rows.
+    # Attachment lookups go by (file_hash, chat_id). On PostgreSQL the table is
+    # range partitioned by id (see storage/archive.py), and a unique index
+    # there would have to include id; seqs are unique by construction anyway.
+    __table_args__ = (
+        Index("ix_messages_chat_id_id_sender_id", "chat_id", "id", "sender_id"),
+        Index("ix_messages_file_hash_chat_id", "file_hash", "chat_id"),
+        Index("ix_messages_chat_id_seq", "chat_id", "seq", unique=True).ddl_if(callable_=not_postgresql),
+        Index("ix_messages_chat_id_seq_pg", "chat_id", "seq").ddl_if(dialect="postgresql"),
+        {"postgresql_partition_by": "RANGE (id)"},
+    )
+
+class MessagePartition(Base):
+    """A range of message ids: a native partition on PostgreSQL, a logical one elsewhere.
+
+    Ids grow with time, so each range holds a contiguous stretch of history.
+    Cold ranges are moved to an archive file and dropped from ``messages``.
+    """
+    __tablename__ = "message_partitions"
+
+    low_id = Column(Integer, primary_key=True, autoincrement=False)
+    # Exclusive
+    high_id = Column(Integer, nullable=False)
+    # "live", "archiving" or "archived"
+    state = Column(String, nullable=False, default="live")
+    claimed_at = Column(DateTime, nullable=True)
+    archive_key = Column(String, nullable=True)
+    row_count = Column(Integer, nullable=True)
+    first_at = Column(DateTime, nullable=True)
+    last_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=True)
+
+class ArchivedBlock(Base):
+    """Consecutive archived messages of one chat, stored as one gzip member of an archive file"""
+    __tablename__ = "archived_message_blocks"
+
+    # No foreign key to chats: blocks of a deleted chat are purged after it
+    chat_id = Column(Integer, primary_key=True, autoincrement=False)
+    first_id = Column(Integer, primary_key=True, autoincrement=False)
+    last_id = Column(Integer, nullable=False)
+    partition_low_id = Column(Integer, ForeignKey("message_partitions.low_id"), nullable=False, index=True)
+    offset = Column(BigInteger, nullable=False)
+    length = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
@@ -0,0 +1,73 @@
+from typing import Callable, Dict
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from .metrics import COUNT_BUCKETS, registry
+from .tracing import traced
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests answered", ["method", "route", "status"]
+)
+http_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to answer an HTTP request", ["method", "route"]
+)
+http_db_queries = registry.histogram(
+    "http_request_db_queries", "SQL statements executed per HTTP request", ["route"], COUNT_BUCKETS
+)
+http_db_duration = registry.histogram(
+    "http_request_db_seconds", "Time spent in SQL per HTTP request", ["route"]
+)
+
+
+class MetricsMiddleware:
+    """Record latency, status and database cost of every HTTP request per route.
+
+    Routes are labelled by their path template (``/chats/{chat_id}``), so the
+    number of series stays bounded; paths matching no route share
+    ``unmatched``. With tracing on, responses carry a ``Server-Timing``
+    header with the time spent in the database and other stages.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._templates: Dict[Callable, str] = {}
+
+    def _route(self, scope: Scope) -> str:
+        # Starlette leaves the matched endpoint in the scope
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        template = self._templates.get(endpoint)
+        if template is None:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is not None:
+                    self._templates[route.endpoint] = route.path
+            template = self._templates.setdefault(endpoint, "unmatched")
+        return template
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            # WebSocket frames are traced one by one by the endpoint
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = 500
+
+        with traced(f"{method} {scope['path']}") as trace:
+            async def send_wrapper(message: Message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    if trace.spans is not None:
+                        timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.stage_totals())
+                        message["headers"] = [*message.get("headers", []), (b"server-timing", timing.encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = self._route(scope)
+                elapsed = trace.elapsed()
+                http_requests.inc(method, route, str(status))
+                http_duration.observe(elapsed, method, route)
+                http_db_queries.observe(trace.db_queries, route)
+                http_db_duration.observe(trace.db_time, route)
+                trace.finish(str(status))
@@ -0,0 +1,146 @@
+import logging
+import random
+import time
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .metrics import registry
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests and frames whose spans are logged
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Requests and frames slower than this are logged with their spans; 0 disables
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+# Spans are only collected when something may log them
+TRACING = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Time spent executing one SQL statement"
+)
+stage_duration = registry.histogram(
+    "stage_duration_seconds", "Time spent in instrumented stages such as broadcast", ["stage"]
+)
+
+
+class Trace:
+    """Cost of one HTTP request or WebSocket frame, tracked through a context variable"""
+
+    __slots__ = ("name", "started", "db_queries", "db_time", "spans", "sampled")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        # (stage, offset from start, duration), only when tracing is on
+        self.spans: Optional[List[Tuple[str, float, float]]] = [] if TRACING else None
+        self.sampled = TRACING and random.random() < TRACE_SAMPLE_RATE
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add_span(self, stage: str, started: float, duration: float):
+        if self.spans is not None:
+            self.spans.append((stage, started - self.started, duration))
+
+    def stage_totals(self) -> List[Tuple[str, float]]:
+        totals = {"db": self.db_time}
+        for stage, _, duration in self.spans or ():
+            if stage != "db":
+                totals[stage] = totals.get(stage, 0.0) + duration
+        return list(totals.items())
+
+    def finish(self, outcome: str = ""):
+        """Log the trace if it was sampled or slow"""
+        if self.spans is None:
+            return
+        elapsed = self.elapsed()
+        if not self.sampled and not (TRACE_SLOW_MS and elapsed * 1000 >= TRACE_SLOW_MS):
+            return
+        logger.info(
+            "trace %s %s %.1fms db=%d/%.1fms spans=%s",
+            self.name, outcome, elapsed * 1000, self.db_queries, self.db_time * 1000,
+            " ".join(f"{stage}@{offset * 1000:.1f}+{duration * 1000:.1f}ms" for stage, offset, duration in self.spans),
+        )
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+class span:
+    """Time a stage into ``stage_duration_seconds`` and the current trace::
+
+        with span("broadcast"):
+            ...
+    """
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.started
+        stage_duration.observe(duration, self.stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(self.stage, self.started, duration)
+        return False
+
+
+class traced:
+    """Make a new trace current for the duration of the block"""
+
+    __slots__ = ("trace", "token")
+
+    def __init__(self, name: str):
+        self.trace = Trace(name)
+
+    def __enter__(self) -> Trace:
+        self.token = current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        current_trace.reset(self.token)
+        return False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    duration = time.perf_counter() - started
+    db_query_duration.observe(duration)
+    # The async driver runs these hooks in the awaiting task's context
+    trace = current_trace.get()
+    if trace is not None:
+        trace.db_queries += 1
+        trace.db_time += duration
+        trace.add_span("db", started, duration)
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: Engine):
+    """Count and time every statement of a (sync) engine; async engines pass ``.sync_engine``"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
@@ -0,0 +1,236 @@
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from dotenv import load_dotenv
+from fastapi import Depends
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from .auth import auth
+from .auth.cache import MISSING, TTLCache
+from .database import SessionLocal, acting_user, pool_options, to_async_url
+from .monitoring.tracing import instrument_engine
+from .websockets.backplane import Backplane
+from .websockets.manager import manager
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Backplane channel carrying "<user_id>" of users who just wrote
+WRITES_CHANNEL = "writes"
+
+# Seconds the replica is behind; 0 on a primary or a standby that replayed all it received
+POSTGRES_LAG = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+# Sessions on a replica; which engine is chosen per request
+ReadSession = async_sessionmaker(expire_on_commit=False)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = to_async_url(url)
+        self.name = self.url.render_as_string(hide_password=True)
+        self.engine = create_async_engine(self.url, **pool_options(self.url))
+        # Nothing is routed here before the first check passes
+        self.healthy = False
+        self.checked = False
+        self.lag: Optional[float] = None
+        event.listen(self.engine.sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        # A dropped connection takes the replica out of rotation until the next check passes
+        if context.is_disconnect and self.healthy:
+            self.healthy = False
+            logger.warning("Read replica %s disconnected; reading from the primary", self.name)
+
+
+class ReplicaRouter:
+    """Sends read-only sessions to healthy read replicas, the rest to the primary.
+
+    Each replica is checked every ``interval`` seconds: it must answer and,
+    on PostgreSQL, be at most ``max_lag`` seconds behind. Requests are spread
+    round-robin over the healthy ones and fall back to the primary when none
+    is, or when the chosen one cannot be reached.
+
+    Whatever a user commits makes their own reads go to the primary for
+    ``window`` seconds, so they see their writes whatever the replication lag.
+    Commits are noticed by session events and tied to the user through
+    ``database.acting_user``; the other workers hear of them over the
+    backplane, at most twice per window for a user who keeps writing.
+    """
+
+    def __init__(self, urls: List[str], backplane: Backplane, interval: float = 5.0,
+                 max_lag: float = 10.0, window: float = 5.0):
+        self.replicas = [Replica(url) for url in urls]
+        self.backplane = backplane
+        self.interval = interval
+        self.max_lag = max_lag
+        self.window = window
+        # user id -> when this worker last announced their write
+        self._writers = TTLCache(100_000, window)
+        self._turn = itertools.count()
+        self._announcements = set()
+        self._task: Optional[asyncio.Task] = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+        backplane.subscribe(WRITES_CHANNEL, self._on_write)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    async def start(self):
+        if not self.enabled:
+            return
+        for replica in self.replicas:
+            instrument_engine(replica.engine.sync_engine)
+        await self.check()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._announcements, return_exceptions=True)
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    async def check(self):
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def _check(self, replica: Replica):
+        try:
+            lag = await asyncio.wait_for(self._lag(replica), self.interval)
+        except Exception as e:
+            if replica.healthy or not replica.checked:
+                logger.warning("Read replica %s is down: %s", replica.name, e)
+            replica.healthy, replica.lag, replica.checked = False, None, True
+            return
+        healthy = lag <= self.max_lag
+        if healthy != replica.healthy or not replica.checked:
+            if healthy:
+                logger.info("Read replica %s is serving reads", replica.name)
+            else:
+                logger.warning("Read replica %s is %.1fs behind; reading from the primary", replica.name, lag)
+        replica.healthy, replica.lag, replica.checked = healthy, lag, True
+
+    @staticmethod
+    async def _lag(replica: Replica) -> float:
+        async with replica.engine.connect() as conn:
+            if conn.dialect.name == "postgresql":
+                return float(await conn.scalar(text(POSTGRES_LAG)) or 0)
+            await conn.execute(text("SELECT 1"))
+            return 0.0
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Checking the read replicas failed")
+
+    def is_sticky(self, user_id: Optional[int]) -> bool:
+        return user_id is not None and self._writers.get(user_id) is not MISSING
+
+    def wrote(self, user_id: Optional[int]):
+        """Keep the user's reads on the primary for the next ``window`` seconds"""
+        if not self.enabled or not self.window or user_id is None:
+            return
+        now = time.monotonic()
+        announced = self._writers.get(user_id)
+        if announced is not MISSING and now - announced < self.window / 2:
+            # The other workers still hold it for at least half a window
+            self._writers.put(user_id, announced)
+            return
+        self._writers.put(user_id, now)
+        try:
+            task = asyncio.get_running_loop().create_task(
+                self.backplane.publish(WRITES_CHANNEL, b"%d" % user_id)
+            )
+        except RuntimeError:
+            return
+        self._announcements.add(task)
+        task.add_done_callback(self._announcements.discard)
+
+    async def _on_write(self, data: bytes):
+        self._writers.put(int(data), time.monotonic())
+
+    def pick(self, user_id: Optional[int]) -> Optional[Replica]:
+        if self.is_sticky(user_id):
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    @asynccontextmanager
+    async def session(self, user_id: Optional[int]):
+        """A session for reads on behalf of the user: on a replica when one may serve them"""
+        replica = self.pick(user_id)
+        db = None
+        if replica is not None:
+            db = ReadSession(bind=replica.engine, info={"replica": replica.name})
+            try:
+                # Connecting up front lets an unreachable replica fall back before any query
+                await db.connection()
+            except (DBAPIError, OSError) as e:
+                await db.close()
+                db = None
+                replica.healthy = False
+                self.fallbacks += 1
+                logger.warning("Read replica %s is unreachable; reading from the primary: %s", replica.name, e)
+        if db is None:
+            db = SessionLocal()
+            self.primary_reads += 1
+        else:
+            self.replica_reads += 1
+        async with db:
+            yield db
+
+
+@event.listens_for(Session, "after_flush")
+def _flushed(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _executed(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _committed(session):
+    if session.info.pop("wrote", False):
+        replicas.wrote(acting_user.get())
+
+
+@event.listens_for(Session, "after_rollback")
+def _rolled_back(session):
+    session.info.pop("wrote", None)
+
+
+async def get_read_db(current_user: auth.Principal = Depends(auth.get_current_active_user)):
+    """Like ``get_db``, for endpoints that only read: may be served by a replica"""
+    async with replicas.session(current_user.id) as db:
+        yield db
+
+
+replicas = ReplicaRouter(
+    [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()],
+    manager.backplane,
+    interval=float(os.getenv("REPLICA_CHECK_INTERVAL", "5")),
+    max_lag=float(os.getenv("REPLICA_MAX_LAG", "10")),
+    window=float(os.getenv("READ_YOUR_WRITES_SECONDS", "5")),
+)
@@ -3,11 +3,17 @@ from .auth import router as auth_router
 from .users import router as users_router
 from .chats import router as chats_router
 from .messages import router as messages_router
+from .files import router as files_router
+from .search import router as search_router
 from .websockets import router as websockets_router
+from .metrics import router as metrics_router
 
 router = APIRouter()
 router.include_router(auth_router)
 router.include_router(users_router)
 router.include_router(chats_router)
 router.include_router(messages_router)
-router.include_router(websockets_router) 
\ No newline at end of file
+router.include_router(files_router)
+router.include_router(search_router)
+router.include_router(websockets_router)
+router.include_router(metrics_router) 
\ No newline at end of file
@@ -1,31 +1,56 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import List
 from ..database import get_db
+from ..replicas import get_read_db
 from ..models import models
 from ..schemas import schemas
 from ..auth import auth
+from ..auth.membership import membership, require_participant
 from ..websockets.manager import manager
+from ..websockets.read_cursors import read_cursors
+from ..storage.archive import message_archive
+from datetime import datetime
 from fastapi import UploadFile, File
 router = APIRouter(prefix="/chats", tags=["chats"])
 
+async def load_chat(db: AsyncSession, chat_id: int):
+    """Fetch a chat with its participants loaded up front"""
+    return await db.scalar(
+        select(models.Chat)
+        .where(models.Chat.id == chat_id)
+        .options(selectinload(models.Chat.participants))
+    )
+
 @router.post("/", response_model=schemas.Chat)
 async def create_chat(
     chat: schemas.ChatCreate,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_db)
 ):
+    # Owner first, then the requested users in order; unknown ids are skipped
+    ordered_ids = list(dict.fromkeys([current_user.id, *chat.participant_ids]))
+    users = {u.id: u for u in await db.scalars(select(models.User).where(models.User.id.in_(ordered_ids)))}
+    participants = [users[user_id] for user_id in ordered_ids if user_id in users]
     db_chat = models.Chat(name=chat.name, is_group=chat.is_group)
-    db_chat.participants.append(current_user)
     db.add(db_chat)
-    db.commit()
-    db.refresh(db_chat)
-    for user_id in chat.participant_ids:
-        user = db.query(models.User).filter(models.User.id == user_id).first()
-        if user:
-            db_chat.participants.append(user)
-    db.commit()
-    db.refresh(db_chat)
+    await db.flush()
+    # Rows are added with their roles rather than through the relationship; the creator owns the chat
+    db.add_all(
+        models.ChatParticipant(
+            chat_id=db_chat.id, user_id=user.id,
+            role=models.OWNER if user.id == current_user.id else models.MEMBER
+        )
+        for user in participants
+    )
+    set_committed_value(db_chat, "participants", participants)
+    await db.commit()
+    await membership.invalidate(db_chat.id)
+    await manager.subscribe(db_chat.id, [p.id for p in db_chat.participants])
     chat_data = {
         "id": db_chat.id,
         "name": db_chat.name,
@@ -36,55 +61,108 @@ async def create_chat(
     await manager.notify_chat_update(db_chat.id, "new_chat", chat_data)
     return db_chat
 
-@router.get("/", response_model=List[schemas.Chat])
-def get_user_chats(current_user: models.User = Depends(auth.get_current_active_user), db: Session = Depends(get_db)):
-    return current_user.chats
+@router.get("/", response_model=List[schemas.ChatSummary])
+async def get_user_chats(current_user: auth.Principal = Depends(auth.get_current_active_user), db: AsyncSession = Depends(get_read_db)):
+    """The sidebar: every chat with participants, last message and unread count.
+
+    Four queries however many chats the user has: chats with read cursors,
+    their participants, the last messages, and unread counts grouped by chat.
+    """
+    if read_cursors.has_pending(current_user.id):
+        await read_cursors.flush()
+    cursor = models.user_chat.c
+    rows = (await db.execute(
+        select(models.Chat, cursor.last_read_message_id)
+        .join(models.user_chat, cursor.chat_id == models.Chat.id)
+        .where(cursor.user_id == current_user.id)
+        .options(selectinload(models.Chat.participants))
+        .order_by(func.coalesce(models.Chat.last_message_id, 0).desc(), models.Chat.id.desc())
+    )).unique().all()
+
+    last_ids = [chat.last_message_id for chat, _ in rows if chat.last_message_id]
+    last_messages = {}
+    if last_ids:
+        last_messages = {m.id: m for m in await db.scalars(
+            select(models.Message).where(models.Message.id.in_(last_ids)).options(joinedload(models.Message.sender))
+        )}
+        # Chats quiet for long enough have their last message in the archive
+        missing = {chat.id: chat.last_message_id for chat, _ in rows
+                   if chat.last_message_id and chat.last_message_id not in last_messages}
+        last_messages.update(await message_archive.find(db, missing))
+
+    # Walks ix_messages_chat_id_id from each cursor; the user's own messages never count
+    unread = dict((await db.execute(
+        select(models.Message.chat_id, func.count())
+        .join(models.user_chat, (cursor.chat_id == models.Message.chat_id) & (cursor.user_id == current_user.id))
+        .where(models.Message.id > cursor.last_read_message_id, models.Message.sender_id != current_user.id)
+        .group_by(models.Message.chat_id)
+    )).all())
+
+    return [
+        {
+            "id": chat.id,
+            "name": chat.name,
+            "is_group": chat.is_group,
+            "created_at": chat.created_at,
+            "participants": chat.participants,
+            "last_message": last_messages.get(chat.last_message_id),
+            "last_read_message_id": last_read,
+            "unread_count": unread.get(chat.id, 0),
+        }
+        for chat, last_read in rows
+    ]
 
 @router.get("/{chat_id}", response_model=schemas.Chat)
-def get_chat(
+async def get_chat(
     chat_id: int,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    if current_user not in chat.participants:
-        raise HTTPException(status_code=403, detail="Not authorized to access this chat")
-    return chat
+    await require_participant(db, current_user.id, chat_id, "Not authorized to access this chat")
+    return await load_chat(db, chat_id)
+
+def mark_deleted(chat: models.Chat):
+    """Take a chat away from everyone now; its messages are purged in the background"""
+    chat.participants = []
+    chat.deleted_at = datetime.utcnow()
 
 @router.delete("/{chat_id}")
-async def delete_chat(chat_id: int, current_user: models.User = Depends(auth.get_current_active_user), db: Session = Depends(get_db)):
+async def delete_chat(chat_id: int, current_user: auth.Principal = Depends(auth.get_current_active_user), db: AsyncSession = Depends(get_db)):
     try:
-        chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
+        chat = await load_chat(db, chat_id)
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         participants = [p.id for p in chat.participants]
-        if current_user not in chat.participants:
+        if current_user.id not in participants:
             raise HTTPException(status_code=403, detail="Not authorized to delete this chat")
         if not chat.is_group:
-            db.query(models.Message).filter(models.Message.chat_id == chat_id).delete()
-            db.query(models.ChatParticipant).filter(models.ChatParticipant.chat_id == chat_id).delete()
-            db.delete(chat)
-            db.commit()
+            mark_deleted(chat)
+            await db.execute(delete(models.DirectChat).where(models.DirectChat.chat_id == chat_id))
+            await db.commit()
+            await membership.invalidate(chat_id)
+            await manager.unsubscribe(chat_id, participants)
             for user_id in participants:
                 await manager.notify_user_chats_update(user_id, {
                     "id": chat_id,
                     "deleted": True
                 })
             return {"message": "Chat deleted successfully"}
-        chat.participants.remove(current_user)
+        chat.participants = [p for p in chat.participants if p.id != current_user.id]
         if not chat.participants:
-            db.query(models.Message).filter(models.Message.chat_id == chat_id).delete()
-            db.delete(chat)
-            db.commit()
+            mark_deleted(chat)
+            await db.execute(delete(models.DirectChat).where(models.DirectChat.chat_id == chat_id))
+            await db.commit()
+            await membership.invalidate(chat_id)
+            await manager.unsubscribe(chat_id, participants)
             for user_id in participants:
                 await manager.notify_user_chats_update(user_id, {
                     "id": chat_id,
                     "deleted": True
                 })
         else:
-            db.commit()
+            await db.commit()
+            await membership.invalidate(chat_id, current_user.id)
+            await manager.unsubscribe(chat_id, [current_user.id])
             chat_data = {
                 "id": chat.id,
                 "name": chat.name,
@@ -96,23 +174,25 @@ async def delete_chat(chat_id: int, current_user: models.User = Depends(auth.get
                 if user_id != current_user.id:
                     await manager.notify_user_chats_update(user_id, chat_data)
         return {"message": "Successfully removed from chat"}
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/{chat_id}/leave")
-async def leave_chat(chat_id: int, current_user: models.User = Depends(auth.get_current_active_user), db: Session = Depends(get_db)):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
+async def leave_chat(chat_id: int, current_user: auth.Principal = Depends(auth.get_current_active_user), db: AsyncSession = Depends(get_db)):
+    chat = await load_chat(db, chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    participant = db.query(models.ChatParticipant).filter(
-        models.ChatParticipant.chat_id == chat_id,
-        models.ChatParticipant.user_id == current_user.id
-    ).first()
+    participant = await db.get(models.ChatParticipant, (chat_id, current_user.id))
     if not participant:
         raise HTTPException(status_code=403, detail="Not a participant in this chat")
-    db.delete(participant)
-    db.commit()
+    await db.delete(participant)
+    await db.commit()
+    await membership.invalidate(chat_id, current_user.id)
+    await manager.unsubscribe(chat_id, [current_user.id])
+    await db.refresh(chat, ["participants"])
     chat_data = {
         "id": chat.id,
         "name": chat.name,
@@ -129,31 +209,26 @@ async def leave_chat(chat_id: int, current_user: models.User = Depends(auth.get_
 async def add_participant(
     chat_id: int,
     user_id: int,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
+    chat = await load_chat(db, chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    current_participant = db.query(models.ChatParticipant).filter(
-        models.ChatParticipant.chat_id == chat_id,
-        models.ChatParticipant.user_id == current_user.id,
-        models.ChatParticipant.is_admin == True
-    ).first()
-    if not current_participant:
+    current_participant = await db.get(models.ChatParticipant, (chat_id, current_user.id))
+    if not current_participant or current_participant.role not in models.ADMIN_ROLES:
         raise HTTPException(status_code=403, detail="Not authorized to add participants")
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    existing_participant = db.query(models.ChatParticipant).filter(
-        models.ChatParticipant.chat_id == chat_id,
-        models.ChatParticipant.user_id == user_id
-    ).first()
-    if existing_participant:
+    if await db.get(models.ChatParticipant, (chat_id, user_id)):
         raise HTTPException(status_code=400, detail="User is already a participant")
-    participant = models.ChatParticipant(user_id=user_id, chat_id=chat_id)
+    participant = models.ChatParticipant(chat_id=chat_id, user_id=user_id)
     db.add(participant)
-    db.commit()
+    await db.commit()
+    await membership.invalidate(chat_id, user_id)
+    await manager.subscribe(chat_id, [user_id])
+    await db.refresh(chat, ["participants"])
     chat_data = {
         "id": chat.id,
         "name": chat.name,
@@ -167,50 +242,70 @@ async def add_participant(
 @router.post("/direct/{user_id}", response_model=schemas.Chat)
 async def create_direct_chat(
     user_id: int,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        target_user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not target_user:
-            raise HTTPException(status_code=404, detail="User not found")
-        existing_chat = db.query(models.Chat).filter(
-            models.Chat.is_group == False,
-            models.Chat.participants.contains(current_user),
-            models.Chat.participants.contains(target_user)
-        ).first()
-        if existing_chat:
+        user_low_id, user_high_id = models.DirectChat.pair(current_user.id, user_id)
+        # A second pass finds the chat of a request that created the pair concurrently
+        for attempt in range(2):
+            target_user = await db.get(models.User, user_id)
+            if not target_user:
+                raise HTTPException(status_code=404, detail="User not found")
+            existing_chat_id = await db.scalar(
+                select(models.DirectChat.chat_id).where(
+                    models.DirectChat.user_low_id == user_low_id,
+                    models.DirectChat.user_high_id == user_high_id
+                )
+            )
+            existing_chat = await load_chat(db, existing_chat_id) if existing_chat_id is not None else None
+            if existing_chat and {current_user.id, user_id} <= {p.id for p in existing_chat.participants}:
+                if attempt:
+                    # The winner may not have announced its chat yet
+                    await membership.invalidate(existing_chat.id)
+                    await manager.subscribe(existing_chat.id, [p.id for p in existing_chat.participants])
+                chat_data = {
+                    "id": existing_chat.id,
+                    "name": existing_chat.name,
+                    "is_private": existing_chat.is_group == False,
+                    "created_at": existing_chat.created_at.isoformat(),
+                    "participants": [{"id": p.id, "username": p.username} for p in existing_chat.participants]
+                }
+                await manager.notify_user_chats_update(current_user.id, chat_data)
+                await manager.notify_user_chats_update(user_id, chat_data)
+                return existing_chat
+            if existing_chat_id is not None:
+                # One of the pair left (or the chat is gone): start a fresh chat
+                await db.execute(delete(models.DirectChat).where(models.DirectChat.chat_id == existing_chat_id))
+            chat = models.Chat(
+                name=f"Direct Message with {target_user.username}",
+                is_group=False
+            )
+            chat.participants = list(dict.fromkeys([await db.get(models.User, current_user.id), target_user]))
+            db.add(chat)
+            await db.flush()
+            # The pair's primary key makes a concurrent duplicate fail here
+            db.add(models.DirectChat(user_low_id=user_low_id, user_high_id=user_high_id, chat_id=chat.id))
+            try:
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()
+                continue
+            await membership.invalidate(chat.id)
+            await manager.subscribe(chat.id, [p.id for p in chat.participants])
             chat_data = {
-                "id": existing_chat.id,
-                "name": existing_chat.name,
-                "is_private": existing_chat.is_group == False,
-                "created_at": existing_chat.created_at.isoformat(),
-                "participants": [{"id": p.id, "username": p.username} for p in existing_chat.participants]
+                "id": chat.id,
+                "name": chat.name,
+                "is_private": chat.is_group == False,
+                "created_at": chat.created_at.isoformat(),
+                "participants": [{"id": p.id, "username": p.username} for p in chat.participants]
             }
             await manager.notify_user_chats_update(current_user.id, chat_data)
             await manager.notify_user_chats_update(user_id, chat_data)
-            return existing_chat
-        chat = models.Chat(
-            name=f"Direct Message with {target_user.username}",
-            is_group=False
-        )
-        chat.participants = [current_user, target_user]
-        db.add(chat)
-        db.commit()
-        db.refresh(chat)
-        chat_data = {
-            "id": chat.id,
-            "name": chat.name,
-            "is_private": chat.is_group == False,
-            "created_at": chat.created_at.isoformat(),
-            "participants": [{"id": p.id, "username": p.username} for p in chat.participants]
-        }
-        await manager.notify_user_chats_update(current_user.id, chat_data)
-        await manager.notify_user_chats_update(user_id, chat_data)
-        return chat
+            return chat
+        raise HTTPException(status_code=409, detail="The direct chat was changed concurrently; try again")
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e)) 
-    
-
-
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import re
+from typing import Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from ..database import get_db
+from ..models import models
+from ..auth import auth
+from ..auth.membership import require_participant
+from ..storage.storage import LocalStorage, content_disposition, content_key, served_type, storage
+from ..storage.media import file_url, thumbnail_key, thumbnail_url
+from ..storage.signing import signature_valid
+
+load_dotenv()
+
+router = APIRouter(prefix="/chats/{chat_id}/files", tags=["files"])
+
+# When set (e.g. "/_protected_uploads/"), nginx streams the blob from its own
+# internal location; see frontend/nginx.conf
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX")
+
+# The URL names the content, so a cached copy never goes stale
+IMMUTABLE = "private, max-age=31536000, immutable"
+STREAM_CHUNK_SIZE = 256 * 1024
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Return the inclusive (start, end) of a single byte range.
+
+    None means the header is ignored and the whole file is sent, which RFC 9110
+    allows for multiple ranges. An unsatisfiable range raises 416.
+    """
+    match = RANGE_HEADER.match(header.replace(" ", ""))
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # "bytes=-N" is the final N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+async def read_file(path: str, start: int, length: int):
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, start)
+        while length > 0:
+            chunk = await asyncio.to_thread(f.read, min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def authorize(
+    db: AsyncSession, path: str, expires: Optional[int], signature: Optional[str], token: Optional[str]
+) -> Optional[int]:
+    """The user downloading with a bearer token, or None for a valid signed URL.
+
+    Media tags use the signed URLs handed out with each message; they were
+    only given to members of the chat, so they need no membership check.
+    """
+    if expires is not None and signature is not None:
+        if not signature_valid(path, expires, signature):
+            raise HTTPException(status_code=403, detail="Download link is invalid or has expired")
+        return None
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    principal = await auth.get_current_active_user(await auth.authenticate_token(token, db))
+    return principal.id
+
+
+async def find_attachment(db: AsyncSession, user_id: Optional[int], chat_id: int, file_hash: str):
+    if not SHA256_HEX.match(file_hash):
+        raise HTTPException(status_code=404, detail="File not found")
+    if user_id is not None:
+        await require_participant(db, user_id, chat_id, "Not authorized to access this chat's files")
+    attachment = (await db.execute(
+        select(models.Message.filename, models.Message.filetype).where(
+            (models.Message.chat_id == chat_id) & (models.Message.file_hash == file_hash)
+        ).limit(1)
+    )).first()
+    if attachment is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return attachment
+
+
+async def serve_blob(request: Request, key: str, etag: str, filename: str, media_type: str) -> Response:
+    """Answer a download of an immutable blob with 304, a redirect, nginx, or a (ranged) stream"""
+    media_type = served_type(media_type)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE,
+        "Content-Disposition": content_disposition(filename, media_type),
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+        # Even if a browser renders it, an uploaded file gets no script and no origin
+        "Content-Security-Policy": "sandbox",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE})
+
+    redirect = storage.download_url(key, filename, media_type)
+    if redirect is not None:
+        return RedirectResponse(redirect, status_code=307, headers={"Cache-Control": "private, no-store"})
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=500, detail="Storage backend cannot serve files")
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        # nginx serves the bytes with sendfile and answers Range requests itself
+        headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + key
+        return Response(media_type=media_type, headers=headers)
+
+    path = storage.path(key)
+    try:
+        size = (await asyncio.to_thread(os.stat, path)).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(read_file(path, 0, size), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_file(path, start, end - start + 1), status_code=206,
+                             media_type=media_type, headers=headers)
+
+
+@router.get("/{file_hash}")
+async def download_file(
+    chat_id: int,
+    file_hash: str,
+    request: Request,
+    expires: Optional[int] = None,
+    signature: Optional[str] = None,
+    token: Optional[str] = Depends(auth.optional_oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+):
+    user_id = await authorize(db, file_url(chat_id, file_hash), expires, signature, token)
+    attachment = await find_attachment(db, user_id, chat_id, file_hash)
+    return await serve_blob(
+        request,
+        content_key(file_hash),
+        f'"{file_hash}"',
+        attachment.filename or "file",
+        attachment.filetype or "application/octet-stream",
+    )
+
+
+@router.get("/{file_hash}/thumbnail")
+async def download_thumbnail(
+    chat_id: int,
+    file_hash: str,
+    request: Request,
+    expires: Optional[int] = None,
+    signature: Optional[str] = None,
+    token: Optional[str] = Depends(auth.optional_oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+):
+    user_id = await authorize(db, thumbnail_url(chat_id, file_hash), expires, signature, token)
+    attachment = await find_attachment(db, user_id, chat_id, file_hash)
+    name, _ = os.path.splitext(attachment.filename or "file")
+    return await serve_blob(request, thumbnail_key(file_hash), f'"{file_hash}-thumb"', f"{name}.jpg", "image/jpeg")
@@ -1,119 +1,110 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy import select
+from typing import Optional
 from ..database import get_db
+from ..replicas import get_read_db
 from ..models import models
 from ..schemas import schemas
 from ..auth import auth
+from ..auth.membership import require_participant
 from ..websockets.manager import manager
+from ..websockets.ingest import save_message
+from ..websockets.replay import message_event
+from ..storage.storage import MAX_UPLOAD_SIZE, UploadLimitRoute, save_upload, storage
+from ..storage.media import file_url as attachment_url, media
+from ..storage.signing import sign_url
+from ..storage.archive import message_archive
 from fastapi import UploadFile, File
 import os
 
-router = APIRouter(prefix="/chats/{chat_id}/messages", tags=["messages"])
+# Oversized uploads are refused before their body is read
+router = APIRouter(prefix="/chats/{chat_id}/messages", tags=["messages"], route_class=UploadLimitRoute)
 
 @router.post("/", response_model=schemas.Message)
 async def create_message(
     chat_id: int,
     message: schemas.MessageCreate,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    participant = db.query(models.ChatParticipant).filter(
-        models.ChatParticipant.chat_id == chat_id,
-        models.ChatParticipant.user_id == current_user.id
-    ).first()
-    if not participant:
-        raise HTTPException(status_code=403, detail="Not authorized to send messages to this chat")
-    db_message = models.Message(
-        content=message.content,
-        chat_id=chat_id,
-        user_id=current_user.id
-    )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    message_data = {
-        "id": db_message.id,
-        "content": db_message.content,
-        "created_at": db_message.timestamp.isoformat(),
-        "user": {
-            "id": current_user.id,
-            "username": current_user.username
-        }
-    }
-    await manager.broadcast_to_chat(chat_id, message_data)
+    await require_participant(db, current_user.id, chat_id, "Not authorized to send messages to this chat")
+    sender = await db.get(models.User, current_user.id)
+    db_message = await save_message(db, content=message.content, chat_id=chat_id, sender_id=sender.id)
+    db_message.sender = sender
+    await manager.broadcast_to_chat(chat_id, message_event(db_message, sender.username), seq=db_message.seq)
     return db_message
 
 @router.post("/upload")
-async def upload_file(chat_id: int, file: UploadFile = File(...), current_user: models.User = Depends(auth.get_current_active_user), db: Session = Depends(get_db)):
-    print(file.filename)
-    print(file.content_type)
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    if current_user not in chat.participants:
-        raise HTTPException(status_code=403, detail="Not authorized to upload files to this chat")
-    
-    # Save file to uploads directory
-    uploads_dir = os.path.join(os.path.dirname(__file__), "uploads")
-    os.makedirs(uploads_dir, exist_ok=True)
-    file_path = os.path.join(uploads_dir, file.filename)
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
-    # File URL for frontend (assuming /static/uploads/ is served)
-    file_url = f"/static/uploads/{file.filename}"
-    db_message = models.Message(
-        content=file.filename,
+async def upload_file(chat_id: int, file: UploadFile = File(...), current_user: auth.Principal = Depends(auth.get_current_active_user), db: AsyncSession = Depends(get_db)):
+    await require_participant(db, current_user.id, chat_id, "Not authorized to upload files to this chat")
+
+    # Streamed to storage under its content hash; identical files share one blob
+    stored = await save_upload(file, storage, MAX_UPLOAD_SIZE)
+    # Served by routers/files.py, to members or holders of a signed URL
+    file_url = attachment_url(chat_id, stored.sha256)
+    # The client's name is only shown, never used as a path
+    filename = os.path.basename(file.filename or "") or "file"
+    values = dict(
+        content=filename,
         chat_id=chat_id,
         sender_id=current_user.id,
         file_url=file_url,
         filetype=file.content_type,
-        filename=file.filename
+        filename=filename,
+        file_hash=stored.sha256,
+        file_size=stored.size
     )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    message_data = {
-        "id": db_message.id,
-        "content": db_message.content,
-        "file_url": file_url,
-        "filetype": file.content_type,
-        "filename": file.filename,
-        "created_at": db_message.timestamp.isoformat(),
-        "sender_id": current_user.id,
-        "chat_id": chat_id,
-        "sender": {"id": current_user.id, "username": current_user.username if current_user else "Unknown"}
-    }
-    await manager.broadcast_to_chat(chat_id, {
-        "type": "message",
-        "message": message_data
-    })
-    
+    db_message = await save_message(db, **values)
+    # Thumbnail and placeholder follow in a message_updated event
+    media.submit(db_message.id, chat_id, stored.sha256, file.content_type)
+    await manager.broadcast_to_chat(chat_id, message_event(db_message, current_user.username), seq=db_message.seq)
+
     return {
         "id": db_message.id,
         "content": db_message.content,
-        "file_url": file_url,
+        "file_url": sign_url(file_url),
         "filetype": file.content_type,
-        "filename": file.filename,
+        "filename": filename,
+        "file_size": stored.size,
         "created_at": db_message.timestamp.isoformat(),
         "sender_id": current_user.id,
-        "chat_id": chat_id
+        "chat_id": chat_id,
+        "seq": db_message.seq
     }
 
-@router.get("/", response_model=List[schemas.Message])
-def get_chat_messages(
+@router.get("/", response_model=schemas.MessagePage)
+async def get_chat_messages(
     chat_id: int,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    if current_user not in chat.participants:
-        raise HTTPException(status_code=403, detail="Not authorized to access this chat's messages")
-    return chat.messages 
-
-
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    await require_participant(db, current_user.id, chat_id, "Not authorized to access this chat's messages")
+    query = select(models.Message).options(
+        joinedload(models.Message.sender)
+    ).where(models.Message.chat_id == chat_id)
+    if after_id is not None:
+        query = query.where(models.Message.id > after_id).order_by(models.Message.id.asc())
+    else:
+        # Without a cursor the newest page is returned
+        if before_id is not None:
+            query = query.where(models.Message.id < before_id)
+        query = query.order_by(models.Message.id.desc())
+    # One extra row tells us whether another page exists
+    messages = (await db.scalars(query.limit(limit + 1))).all()
+    # Cold history lives in archive files once its id range is archived
+    messages = await message_archive.with_archived(db, chat_id, messages, before_id, after_id, limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after_id is None:
+        messages.reverse()
+    next_cursor = None
+    if has_more:
+        next_cursor = messages[-1].id if after_id is not None else messages[0].id
+    return {"messages": messages, "next_cursor": next_cursor}
@@ -0,0 +1,73 @@
+import hmac
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from dotenv import load_dotenv
+from ..auth import auth
+from ..auth.membership import membership
+from ..monitoring.metrics import Registry, registry
+from ..replicas import replicas
+from ..storage.archive import message_archive
+from ..websockets.ingest import ingest
+from ..websockets.manager import manager
+from ..websockets.presence import presence
+import os
+
+load_dotenv()
+
+# Scrapers must send "Authorization: Bearer <token>" when set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+router = APIRouter(tags=["metrics"])
+
+# Read from the state the components already keep, only when scraped
+registry.gauge("ws_connections", "Open WebSocket connections", lambda: len(manager.connections()))
+registry.gauge("ws_users", "Users with at least one open WebSocket", lambda: len(manager.active_connections))
+registry.gauge("ws_rooms", "Chats with at least one joined WebSocket", lambda: len(manager.chat_rooms))
+registry.gauge("ws_send_queue_frames", "Frames waiting in WebSocket send queues",
+               lambda: sum(c.depth for c in manager.connections()))
+registry.gauge("ws_send_queue_max_depth", "Deepest WebSocket send queue",
+               lambda: max((c.depth for c in manager.connections()), default=0))
+registry.callback_counter("ws_dropped_frames_total", "Frames dropped from full send queues",
+                          lambda: manager.dropped_frames)
+registry.callback_counter("ws_slow_consumer_disconnects_total", "Sockets closed for not keeping up",
+                          lambda: manager.slow_consumer_disconnects)
+registry.callback_counter("ws_replay_total", "Resumes answered from the replay buffer or not",
+                          lambda: {("hit",): manager.replay.hits, ("miss",): manager.replay.misses}, ["result"])
+registry.gauge("presence_online_users", "Users announced online by this worker", lambda: presence.announced)
+registry.callback_counter("presence_evicted_nodes_total", "Workers whose users were taken offline for missed heartbeats",
+                          lambda: presence.evicted_nodes)
+registry.gauge("ingest_pending_messages", "Write-behind messages not yet in the database", lambda: ingest.pending)
+registry.callback_counter("ingest_dropped_messages_total", "Write-behind messages the database rejected",
+                          lambda: ingest.dropped_rows)
+registry.callback_counter("membership_cache_total", "Membership checks answered from memory or not",
+                          lambda: {("hit",): membership.hits, ("miss",): membership.misses}, ["result"])
+registry.callback_counter("principal_cache_total", "Token checks answered from memory or not",
+                          lambda: {("hit",): auth.principal_cache.hits, ("miss",): auth.principal_cache.misses},
+                          ["result"])
+
+registry.callback_counter("messages_archived_total", "Messages moved to archive files",
+                          lambda: message_archive.archived_rows)
+registry.callback_counter("messages_purged_total", "Messages of deleted chats removed",
+                          lambda: message_archive.purged_rows)
+
+registry.gauge("db_replica_up", "Whether a read replica passed its last check",
+               lambda: {(r.name,): int(r.healthy) for r in replicas.replicas}, ["replica"])
+registry.gauge("db_replica_lag_seconds", "Replication lag seen by the last check",
+               lambda: {(r.name,): r.lag for r in replicas.replicas if r.lag is not None}, ["replica"])
+registry.callback_counter("db_read_sessions_total", "Read-only sessions by where they were served",
+                          lambda: {("replica",): replicas.replica_reads, ("primary",): replicas.primary_reads},
+                          ["target"])
+registry.callback_counter("db_replica_fallbacks_total", "Reads sent to the primary because a replica was unreachable",
+                          lambda: replicas.fallbacks)
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(None)):
+    """Metrics of this worker in the Prometheus text format"""
+    if METRICS_TOKEN:
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token, METRICS_TOKEN):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    # Set as a header: given as media_type, Starlette appends a second charset
+    return PlainTextResponse(registry.render(), headers={"Content-Type": Registry.CONTENT_TYPE})
@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy import select
+from typing import Optional
+from ..replicas import get_read_db
+from ..models import models
+from ..schemas import schemas
+from ..auth import auth
+from ..auth.membership import require_participant
+from ..search.search import search_index
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+@router.get("/messages", response_model=schemas.MessagePage)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    chat_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Messages containing every word of ``q`` in the caller's chats, newest first"""
+    if chat_id is not None:
+        await require_participant(db, current_user.id, chat_id, "Not authorized to access this chat's messages")
+    condition = search_index.message_filter(q)
+    if condition is None:
+        return {"messages": [], "next_cursor": None}
+    query = select(models.Message).options(
+        joinedload(models.Message.sender)
+    ).join(
+        models.user_chat,
+        (models.user_chat.c.chat_id == models.Message.chat_id) &
+        (models.user_chat.c.user_id == current_user.id)
+    ).where(condition)
+    if chat_id is not None:
+        query = query.where(models.Message.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(models.Message.id < before_id)
+    messages = (await db.scalars(query.order_by(models.Message.id.desc()).limit(limit + 1))).all()
+    next_cursor = messages[limit - 1].id if len(messages) > limit else None
+    return {"messages": messages[:limit], "next_cursor": next_cursor}
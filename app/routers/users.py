@@ -1,54 +1,55 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from pydantic import BaseModel, EmailStr
 from ..database import get_db
+from ..replicas import get_read_db
 from ..models import models
 from ..schemas import schemas
 from ..auth import auth
+from ..search.search import search_index
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 @router.post("/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await db.scalar(select(models.User).where(models.User.email == user.email))
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.password_hasher.hash(user.password)
     db_user = models.User(
         email=user.email,
         username=user.username,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     return db_user
 
 @router.get("/me/", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(auth.get_current_active_user)):
-    return current_user
+async def read_users_me(current_user: auth.Principal = Depends(auth.get_current_active_user), db: AsyncSession = Depends(get_read_db)):
+    return await db.get(models.User, current_user.id)
 
 @router.get("/search/", response_model=List[schemas.User])
-def search_users(
-    query: str,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+async def search_users(
+    query: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=50),
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    users = db.query(models.User).filter(
-        (models.User.username.ilike(f"%{query}%")) |
-        (models.User.email.ilike(f"%{query}%"))
-    ).all()
-    return users
+    # Prefix (and trigram) indexes instead of a scan on every keystroke
+    users = await db.scalars(search_index.user_search(query, limit))
+    return users.all()
 
 @router.get("/{user_id}", response_model=schemas.User)
-def get_user(
+async def get_user(
     user_id: int,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
@@ -62,17 +63,19 @@ class UserUpdate(BaseModel):
 @router.put("/me", response_model=schemas.User)
 async def update_user(
     user_update: UserUpdate,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: auth.Principal = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(get_db)
 ):
+    user = await db.get(models.User, current_user.id)
     if user_update.username:
-        current_user.username = user_update.username
+        user.username = user_update.username
     if user_update.email:
-        current_user.email = user_update.email
+        user.email = user_update.email
     if user_update.new_password:
-        if not user_update.current_password or not auth.verify_password(user_update.current_password, current_user.hashed_password):
+        if not user_update.current_password or not await auth.password_hasher.verify(user_update.current_password, user.hashed_password):
             raise HTTPException(status_code=400, detail="Current password is incorrect")
-        current_user.hashed_password = auth.get_password_hash(user_update.new_password)
-    db.commit()
-    db.refresh(current_user)
-    return current_user 
\ No newline at end of file
+        user.hashed_password = await auth.password_hasher.hash(user_update.new_password)
+    await db.commit()
+    if user_update.username or user_update.new_password:
+        await auth.invalidate_principal(user.id)
+    return user
\ No newline at end of file
@@ -1,63 +1,264 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from ..database import get_db
+from typing import Dict, List, Optional
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from ..database import SessionLocal
 from ..websockets.manager import manager
+from ..websockets.connection import Connection
+from ..websockets.ingest import ingest, save_message
+from ..websockets.read_cursors import read_cursors
+from ..websockets.presence import presence
+from ..websockets.frames import encode_frame
+from ..websockets.replay import ReplayBuffer, message_event
+from ..auth import auth
+from ..auth.membership import membership
+from ..auth.cache import MISSING, TTLCache
 from ..models import models
+from ..monitoring.metrics import COUNT_BUCKETS, registry
+from ..monitoring.tracing import span, traced
+from ..replicas import replicas
+from dotenv import load_dotenv
 import json
+import logging
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-@router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int, db: Session = Depends(get_db)):
-    await manager.connect(websocket, user_id)
+# Frame types the client may send; anything else is labelled "other"
+FRAME_TYPES = {"ping", "typing", "join_chat", "read", "resume", "message"}
+
+ws_frame_duration = registry.histogram(
+    "ws_frame_duration_seconds", "Time to handle one client WebSocket frame", ["type"]
+)
+ws_frame_db_queries = registry.histogram(
+    "ws_frame_db_queries", "SQL statements executed per client WebSocket frame", ["type"], COUNT_BUCKETS
+)
+
+# Most messages a resuming client is sent per chat before it is told to reload
+REPLAY_MAX_MESSAGES = int(os.getenv("WS_REPLAY_MAX_MESSAGES", "500"))
+
+# (user_id, client_id) -> ack of a message already saved, so a client that
+# resends after a reconnect does not post it twice. Per worker, best effort.
+recent_sends = TTLCache(max_entries=100_000, ttl=300.0)
+
+
+def is_id(value) -> bool:
+    """Whether a client sent a usable row id: a positive int, not a bool or string"""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def is_seq(value) -> bool:
+    """Whether a client sent a usable sequence number: a non-negative int"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def ack_frame(client_id, message: models.Message) -> str:
+    return encode_frame({
+        "type": "ack", "client_id": client_id, "chat_id": message.chat_id,
+        "id": message.id, "seq": message.seq,
+    })
+
+
+async def authenticate(websocket: WebSocket, token: Optional[str]) -> Optional[auth.Principal]:
+    """The user behind the handshake's access token, from ?token= or an Authorization header"""
+    if not token:
+        scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+        token = credentials if scheme.lower() == "bearer" else None
+    if not token:
+        return None
+    async with SessionLocal() as db:
+        try:
+            principal = await auth.authenticate_token(token, db)
+        except HTTPException:
+            return None
+    return principal if principal.is_active else None
+
+
+async def load_chat_ids(user_id: int) -> List[int]:
+    epoch = membership.epoch
+    async with SessionLocal() as db:
+        chat_ids = (await db.scalars(
+            select(models.user_chat.c.chat_id).where(models.user_chat.c.user_id == user_id)
+        )).all()
+    # The socket's later checks for these chats are answered from memory
+    membership.remember(user_id, chat_ids, epoch)
+    return chat_ids
+
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = Query(None)):
+    principal = await authenticate(websocket, token)
+    if principal is None:
+        # Rejected before accept, so the client sees the handshake fail with 403
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_id = principal.id
+    chat_ids = await load_chat_ids(user_id)
+    connection = await manager.connect(websocket, user_id, chat_ids)
     try:
         while True:
             data = await websocket.receive_text()
-            try:
-                msg = json.loads(data)
-                if msg.get("type") == "join_chat":
-                    chat_id = msg.get("chat_id")
-                    if chat_id:
-                        await manager.join_chat(user_id, chat_id)
-                elif msg.get("type") == "message":
-                    chat_id = msg.get("chat_id")
-                    content = msg.get("content")
-                    if chat_id and content:
-                        # Check if user is a participant in the chat
-                        is_participant = db.execute(
-                            select(models.user_chat).where(
-                                (models.user_chat.c.user_id == user_id) &
-                                (models.user_chat.c.chat_id == chat_id)
-                            )
-                        ).first()
-                        if not is_participant:
-                            await websocket.send_text(json.dumps({"type": "error", "message": "Not authorized to send messages to this chat"}))
-                            continue
-                        # Save message to DB
-                        db_message = models.Message(
-                            content=content,
-                            chat_id=chat_id,
-                            sender_id=user_id
-                        )
-                        db.add(db_message)
-                        db.commit()
-                        db.refresh(db_message)
-                        # Fetch sender username
-                        sender = db.query(models.User).filter(models.User.id == user_id).first()
-                        message_data = {
-                            "id": db_message.id,
-                            "content": db_message.content,
-                            "created_at": db_message.timestamp.isoformat(),
-                            "sender_id": user_id,
-                            "chat_id": chat_id,
-                            "sender": {"username": sender.username if sender else "Unknown"}
-                        }
-                        await manager.broadcast_to_chat(chat_id, {
-                            "type": "message",
-                            "message": message_data
-                        })
-            except Exception as e:
-                print("WebSocket message handling error:", e)
+            frame_type = "other"
+            with traced("ws") as trace:
+                try:
+                    msg = json.loads(data)
+                    if msg.get("type") in FRAME_TYPES:
+                        frame_type = msg["type"]
+                    # A session per frame: idle sockets hold no pooled connection, and
+                    # frames answered from caches never check one out at all
+                    async with SessionLocal() as db:
+                        await handle_frame(db, connection, principal, msg)
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring a malformed WebSocket frame from user %d", user_id)
+                except Exception:
+                    logger.exception("Handling a WebSocket frame of user %d failed", user_id)
+                trace.name = f"ws {frame_type}"
+                ws_frame_duration.observe(trace.elapsed(), frame_type)
+                ws_frame_db_queries.observe(trace.db_queries, frame_type)
+                trace.finish()
     except WebSocketDisconnect:
-        manager.disconnect(user_id) 
\ No newline at end of file
+        pass
+    finally:
+        await manager.disconnect(connection)
+
+
+async def archived_since(db: AsyncSession, chat_id: int, last_seq: int, buffered: Dict[int, str]) -> bool:
+    """Whether archived messages of a chat may have seqs above ``last_seq``.
+
+    Archiving takes the oldest id ranges, so archived messages have the
+    lowest seqs of their chat: a client is behind the archive when its seq
+    is below the oldest one still live (or buffered, or about to be given).
+    """
+    blocks = select(models.ArchivedBlock.chat_id).where(models.ArchivedBlock.chat_id == chat_id).limit(1)
+    if await db.scalar(blocks) is None:
+        return False
+    oldest = await db.scalar(select(func.min(models.Message.seq)).where(models.Message.chat_id == chat_id))
+    if oldest is None:
+        oldest = min(buffered, default=None)
+    if oldest is None:
+        oldest = (await db.scalar(select(models.Chat.last_seq).where(models.Chat.id == chat_id)) or 0) + 1
+    return last_seq < oldest - 1
+
+
+async def replay_since(
+    db: AsyncSession, buffer: ReplayBuffer, chat_id: int, last_seq: int, limit: int
+) -> Optional[List[str]]:
+    """Frames a client with ``last_seq`` missed in a chat, oldest first.
+
+    Served from the buffer when it covers the gap, otherwise from the
+    database merged with the buffer (which holds messages still waiting for
+    the write-behind flush). None when more than ``limit`` messages were
+    missed, or when some of them are archived and only history can return
+    them; the client should reload the history instead.
+    """
+    frames = buffer.since(chat_id, last_seq)
+    if frames is not None:
+        return frames if len(frames) <= limit else None
+    rows = (await db.scalars(
+        select(models.Message)
+        .options(joinedload(models.Message.sender))
+        .where((models.Message.chat_id == chat_id) & (models.Message.seq > last_seq))
+        .order_by(models.Message.seq)
+        .limit(limit + 1)
+    )).all()
+    if len(rows) > limit:
+        return None
+    missed = buffer.recent(chat_id, last_seq)
+    if (not rows or rows[0].seq != last_seq + 1) and await archived_since(db, chat_id, last_seq, missed):
+        return None
+    for message in rows:
+        if message.seq not in missed:
+            missed[message.seq] = encode_frame(message_event(message, message.sender.username))
+    if len(missed) > limit:
+        return None
+    return [missed[seq] for seq in sorted(missed)]
+
+
+async def handle_frame(db: AsyncSession, connection: Connection, principal: auth.Principal, msg: dict):
+    user_id = principal.id
+    if msg.get("type") == "ping":
+        presence.heartbeat(user_id)
+        connection.send(encode_frame({"type": "pong"}))
+    elif msg.get("type") == "typing":
+        chat_id = msg.get("chat_id")
+        # Relayed, never stored; repeats inside the rate limit are dropped. Members
+        # only reach the limiter, so others cannot use up its slots or its memory.
+        if is_id(chat_id) and await membership.is_participant(db, user_id, chat_id) and \
+                presence.typing(user_id, chat_id):
+            await manager.broadcast_to_chat(chat_id, {
+                "type": "typing", "chat_id": chat_id, "user_id": user_id
+            })
+    elif msg.get("type") == "join_chat":
+        # Chats are joined at connect and on membership changes; this re-joins one
+        chat_id = msg.get("chat_id")
+        if is_id(chat_id) and await membership.is_participant(db, user_id, chat_id):
+            await manager.join_chat(user_id, chat_id, connection)
+    elif msg.get("type") == "read":
+        chat_id = msg.get("chat_id")
+        message_id = msg.get("message_id")
+        if is_id(chat_id) and is_id(message_id) and await membership.is_participant(db, user_id, chat_id):
+            # A cursor past the newest message would hide the next ones from the unread counts
+            newest = await db.scalar(select(models.Chat.last_message_id).where(models.Chat.id == chat_id))
+            message_id = min(message_id, max(newest or 0, ingest.newest_pending(chat_id)))
+            # Persisted in the next batch; the user's other devices hear about it now
+            if message_id and read_cursors.advance(user_id, chat_id, message_id):
+                # Unread counts come from the primary until the cursor has replicated
+                replicas.wrote(user_id)
+                await manager.send_personal_message(
+                    {"type": "read", "chat_id": chat_id, "message_id": message_id}, user_id
+                )
+    elif msg.get("type") == "resume":
+        # {"chats": {chat_id: last seq seen}}: send only what was missed
+        chats = msg.get("chats")
+        if not isinstance(chats, dict):
+            return
+        for key, last_seq in chats.items():
+            # JSON object keys are strings; anything but a plain positive number is not a chat
+            chat_id = int(key) if isinstance(key, str) and key.isdigit() and key.isascii() else None
+            if not is_id(chat_id):
+                connection.send(encode_frame({"type": "resync", "chat_id": key}))
+                continue
+            if not await membership.is_participant(db, user_id, chat_id):
+                continue
+            # Joined first: a message racing the replay is sent twice, never lost
+            await manager.join_chat(user_id, chat_id, connection)
+            if not is_seq(last_seq):
+                connection.send(encode_frame({"type": "resync", "chat_id": chat_id}))
+                continue
+            with span("replay"):
+                frames = await replay_since(db, manager.replay, chat_id, last_seq, REPLAY_MAX_MESSAGES)
+            if frames is None:
+                connection.send(encode_frame({"type": "resync", "chat_id": chat_id}))
+                continue
+            for frame in frames:
+                connection.send(frame)
+            connection.send(encode_frame({"type": "resumed", "chat_id": chat_id, "replayed": len(frames)}))
+    elif msg.get("type") == "message":
+        chat_id = msg.get("chat_id")
+        content = msg.get("content")
+        client_id = msg.get("client_id")
+        if client_id is not None:
+            acked = recent_sends.get((user_id, client_id))
+            if acked is not MISSING:
+                connection.send(acked)
+                return
+        # Checked before the database sees them: a string id would be stored, then fail the broadcast
+        if not is_id(chat_id) or not isinstance(content, str) or not content:
+            return
+        if not await membership.is_participant(db, user_id, chat_id):
+            connection.send(encode_frame({"type": "error", "message": "Not authorized to send messages to this chat"}))
+            return
+        # Save message to DB (or to the write-behind batch)
+        with span("save_message"):
+            db_message = await save_message(db, content=content, chat_id=chat_id, sender_id=user_id)
+        if client_id is not None:
+            # The sender learns the id and seq even if the broadcast is lost
+            acked = ack_frame(client_id, db_message)
+            recent_sends.put((user_id, client_id), acked)
+            connection.send(acked)
+        await manager.broadcast_to_chat(chat_id, message_event(db_message, principal.username), seq=db_message.seq)
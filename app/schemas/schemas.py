@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, field_serializer
 from typing import List, Optional
 from datetime import datetime
+from ..storage.signing import sign_url
 
 class UserBase(BaseModel):
     username: str
@@ -37,6 +38,16 @@ class MessageBase(BaseModel):
     file_url: Optional[str] = None
     filetype: Optional[str] = None
     filename: Optional[str] = None
+    file_size: Optional[int] = None
+    thumbnail_url: Optional[str] = None
+    blurhash: Optional[str] = None
+    media_width: Optional[int] = None
+    media_height: Optional[int] = None
+
+    # Media tags fetch these without the Authorization header
+    @field_serializer("file_url", "thumbnail_url")
+    def signed(self, url: Optional[str]) -> Optional[str]:
+        return sign_url(url)
 
 class MessageCreate(MessageBase):
     chat_id: int
@@ -47,11 +58,22 @@ class Message(MessageBase):
     sender_id: int
     chat_id: int
     is_read: bool
+    seq: Optional[int] = None
     sender: User
 
     class Config:
         from_attributes = True
 
+class ChatSummary(Chat):
+    last_message: Optional[Message] = None
+    last_read_message_id: int = 0
+    unread_count: int = 0
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    # Pass as before_id (or after_id when paging forward) to fetch the next page
+    next_cursor: Optional[int] = None
+
 class Token(BaseModel):
     access_token: str
     token_type: str
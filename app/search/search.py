@@ -0,0 +1,106 @@
+import logging
+import re
+from typing import List, Optional
+from sqlalchemy import and_, case, func, literal_column, or_, select, table, text
+from sqlalchemy.engine import Connection
+from ..models import models
+
+logger = logging.getLogger(__name__)
+
+# Words of a query; the rest (quotes, operators) is dropped so input can never
+# change the meaning of the MATCH / tsquery syntax it is spliced into
+WORD = re.compile(r"\w+")
+MAX_TERMS = 8
+
+# 'simple' does no stemming, which suits a chat in many languages
+TSVECTOR = "to_tsvector('simple', coalesce(content, ''))"
+
+
+def terms(query: str) -> List[str]:
+    return WORD.findall(query.lower())[:MAX_TERMS]
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SearchIndex:
+    """Full-text message search and prefix/trigram user search per dialect.
+
+    The indexes are created by the migrations; ``detect`` finds out at
+    startup which of them exist. They are maintained by the database as rows
+    are written: an expression GIN index on PostgreSQL and an FTS5 table kept
+    in sync by triggers on SQLite. Where neither is available searches fall
+    back to LIKE, which is correct but scans.
+    """
+
+    def __init__(self):
+        self.dialect: Optional[str] = None
+        self.messages: Optional[str] = None  # "tsvector", "fts5" or None
+        self.trigram = False
+
+    def detect(self, conn: Connection):
+        dialect = self.dialect = conn.dialect.name
+        if dialect == "postgresql":
+            names = set(conn.scalars(text(
+                "SELECT indexname FROM pg_indexes WHERE indexname IN "
+                "('ix_messages_content_tsv', 'ix_users_username_trgm')"
+            )))
+            if "ix_messages_content_tsv" in names:
+                self.messages = "tsvector"
+            self.trigram = "ix_users_username_trgm" in names
+        elif dialect == "sqlite":
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).first():
+                self.messages = "fts5"
+        if self.messages is None:
+            logger.warning("No full-text index for messages on %s; search will scan", dialect)
+
+    def message_filter(self, query: str):
+        """WHERE clause matching messages that contain every word, the last one as a prefix"""
+        words = terms(query)
+        if not words:
+            return None
+        if self.messages == "tsvector":
+            tsquery = " & ".join(f"{word}:*" for word in words)
+            return text(f"{TSVECTOR} @@ to_tsquery('simple', :tsquery)").bindparams(tsquery=tsquery)
+        if self.messages == "fts5":
+            match = " ".join(f'"{word}"*' for word in words)
+            matching = (
+                select(literal_column("rowid"))
+                .select_from(table("messages_fts"))
+                .where(text("messages_fts MATCH :match").bindparams(match=match))
+            )
+            return models.Message.id.in_(matching)
+        return func.lower(models.Message.content).like(
+            "%" + "%".join(escape_like(word) for word in words) + "%", escape="\\"
+        )
+
+    def user_search(self, query: str, limit: int):
+        """Users whose username (or email) starts with the query, best matches first.
+
+        With pg_trgm, usernames containing a query of three or more characters
+        anywhere match too, ranked by similarity after the prefix matches.
+        """
+        q = query.strip().lower()
+        username = func.lower(models.User.username)
+        email = func.lower(models.User.email)
+        prefix = escape_like(q) + "%"
+        conditions = [self._starts_with(username, q), self._starts_with(email, q)]
+        ranking = [
+            case((username == q, 0), else_=1),
+            case((username.like(prefix, escape="\\"), 0), else_=1),
+        ]
+        if self.trigram and len(q) >= 3:
+            conditions.append(username.like("%" + escape_like(q) + "%", escape="\\"))
+            ranking.append(func.similarity(username, q).desc())
+        ranking += [func.length(models.User.username), models.User.username]
+        return select(models.User).where(or_(*conditions)).order_by(*ranking).limit(limit)
+
+    def _starts_with(self, expression, prefix: str):
+        if self.dialect == "sqlite":
+            # SQLite only uses an expression index for comparisons, not LIKE
+            return and_(expression >= prefix, expression < prefix + "\U0010ffff")
+        return expression.like(escape_like(prefix) + "%", escape="\\")
+
+
+search_index = SearchIndex()
@@ -0,0 +1,400 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import and_, delete, func, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from ..auth.cache import MISSING, TTLCache
+from ..database import SessionLocal
+from ..models import models
+from .storage import Storage, create_storage, storage
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+messages = models.Message.__table__
+partitions = models.MessagePartition.__table__
+blocks = models.ArchivedBlock.__table__
+
+# Deleted chats are purged only after this long, so write-behind rows still in flight land first
+PURGE_DELAY = timedelta(minutes=1)
+# A claim on a range older than this belongs to a worker that died while archiving it
+CLAIM_TIMEOUT = timedelta(hours=1)
+
+
+def partition_table(low_id: int) -> str:
+    return f"messages_{int(low_id)}"
+
+
+def archive_key(low_id: int, high_id: int) -> str:
+    return f"archive/messages-{low_id}-{high_id}.jsonl.gz"
+
+
+def encode_row(row) -> bytes:
+    return json.dumps(
+        {name: value.isoformat() if isinstance(value, datetime) else value for name, value in row.items()},
+        separators=(",", ":"),
+    ).encode()
+
+
+def decode_message(data: dict) -> models.Message:
+    values = dict(data)
+    if values.get("timestamp"):
+        values["timestamp"] = datetime.fromisoformat(values["timestamp"])
+    return models.Message(**values)
+
+
+class MessageArchive:
+    """Id-range partitions of ``messages``, archival of cold ones and purging of deleted chats.
+
+    On PostgreSQL ``messages`` is declared ``PARTITION BY RANGE (id)`` and each
+    range is a table of its own; elsewhere, or for a table created before
+    partitioning, ranges are only rows in ``message_partitions``. Ids grow
+    with time, so a range is a stretch of history, and the keyset queries of
+    the history API (by chat and id) touch only the ranges they need. A
+    background task keeps ``partitions_ahead`` empty ranges ready above the
+    newest message.
+
+    With ``archive_after`` set, the oldest range whose newest message is
+    older than that is written to an append-only file in storage: one gzip
+    member per block of up to ``block_rows`` messages of a chat, indexed by
+    ``archived_message_blocks``. The transaction recording the blocks drops
+    the range (DETACH and DROP of the partition, or a DELETE by primary key
+    range elsewhere), so vacuum and index maintenance never see those rows
+    again. ``with_archived`` completes history pages from ranged reads of the
+    files. Archived messages are no longer found by search.
+
+    Deleting a chat only marks it; the same task removes its messages in
+    batches of ``purge_batch`` rows and forgets its archive blocks.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        session_factory=SessionLocal,
+        partition_size: int = 10_000_000,
+        partitions_ahead: int = 2,
+        archive_after: Optional[timedelta] = None,
+        interval: float = 60.0,
+        block_rows: int = 1000,
+        purge_batch: int = 5000,
+        cached_blocks: int = 256,
+    ):
+        self.storage = storage
+        self.session_factory = session_factory
+        self.partition_size = partition_size
+        self.partitions_ahead = partitions_ahead
+        self.archive_after = archive_after
+        self.interval = interval
+        self.block_rows = block_rows
+        self.purge_batch = purge_batch
+        # Decoded blocks; paging back through one block reads it once
+        self._blocks = TTLCache(max_entries=cached_blocks, ttl=600.0)
+        self.native = False
+        self._task: Optional[asyncio.Task] = None
+        self.archived_rows = 0
+        self.purged_rows = 0
+
+    async def start(self):
+        async with self.session_factory() as db:
+            self.native = await self._is_partitioned(db)
+        # Inserts need a partition to land in before the first request
+        await self.maintain_partitions()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    @staticmethod
+    async def _is_partitioned(db: AsyncSession) -> bool:
+        if db.bind.dialect.name != "postgresql":
+            return False
+        kind = await db.scalar(text("SELECT relkind::text FROM pg_class WHERE oid = 'messages'::regclass"))
+        if kind != "p":
+            logger.warning("messages is not a partitioned table; id ranges are archived with DELETE")
+        return kind == "p"
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.maintain_partitions()
+                await self.archive_cold()
+                await self.purge_deleted_chats()
+            except Exception:
+                logger.exception("Message maintenance failed; retrying in %.0fs", self.interval)
+
+    async def maintain_partitions(self):
+        """Create ranges up to ``partitions_ahead`` past the one holding the newest message"""
+        async with self.session_factory() as db:
+            newest = (await db.scalar(select(func.max(messages.c.id)))) or 0
+            high = (await db.scalar(select(func.max(partitions.c.high_id)))) or 0
+            try:
+                while high <= newest + self.partition_size * self.partitions_ahead:
+                    low, high = high, high + self.partition_size
+                    if self.native:
+                        await db.execute(text(
+                            f"CREATE TABLE IF NOT EXISTS {partition_table(low)} "
+                            f"PARTITION OF messages FOR VALUES FROM ({low}) TO ({high})"
+                        ))
+                    await db.execute(insert(partitions).values(low_id=low, high_id=high, state="live"))
+                await db.commit()
+            except IntegrityError:
+                # Another worker created the same range first
+                await db.rollback()
+
+    async def archive_cold(self):
+        """Archive ranges, oldest first, while the oldest live one is cold"""
+        if self.archive_after is None:
+            return
+        while True:
+            cutoff = datetime.utcnow() - self.archive_after
+            async with self.session_factory() as db:
+                newest = await db.scalar(select(func.max(messages.c.id)))
+                partition = (await db.execute(
+                    select(partitions).where(partitions.c.state != "archived").order_by(partitions.c.low_id).limit(1)
+                )).first()
+                # The range holding the newest message is still being written
+                if partition is None or newest is None or partition.high_id > newest:
+                    return
+                in_range = (messages.c.id >= partition.low_id) & (messages.c.id < partition.high_id)
+                last_at = await db.scalar(select(func.max(messages.c.timestamp)).where(in_range))
+                if last_at is not None and last_at >= cutoff:
+                    return
+                if not await self._claim(db, partition.low_id):
+                    return
+            try:
+                await self._archive(partition.low_id, partition.high_id)
+            except Exception:
+                async with self.session_factory() as db:
+                    await db.execute(
+                        update(partitions)
+                        .where((partitions.c.low_id == partition.low_id) & (partitions.c.state == "archiving"))
+                        .values(state="live", claimed_at=None)
+                    )
+                    await db.commit()
+                raise
+
+    async def _claim(self, db: AsyncSession, low_id: int) -> bool:
+        now = datetime.utcnow()
+        result = await db.execute(
+            update(partitions)
+            .where((partitions.c.low_id == low_id) & (
+                (partitions.c.state == "live") | (partitions.c.claimed_at < now - CLAIM_TIMEOUT)
+            ))
+            .values(state="archiving", claimed_at=now)
+        )
+        await db.commit()
+        return result.rowcount == 1
+
+    async def _archive(self, low: int, high: int):
+        in_range = (messages.c.id >= low) & (messages.c.id < high)
+        key = archive_key(low, high)
+        fd, path = tempfile.mkstemp(dir=self.storage.staging_dir())
+        written: List[dict] = []
+        count, first_at, last_at = 0, None, None
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with self.session_factory() as db:
+                    result = await db.stream(
+                        select(messages).where(in_range)
+                        .order_by(messages.c.chat_id, messages.c.id)
+                        .execution_options(yield_per=self.block_rows)
+                    )
+                    chat_id, rows = None, []
+                    async for row in result.mappings():
+                        count += 1
+                        stamp = row["timestamp"]
+                        if stamp is not None:
+                            first_at = stamp if first_at is None else min(first_at, stamp)
+                            last_at = stamp if last_at is None else max(last_at, stamp)
+                        # Rows without a chat were never readable through the API
+                        if row["chat_id"] is None:
+                            continue
+                        if rows and (row["chat_id"] != chat_id or len(rows) >= self.block_rows):
+                            written.append(await self._write_block(f, low, chat_id, rows))
+                            rows = []
+                        chat_id = row["chat_id"]
+                        rows.append(row)
+                    if rows:
+                        written.append(await self._write_block(f, low, chat_id, rows))
+            if written:
+                await self.storage.put(key, path, "application/gzip")
+            else:
+                os.remove(path)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        async with self.session_factory() as db:
+            if self.native:
+                # Holds off writers until the range is gone
+                await db.execute(text(f"LOCK TABLE {partition_table(low)} IN SHARE MODE"))
+            present = await db.scalar(select(func.count()).select_from(messages).where(in_range))
+            if present != count:
+                raise RuntimeError(f"Messages {low}-{high} changed while being archived")
+            if written:
+                await db.execute(insert(blocks), written)
+                # Chats deleted meanwhile were purged before these blocks existed
+                await db.execute(delete(blocks).where(
+                    (blocks.c.partition_low_id == low) &
+                    blocks.c.chat_id.not_in(select(models.Chat.id).where(models.Chat.deleted_at.is_(None)))
+                ))
+            if self.native:
+                await db.execute(text(f"ALTER TABLE messages DETACH PARTITION {partition_table(low)}"))
+                await db.execute(text(f"DROP TABLE {partition_table(low)}"))
+            else:
+                await db.execute(delete(messages).where(in_range))
+            await db.execute(update(partitions).where(partitions.c.low_id == low).values(
+                state="archived", archive_key=key if written else None, row_count=count,
+                first_at=first_at, last_at=last_at, archived_at=datetime.utcnow(),
+            ))
+            await db.commit()
+        self.archived_rows += count
+        logger.info("Archived %d messages with ids %d-%d", count, low, high - 1)
+
+    async def _write_block(self, f, low: int, chat_id: int, rows: List) -> dict:
+        data = await asyncio.to_thread(gzip.compress, b"\n".join(encode_row(row) for row in rows))
+        offset = f.tell()
+        await asyncio.to_thread(f.write, data)
+        return {
+            "chat_id": chat_id, "first_id": rows[0]["id"], "last_id": rows[-1]["id"],
+            "partition_low_id": low, "offset": offset, "length": len(data), "count": len(rows),
+        }
+
+    async def _read_block(self, key: str, offset: int, length: int) -> List[dict]:
+        rows = self._blocks.get((key, offset))
+        if rows is MISSING:
+            data = await self.storage.read_range(key, offset, length)
+            rows = [json.loads(line) for line in (await asyncio.to_thread(gzip.decompress, data)).splitlines()]
+            self._blocks.put((key, offset), rows)
+        return rows
+
+    @staticmethod
+    def _blocks_query():
+        return select(blocks.c.offset, blocks.c.length, partitions.c.archive_key).join(
+            partitions, partitions.c.low_id == blocks.c.partition_low_id
+        )
+
+    async def history(
+        self, db: AsyncSession, chat_id: int, before_id: Optional[int], after_id: Optional[int], limit: int
+    ) -> List[models.Message]:
+        """Archived messages of a chat after ``after_id`` (oldest first), else before ``before_id`` (newest first)"""
+        query = self._blocks_query().where(blocks.c.chat_id == chat_id)
+        if after_id is not None:
+            query = query.where(blocks.c.last_id > after_id).order_by(blocks.c.first_id)
+        else:
+            if before_id is not None:
+                query = query.where(blocks.c.first_id < before_id)
+            query = query.order_by(blocks.c.first_id.desc())
+        found: List[dict] = []
+        result = await db.stream(query)
+        try:
+            async for offset, length, key in result:
+                rows = await self._read_block(key, offset, length)
+                if after_id is not None:
+                    found.extend(row for row in rows if row["id"] > after_id)
+                else:
+                    found.extend(row for row in reversed(rows) if before_id is None or row["id"] < before_id)
+                if len(found) >= limit:
+                    break
+        finally:
+            await result.close()
+        return await self._with_senders(db, found[:limit])
+
+    async def with_archived(
+        self, db: AsyncSession, chat_id: int, page: List[models.Message],
+        before_id: Optional[int], after_id: Optional[int], limit: int,
+    ) -> List[models.Message]:
+        """Complete a page of live messages, in query order, with archived ones.
+
+        Archived ids are below every live id, so paging back only needs the
+        archive once the live rows run out; paging forward always asks, which
+        costs one lookup in the block index when nothing is archived.
+        """
+        if after_id is None and len(page) >= limit:
+            return page
+        archived = await self.history(db, chat_id, before_id, after_id, limit)
+        if not archived:
+            return page
+        merged = sorted([*page, *archived], key=lambda message: message.id, reverse=after_id is None)
+        return merged[:limit]
+
+    async def find(self, db: AsyncSession, message_ids: Dict[int, int]) -> Dict[int, models.Message]:
+        """Archived messages by id, given as {chat_id: message_id}"""
+        if not message_ids:
+            return {}
+        rows = (await db.execute(self._blocks_query().add_columns(blocks.c.chat_id).where(or_(*(
+            and_(blocks.c.chat_id == chat_id, blocks.c.first_id <= message_id, blocks.c.last_id >= message_id)
+            for chat_id, message_id in message_ids.items()
+        ))))).all()
+        found = []
+        for offset, length, key, chat_id in rows:
+            wanted = message_ids[chat_id]
+            found.extend(row for row in await self._read_block(key, offset, length) if row["id"] == wanted)
+        return {message.id: message for message in await self._with_senders(db, found)}
+
+    @staticmethod
+    async def _with_senders(db: AsyncSession, rows: List[dict]) -> List[models.Message]:
+        sender_ids = {row["sender_id"] for row in rows}
+        senders = {}
+        if sender_ids:
+            senders = {user.id: user for user in await db.scalars(
+                select(models.User).where(models.User.id.in_(sender_ids))
+            )}
+        found = []
+        for row in rows:
+            message = decode_message(row)
+            # Loaded state, not a change: the message never joins the session
+            set_committed_value(message, "sender", senders.get(row["sender_id"]))
+            found.append(message)
+        return found
+
+    async def purge_deleted_chats(self):
+        cutoff = datetime.utcnow() - PURGE_DELAY
+        async with self.session_factory() as db:
+            chat_ids = (await db.scalars(
+                select(models.Chat.id).where(models.Chat.deleted_at < cutoff).limit(100)
+            )).all()
+        for chat_id in chat_ids:
+            await self._purge_chat(chat_id)
+
+    async def _purge_chat(self, chat_id: int):
+        # Short transactions: a huge chat never holds locks for long
+        batch = select(messages.c.id).where(messages.c.chat_id == chat_id).limit(self.purge_batch)
+        while True:
+            async with self.session_factory() as db:
+                result = await db.execute(delete(messages).where(messages.c.id.in_(batch)))
+                await db.commit()
+            self.purged_rows += result.rowcount
+            if result.rowcount < self.purge_batch:
+                break
+        async with self.session_factory() as db:
+            await db.execute(delete(blocks).where(blocks.c.chat_id == chat_id))
+            await db.execute(delete(models.Chat.__table__).where(models.Chat.__table__.c.id == chat_id))
+            await db.commit()
+
+
+def archive_after(days: str) -> Optional[timedelta]:
+    return timedelta(days=float(days)) if float(days) > 0 else None
+
+
+message_archive = MessageArchive(
+    create_storage(os.getenv("MESSAGE_ARCHIVE_URL")) if os.getenv("MESSAGE_ARCHIVE_URL") else storage,
+    partition_size=int(os.getenv("MESSAGE_PARTITION_SIZE", "10000000")),
+    archive_after=archive_after(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "0")),
+    interval=float(os.getenv("MESSAGE_MAINTENANCE_INTERVAL", "60")),
+    purge_batch=int(os.getenv("CHAT_PURGE_BATCH", "5000")),
+)
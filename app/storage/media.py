@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import select, update
+from ..database import SessionLocal
+from ..models import models
+from ..websockets.manager import manager
+from ..websockets.ingest import ingest
+from . import blurhash
+from .signing import sign_url
+from .storage import LocalStorage, Storage, content_key, storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, previews are skipped without it
+    Image = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+# Edge of the image the placeholder is computed from; BlurHash needs very little
+BLURHASH_EDGE = 32
+
+
+def thumbnail_key(file_hash: str) -> str:
+    # Derived from the content, so identical uploads share one thumbnail
+    return content_key(file_hash) + THUMBNAIL_SUFFIX
+
+
+def render_preview(source: str, kind: str, target: str, max_edge: int, ffmpeg: Optional[str]) -> dict:
+    """Write a JPEG thumbnail of ``source`` to ``target``; runs in a worker process"""
+    frame = None
+    if kind == "video":
+        fd, frame = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(target))
+        os.close(fd)
+        subprocess.run(
+            [ffmpeg, "-v", "error", "-y", "-i", source, "-frames:v", "1", frame],
+            check=True, timeout=60, stdin=subprocess.DEVNULL,
+        )
+        source = frame
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            # EXIF orientations 5-8 are rotated by 90 degrees
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
+            # Lets JPEG decode at a fraction of full resolution
+            image.draft("RGB", (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((max_edge, max_edge))
+            image.save(target, "JPEG", quality=80, optimize=True, progressive=True)
+            image.thumbnail((BLURHASH_EDGE, BLURHASH_EDGE))
+            placeholder = blurhash.encode(list(image.getdata()), *image.size)
+    finally:
+        if frame is not None:
+            os.remove(frame)
+    return {"media_width": width, "media_height": height, "blurhash": placeholder}
+
+
+@dataclass
+class PreviewJob:
+    message_id: int
+    chat_id: int
+    file_hash: str
+    kind: str
+
+
+class MediaProcessor:
+    """Builds thumbnails and BlurHash placeholders for image and video uploads.
+
+    Jobs are queued in memory and rendered in a process pool so decoding never
+    competes with the event loop. When a preview is ready the message row is
+    updated and a ``message_updated`` event goes to the chat. Previews are a
+    nicety: a full queue, a missing Pillow/ffmpeg or a crash only means the
+    message keeps showing the original.
+    """
+
+    def __init__(self, storage: Storage, workers: int = 2, queue_size: int = 1000,
+                 max_edge: int = 320, ffmpeg: Optional[str] = None, enabled: bool = True,
+                 session_factory=SessionLocal):
+        self.storage = storage
+        self.session_factory = session_factory
+        self.workers = workers
+        self.max_edge = max_edge
+        self.ffmpeg = ffmpeg
+        self.enabled = enabled and Image is not None
+        self.missing_pillow = enabled and Image is None
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks = []
+        self.rendered = 0
+        self.reused = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def kind_of(self, filetype: Optional[str]) -> Optional[str]:
+        if not filetype:
+            return None
+        if filetype.startswith("image/"):
+            return "image"
+        if filetype.startswith("video/") and self.ffmpeg:
+            return "video"
+        return None
+
+    async def start(self):
+        if self.missing_pillow:
+            logger.warning("Media previews are enabled but Pillow is not installed; attachments get no thumbnails")
+        if not self.enabled:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, message_id: int, chat_id: int, file_hash: str, filetype: Optional[str]) -> bool:
+        """Queue a preview for an attachment; False if none will be made"""
+        kind = self.kind_of(filetype)
+        if not self._tasks or kind is None:
+            return False
+        try:
+            self._queue.put_nowait(PreviewJob(message_id, chat_id, file_hash, kind))
+        except asyncio.QueueFull:
+            self.skipped += 1
+            logger.warning("Preview queue full; message %d keeps its original only", message_id)
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                logger.exception("Preview for message %d failed", job.message_id)
+
+    async def _process(self, job: PreviewJob):
+        preview = await self._existing_preview(job.file_hash)
+        if preview is not None:
+            self.reused += 1
+        else:
+            preview = await self._render(job)
+            self.rendered += 1
+        preview["thumbnail_url"] = thumbnail_url(job.chat_id, job.file_hash)
+        if not await self._record(job.message_id, preview):
+            # Clients would show a preview that is gone after a reload
+            self.failed += 1
+            logger.warning("Message %d was not saved; its preview is dropped", job.message_id)
+            return
+        await manager.broadcast_to_chat(job.chat_id, {
+            "type": "message_updated",
+            "message": {
+                "id": job.message_id, "chat_id": job.chat_id,
+                **preview, "thumbnail_url": sign_url(preview["thumbnail_url"]),
+            },
+        })
+
+    async def _existing_preview(self, file_hash: str) -> Optional[dict]:
+        async with self.session_factory() as db:
+            row = (await db.execute(
+                select(models.Message.media_width, models.Message.media_height, models.Message.blurhash)
+                .where((models.Message.file_hash == file_hash) & models.Message.thumbnail_url.isnot(None))
+                .limit(1)
+            )).first()
+        if row is None or not await self.storage.exists(thumbnail_key(file_hash)):
+            return None
+        return {"media_width": row.media_width, "media_height": row.media_height, "blurhash": row.blurhash}
+
+    async def _render(self, job: PreviewJob) -> dict:
+        staging = self.storage.staging_dir()
+        fd, target = tempfile.mkstemp(suffix=".jpg", dir=staging)
+        os.close(fd)
+        source, fetched = await self._source(job.file_hash)
+        try:
+            loop = asyncio.get_running_loop()
+            preview = await loop.run_in_executor(
+                self._executor, render_preview, source, job.kind, target, self.max_edge, self.ffmpeg
+            )
+            await self.storage.put(thumbnail_key(job.file_hash), target, "image/jpeg")
+        finally:
+            for path in (target, fetched):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        return preview
+
+    async def _source(self, file_hash: str):
+        """Local path of the original, and a temporary copy to remove afterwards if any"""
+        if isinstance(self.storage, LocalStorage):
+            return self.storage.path(content_key(file_hash)), None
+        fd, path = tempfile.mkstemp(dir=self.storage.staging_dir())
+        os.close(fd)
+        await self.storage.fetch(content_key(file_hash), path)
+        return path, path
+
+    async def _record(self, message_id: int, preview: dict) -> bool:
+        """Store the preview on its message; False if the message never reached the database"""
+        while True:
+            # Checked first: a row that was not pending before the UPDATE missed it for good
+            pending = ingest.enabled and ingest.is_pending(message_id)
+            async with self.session_factory() as db:
+                result = await db.execute(
+                    update(models.Message).where(models.Message.id == message_id)
+                    .values(**preview)
+                )
+                await db.commit()
+            if result.rowcount:
+                return True
+            if not pending:
+                return False
+            # With write-behind the row is written by a later flush, or dropped
+            await asyncio.sleep(max(ingest.flush_interval, 0.01))
+
+
+def file_url(chat_id: int, file_hash: str) -> str:
+    return f"/chats/{chat_id}/files/{file_hash}"
+
+
+def thumbnail_url(chat_id: int, file_hash: str) -> str:
+    return f"/chats/{chat_id}/files/{file_hash}/thumbnail"
+
+
+media = MediaProcessor(
+    storage,
+    workers=int(os.getenv("MEDIA_WORKERS", "2")),
+    queue_size=int(os.getenv("MEDIA_QUEUE_SIZE", "1000")),
+    max_edge=int(os.getenv("THUMBNAIL_MAX_EDGE", "320")),
+    ffmpeg=os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg"),
+    enabled=os.getenv("MEDIA_PREVIEWS", "true").lower() in ("1", "true", "yes"),
+)
@@ -0,0 +1,38 @@
+import hashlib
+import hmac
+import os
+import time
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Signed download URLs stay valid between one and two of these
+MEDIA_URL_TTL = int(os.getenv("MEDIA_URL_TTL", "86400"))
+
+# Derived, so a leaked media signature says nothing about the JWT key
+_KEY = hashlib.sha256(b"media-url\n" + (os.getenv("SECRET_KEY") or "").encode()).digest()
+
+
+def _signature(path: str, expires: int) -> str:
+    return hmac.new(_KEY, f"{path}\n{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def sign_url(path: Optional[str], now: Optional[float] = None) -> Optional[str]:
+    """A download URL for ``path`` that works without the session token.
+
+    ``<img>`` and ``<video>`` tags cannot send an Authorization header; the
+    path (chat, content hash and variant) and an expiry are signed instead.
+    The expiry is rounded up to a multiple of ``MEDIA_URL_TTL`` so everyone
+    gets the same URL for a file for a while and browser caches keep working.
+    """
+    if not path:
+        return path
+    now = time.time() if now is None else now
+    expires = (int(now) // MEDIA_URL_TTL + 2) * MEDIA_URL_TTL
+    return f"{path}?expires={expires}&signature={_signature(path, expires)}"
+
+
+def signature_valid(path: str, expires: int, signature: str, now: Optional[float] = None) -> bool:
+    now = time.time() if now is None else now
+    return expires > now and hmac.compare_digest(signature, _signature(path, expires))
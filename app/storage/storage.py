@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import quote, urlparse
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.routing import APIRoute
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional, only needed for s3:// storage
+    boto3 = None
+
+load_dotenv()
+
+CHUNK_SIZE = 1024 * 1024
+# Room for the multipart boundaries and part headers around an uploaded file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class Storage:
+    """Where attachment blobs live, addressed by key.
+
+    Uploads are staged as local files first; ``put`` then moves a finished
+    file into the backend under its final key. Keys are content hashes, so
+    a key that already exists never needs to be written again.
+    """
+
+    def staging_dir(self) -> str:
+        return tempfile.gettempdir()
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    async def put(self, key: str, path: str, content_type: Optional[str] = None):
+        """Store the file at ``path`` under ``key``; the file is consumed"""
+        raise NotImplementedError
+
+    async def fetch(self, key: str, path: str):
+        """Copy the blob stored under ``key`` to the local file ``path``"""
+        raise NotImplementedError
+
+    async def read_range(self, key: str, offset: int, length: int) -> bytes:
+        """``length`` bytes of the blob stored under ``key``, starting at ``offset``"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    def download_url(self, key: str, filename: str, content_type: Optional[str]) -> Optional[str]:
+        """A URL clients can be redirected to, or None if the app serves the blob"""
+        return None
+
+
+class LocalStorage(Storage):
+    """Blobs under a directory, served by the app or by nginx"""
+
+    def __init__(self, root: str):
+        self.root = root
+        # Staging on the same filesystem makes ``put`` an atomic rename
+        self._staging = os.path.join(root, ".staging")
+        os.makedirs(self._staging, exist_ok=True)
+
+    def staging_dir(self) -> str:
+        return self._staging
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self.path(key))
+
+    async def put(self, key: str, path: str, content_type: Optional[str] = None):
+        await asyncio.to_thread(self._move, path, self.path(key))
+
+    @staticmethod
+    def _move(source: str, target: str):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError:
+            # Staging lives on another filesystem
+            shutil.move(source, target)
+
+    async def fetch(self, key: str, path: str):
+        await asyncio.to_thread(shutil.copyfile, self.path(key), path)
+
+    async def read_range(self, key: str, offset: int, length: int) -> bytes:
+        return await asyncio.to_thread(self._read_range, self.path(key), offset, length)
+
+    @staticmethod
+    def _read_range(path: str, offset: int, length: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    async def delete(self, key: str):
+        try:
+            await asyncio.to_thread(os.remove, self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(Storage):
+    """Blobs in an S3-compatible bucket (AWS, MinIO, ...); needs boto3"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 url_ttl: int = 3600):
+        if boto3 is None:
+            raise RuntimeError("s3:// storage requires boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.url_ttl = url_ttl
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    async def put(self, key: str, path: str, content_type: Optional[str] = None):
+        extra = {"ContentType": content_type} if content_type else None
+        try:
+            await asyncio.to_thread(self.client.upload_file, path, self.bucket, self._key(key), ExtraArgs=extra)
+        finally:
+            os.remove(path)
+
+    async def fetch(self, key: str, path: str):
+        await asyncio.to_thread(self.client.download_file, self.bucket, self._key(key), path)
+
+    async def read_range(self, key: str, offset: int, length: int) -> bytes:
+        response = await asyncio.to_thread(
+            self.client.get_object, Bucket=self.bucket, Key=self._key(key),
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )
+        return await asyncio.to_thread(response["Body"].read)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self._key(key))
+
+    def download_url(self, key: str, filename: str, content_type: Optional[str]) -> Optional[str]:
+        # Presigned so the bucket can stay private; S3 handles Range itself
+        params = {
+            "Bucket": self.bucket,
+            "Key": self._key(key),
+            "ResponseContentDisposition": content_disposition(filename, content_type),
+            "ResponseContentType": served_type(content_type),
+        }
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.url_ttl)
+
+
+def create_storage(url: Optional[str]) -> Storage:
+    """Build a storage backend from a URL: a directory, ``file:///dir`` or ``s3://bucket/prefix``."""
+    if not url:
+        return LocalStorage("app/routers/uploads")
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "file"):
+        return LocalStorage(parsed.path)
+    if parsed.scheme == "s3":
+        return S3Storage(
+            parsed.netloc,
+            parsed.path,
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+        )
+    raise ValueError(f"Unsupported storage URL: {url}")
+
+
+@dataclass
+class StoredFile:
+    key: str
+    sha256: str
+    size: int
+    deduplicated: bool
+
+
+# Media a browser only ever renders as media. Anything else (HTML, SVG, XML,
+# PDF, ...) could run script in the app's origin, so it is downloaded instead.
+INLINE_TYPES = frozenset({
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif",
+    "video/mp4", "video/webm", "video/ogg",
+    "audio/mpeg", "audio/ogg", "audio/wav", "audio/webm", "audio/mp4", "audio/aac", "audio/flac",
+})
+
+
+def served_type(content_type: Optional[str]) -> str:
+    """The type a blob is served with: the uploaded one if it is safe inline media, else opaque bytes"""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return media_type if media_type in INLINE_TYPES else "application/octet-stream"
+
+
+def content_disposition(filename: str, content_type: Optional[str] = None) -> str:
+    disposition = "inline" if served_type(content_type) in INLINE_TYPES else "attachment"
+    # RFC 6266: an ASCII fallback plus the exact UTF-8 name
+    fallback = filename.encode("ascii", "replace").decode().replace('"', "")
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def content_key(sha256: str) -> str:
+    # Fan out by prefix so no directory grows to millions of entries
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def _write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+
+async def save_upload(upload: UploadFile, storage: Storage, max_size: int,
+                      chunk_size: int = CHUNK_SIZE) -> StoredFile:
+    """Stream an upload into storage under its SHA-256, keeping one copy per content.
+
+    The body is read ``chunk_size`` bytes at a time; hashing and writing run
+    in a worker thread so the event loop never blocks on disk. Uploads over
+    ``max_size`` bytes are rejected with 413.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, staged = tempfile.mkstemp(dir=storage.staging_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := await upload.read(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {max_size} byte limit")
+                await asyncio.to_thread(_write_chunk, f, digest, chunk)
+        sha256 = digest.hexdigest()
+        key = content_key(sha256)
+        if await storage.exists(key):
+            os.remove(staged)
+            return StoredFile(key, sha256, size, deduplicated=True)
+        await storage.put(key, staged, upload.content_type)
+        return StoredFile(key, sha256, size, deduplicated=False)
+    except BaseException:
+        if os.path.exists(staged):
+            os.remove(staged)
+        raise
+
+
+def limit_body(request: Request, limit: int) -> Request:
+    """The request, answering 413 once its body is known or seen to exceed ``limit`` bytes"""
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail=f"Request body exceeds the {limit} byte limit")
+    receive = request.receive
+    received = 0
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        received += len(message.get("body", b""))
+        if received > limit:
+            raise HTTPException(status_code=413, detail=f"Request body exceeds the {limit} byte limit")
+        return message
+
+    return Request(request.scope, limited_receive)
+
+
+class UploadLimitRoute(APIRoute):
+    """Refuses multipart bodies larger than an upload may be before FastAPI parses them.
+
+    The form, file included, is read and spooled before the endpoint runs,
+    so ``save_upload`` alone would refuse an oversized upload only after
+    receiving all of it.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request):
+            if request.headers.get("content-type", "").startswith("multipart/"):
+                request = limit_body(request, MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD)
+            return await handler(request)
+
+        return limited_handler
+
+
+storage = create_storage(os.getenv("STORAGE_URL"))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))
@@ -0,0 +1,283 @@
+import asyncio
+import glob
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[bytes], Awaitable[None]]
+
+
+class Backplane:
+    """Pub/sub bus that carries WebSocket fan-out between workers.
+
+    Every frame published by a worker reaches the handlers subscribed on all
+    *other* workers. The publishing worker delivers to its own sockets
+    directly, so each backplane only has to move bytes between processes.
+    """
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex[:16].encode()
+        self._handlers: Dict[bytes, List[Handler]] = {}
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel.encode(), []).append(handler)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, data: bytes):
+        raise NotImplementedError
+
+    def _envelope(self, channel: str, data: bytes) -> bytes:
+        return self.node_id + b"\n" + channel.encode() + b"\n" + data
+
+    async def _receive(self, envelope: bytes):
+        try:
+            origin, channel, data = envelope.split(b"\n", 2)
+        except ValueError:
+            logger.warning("Dropping malformed backplane frame")
+            return
+        if origin == self.node_id:
+            return
+        for handler in self._handlers.get(channel, ()):
+            try:
+                await handler(data)
+            except Exception:
+                logger.exception("Backplane handler failed for channel %s", channel)
+
+
+class InMemoryBackplane(Backplane):
+    """Single-process backplane; instances sharing a hub behave like workers."""
+
+    def __init__(self, hub: Optional[List["InMemoryBackplane"]] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+
+    async def start(self):
+        if self not in self.hub:
+            self.hub.append(self)
+
+    async def stop(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+    async def publish(self, channel: str, data: bytes):
+        envelope = self._envelope(channel, data)
+        for peer in list(self.hub):
+            if peer is not self:
+                await peer._receive(envelope)
+
+
+class LocalSocketBackplane(Backplane):
+    """Backplane for several workers on one host using Unix datagram sockets.
+
+    Each worker binds ``<directory>/<node_id>.sock`` and publishing sends one
+    datagram to every other socket found in the directory. Sockets left behind
+    by dead workers are removed the first time a send to them fails.
+    """
+
+    PEER_REFRESH_SECONDS = 1.0
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, self.node_id.decode() + ".sock")
+        self._sock: Optional[socket.socket] = None
+        self._peers: List[str] = []
+        self._peers_loaded_at = 0.0
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _on_readable(self):
+        while True:
+            try:
+                envelope = self._sock.recv(1 << 20)
+            except (BlockingIOError, InterruptedError):
+                return
+            asyncio.ensure_future(self._receive(envelope))
+
+    def _current_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_loaded_at > self.PEER_REFRESH_SECONDS:
+            self._peers = [
+                path for path in glob.glob(os.path.join(self.directory, "*.sock"))
+                if path != self.path
+            ]
+            self._peers_loaded_at = now
+        return self._peers
+
+    async def publish(self, channel: str, data: bytes):
+        envelope = self._envelope(channel, data)
+        for peer in self._current_peers():
+            try:
+                self._sock.sendto(envelope, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                logger.info("Removing stale backplane socket %s", peer)
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+                self._peers_loaded_at = 0.0
+            except (BlockingIOError, OSError) as e:
+                logger.warning("Backplane send to %s failed: %s", peer, e)
+
+
+def _encode_command(*args: bytes) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise RuntimeError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+
+class RedisBackplane(Backplane):
+    """Backplane over any server speaking the Redis protocol (PUBLISH/SUBSCRIBE).
+
+    Talks RESP directly over asyncio streams, so no client library is needed.
+    Publishes are pipelined: replies are drained by a background task rather
+    than awaited per frame. All workers share a single Redis channel and the
+    logical channel travels inside the envelope.
+    """
+
+    RECONNECT_DELAY_SECONDS = 1.0
+
+    def __init__(self, url: str, redis_channel: str = "messanger:ws"):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.redis_channel = redis_channel.encode()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: List[asyncio.Task] = []
+        self._connected = asyncio.Event()
+        self._stopping = False
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command(b"AUTH", self.password.encode()))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self):
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._publisher_loop()),
+            asyncio.create_task(self._subscriber_loop()),
+        ]
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _publisher_loop(self):
+        while not self._stopping:
+            try:
+                reader, self._writer = await self._open()
+                self._connected.set()
+                while True:
+                    await _read_reply(reader)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Redis publish connection lost: %s", e)
+            self._connected.clear()
+            self._writer = None
+            await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+
+    async def _subscriber_loop(self):
+        while not self._stopping:
+            writer = None
+            try:
+                reader, writer = await self._open()
+                writer.write(_encode_command(b"SUBSCRIBE", self.redis_channel))
+                await writer.drain()
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and reply and reply[0] == b"message":
+                        await self._receive(reply[2])
+            except asyncio.CancelledError:
+                if writer is not None:
+                    writer.close()
+                raise
+            except Exception as e:
+                logger.warning("Redis subscribe connection lost: %s", e)
+            if writer is not None:
+                writer.close()
+            await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+
+    async def publish(self, channel: str, data: bytes):
+        if not self._connected.is_set():
+            logger.warning("Redis backplane not connected; frame for %s not published", channel)
+            return
+        self._writer.write(_encode_command(b"PUBLISH", self.redis_channel, self._envelope(channel, data)))
+        await self._writer.drain()
+
+
+def create_backplane(url: Optional[str]) -> Backplane:
+    """Build a backplane from a URL: ``memory://``, ``unix:///dir`` or ``redis://host:port``."""
+    if not url or url.startswith("memory://"):
+        return InMemoryBackplane()
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return LocalSocketBackplane(parsed.path)
+    if parsed.scheme == "redis":
+        return RedisBackplane(url)
+    raise ValueError(f"Unsupported WebSocket backplane URL: {url}")
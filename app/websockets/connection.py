@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import uuid
+from typing import Callable, Optional, Set
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# Close code sent to consumers that cannot keep up ("try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Connection:
+    """A WebSocket with a bounded outbound queue drained by its own writer task.
+
+    Frames are queued already encoded (see ``frames.encode_frame``) so the same
+    text can be shared by every recipient of a broadcast. ``send`` never waits
+    on the network, so a slow or dead client only backs up its own queue. When
+    the queue is full the overflow policy either drops the oldest pending frame
+    or disconnects the client.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        max_queue: int = 256,
+        overflow_policy: str = DROP_OLDEST,
+        send_timeout: float = 10.0,
+        on_overflow: Optional[Callable[["Connection"], None]] = None,
+        on_drop: Optional[Callable[["Connection"], None]] = None,
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.user_id = user_id
+        # Chats this connection joined; the manager keeps per-user counts
+        self.chats: Set[int] = set()
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+        self._on_overflow = on_overflow
+        self._on_drop = on_drop
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def send(self, frame: str) -> bool:
+        """Queue a frame for delivery; returns False if it was not accepted"""
+        if self.closed:
+            return False
+        if self.queue.full():
+            if self.overflow_policy == DISCONNECT:
+                self._drop()
+                if self._on_overflow:
+                    self._on_overflow(self)
+                if self._stop():
+                    # The receive loop ends once the socket is closed and disconnect awaits the writer
+                    asyncio.create_task(self._close_socket(SLOW_CONSUMER_CLOSE_CODE))
+                return False
+            self.queue.get_nowait()
+            self._drop()
+        self.queue.put_nowait(frame)
+        return True
+
+    def _drop(self):
+        self.dropped += 1
+        if self._on_drop:
+            self._on_drop(self)
+
+    async def _write_loop(self):
+        try:
+            # wait_for may swallow a cancel that lands as the send completes; closed still ends the loop
+            while not self.closed:
+                frame = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(frame), self.send_timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.info("Closing connection of user %s after failed send: %s", self.user_id, e)
+            await self.close(SLOW_CONSUMER_CLOSE_CODE)
+
+    def _stop(self) -> bool:
+        """Refuse further frames and cancel the writer; False if already stopped"""
+        if self.closed:
+            return False
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        return True
+
+    async def close(self, code: Optional[int] = None):
+        """Stop the writer and wait for it to exit; with a code, also close the socket so the receive loop ends"""
+        stopping = self._stop()
+        writer = self._writer
+        if writer is not None and writer is not asyncio.current_task():
+            try:
+                await writer
+            except asyncio.CancelledError:
+                # Only the writer's own cancellation is expected; the caller's must propagate
+                if asyncio.current_task().cancelling():
+                    raise
+        if stopping and code is not None:
+            await self._close_socket(code)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
@@ -0,0 +1,13 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, only speeds up encoding
+    orjson = None
+
+
+def encode_frame(message: dict) -> str:
+    """Serialize a WebSocket frame once so it can be sent to any number of sockets"""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"))
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, func, insert, select, text, update
+from sqlalchemy.exc import DBAPIError, IntegrityError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import SessionLocal
+from ..models import models
+from ..replicas import replicas
+from .sequences import next_seq, sequences
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Unused ids of an older block are abandoned, so an idle worker never writes
+# into an id range the archiver has already closed (see storage/archive.py)
+ID_BLOCK_MAX_AGE = 3600.0
+
+# Moves chats.last_message_id forward; run executemany with chat/message pairs
+LAST_MESSAGE_UPDATE = update(models.Chat.__table__).where(
+    (models.Chat.__table__.c.id == bindparam("chat")) &
+    (func.coalesce(models.Chat.__table__.c.last_message_id, 0) < bindparam("message"))
+).values(last_message_id=bindparam("message"))
+
+
+def unreachable(e: Exception) -> bool:
+    """Whether the error says nothing about the rows: the database could not be reached"""
+    if isinstance(e, DBAPIError) and e.connection_invalidated:
+        return True
+    return isinstance(e, (OperationalError, InterfaceError, OSError, asyncio.TimeoutError))
+
+
+def latest_per_chat(rows: List[dict]) -> List[dict]:
+    latest = {}
+    for row in rows:
+        latest[row["chat_id"]] = max(latest.get(row["chat_id"], 0), row["id"])
+    return [{"chat": chat_id, "message": message_id} for chat_id, message_id in latest.items()]
+
+
+class MessageIngest:
+    """Write-behind persistence for chat messages.
+
+    ``submit`` assigns the message id and timestamp immediately and returns a
+    transient ``models.Message`` the caller can broadcast right away. Rows are
+    written by a background task in multi-row INSERTs once ``batch_size`` rows
+    are pending or ``flush_interval`` seconds have passed.
+
+    Durability: a message is durable only after its batch commits. A crash
+    loses at most the rows still pending (bounded by ``flush_interval`` and
+    ``max_pending``); ``stop`` drains everything before returning. A failed
+    flush is retried with the same ids; rows that did land despite the error
+    are skipped, so each message is written exactly once. While the database
+    cannot be reached the batch is retried as a whole. Any other failure
+    writes the batch row by row, and rows the database still rejects (a
+    chat deleted meanwhile, say) are dropped into ``dead_letters`` and
+    logged, so one bad row never holds up the rest.
+
+    Backpressure: at most ``max_pending`` rows wait for the database. Beyond
+    that ``submit`` blocks, which stalls the sender's receive loop instead of
+    growing memory without bound.
+
+    Ids come from the ``messages`` sequence in blocks on PostgreSQL. Other
+    databases fall back to a process-local counter seeded from ``max(id)``, so
+    there this ingest must be the only writer of ``messages``.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        batch_size: int = 500,
+        flush_interval: float = 0.05,
+        max_pending: int = 10000,
+        id_block: int = 1000,
+        enabled: bool = True,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.id_block = id_block
+        self.enabled = enabled
+        self._pending: List[dict] = []
+        self._slots = asyncio.Semaphore(max_pending)
+        self._batch_ready = asyncio.Event()
+        self._ids: Deque[int] = deque()
+        self._ids_reserved_at = 0.0
+        self._id_lock = asyncio.Lock()
+        self._fallback_next: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._consecutive_failures = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        # (row, error) of the latest rows the database rejected
+        self.dead_letters: Deque[tuple] = deque(maxlen=1000)
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush every pending row, then stop the background writer"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def is_pending(self, message_id: int) -> bool:
+        """Whether the message is still waiting to be written"""
+        return any(row["id"] == message_id for row in self._pending)
+
+    def newest_pending(self, chat_id: int) -> int:
+        """Id of the chat's newest message not yet written, or 0"""
+        return max((row["id"] for row in self._pending if row["chat_id"] == chat_id), default=0)
+
+    async def submit(self, **values) -> models.Message:
+        await self._slots.acquire()
+        try:
+            values["id"] = await self._next_id()
+        except BaseException:
+            # Nothing was queued, so the flush would never give the slot back
+            self._slots.release()
+            raise
+        values.setdefault("timestamp", datetime.utcnow())
+        values.setdefault("is_read", False)
+        self._pending.append(values)
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+        return models.Message(**values)
+
+    async def _next_id(self) -> int:
+        if self._ids and time.monotonic() - self._ids_reserved_at > ID_BLOCK_MAX_AGE:
+            self._ids.clear()
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    await self._reserve_ids()
+        return self._ids.popleft()
+
+    async def _reserve_ids(self):
+        self._ids_reserved_at = time.monotonic()
+        async with self.session_factory() as db:
+            if db.bind.dialect.name == "postgresql":
+                result = await db.execute(
+                    text("SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, :n)"),
+                    {"n": self.id_block},
+                )
+                self._ids.extend(row[0] for row in result)
+                return
+            if self._fallback_next is None:
+                self._fallback_next = (await db.scalar(select(func.max(models.Message.id)))) or 0
+        self._ids.extend(range(self._fallback_next + 1, self._fallback_next + 1 + self.id_block))
+        self._fallback_next += self.id_block
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self._flush()
+            if self._stopping and not self._pending:
+                return
+
+    async def _flush(self):
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            try:
+                await self._write(batch)
+            except Exception as e:
+                # An earlier attempt may have committed before reporting failure
+                if isinstance(e, IntegrityError) and await self._drop_written(batch):
+                    continue
+                self.failed_flushes += 1
+                if not unreachable(e) and await self._write_each(batch):
+                    continue
+                self._consecutive_failures += 1
+                logger.exception("Flushing %d messages failed; retrying", len(batch))
+                await asyncio.sleep(min(5.0, self.flush_interval * 2 ** self._consecutive_failures))
+                return
+            self._consecutive_failures = 0
+            del self._pending[:len(batch)]
+            self.flushed_rows += len(batch)
+            for _ in batch:
+                self._slots.release()
+
+    async def _write(self, rows: List[dict]):
+        async with self.session_factory() as db:
+            await db.execute(insert(models.Message), rows)
+            await db.execute(LAST_MESSAGE_UPDATE, latest_per_chat(rows))
+            await db.commit()
+
+    async def _write_each(self, batch: List[dict]) -> bool:
+        """Write the batch row by row, dropping the rows the database rejects.
+
+        Stops and returns False, leaving the rest pending, if the database
+        cannot be reached.
+        """
+        for row in batch:
+            try:
+                await self._write([row])
+            except Exception as e:
+                if unreachable(e):
+                    return False
+                self.dropped_rows += 1
+                self.dead_letters.append((row, e))
+                logger.error("Dropping message %d of chat %s: %s", row["id"], row.get("chat_id"), e)
+            else:
+                self.flushed_rows += 1
+            # The batch is the head of the queue; submit only appends
+            del self._pending[0]
+            self._slots.release()
+        self._consecutive_failures = 0
+        return True
+
+    async def _drop_written(self, batch: List[dict]) -> bool:
+        """Forget rows of the batch that are already in the database"""
+        ids = [row["id"] for row in batch]
+        async with self.session_factory() as db:
+            written = set(await db.scalars(select(models.Message.id).where(models.Message.id.in_(ids))))
+        if not written:
+            return False
+        self._pending = [row for row in self._pending if row["id"] not in written]
+        for _ in written:
+            self._slots.release()
+        return True
+
+
+ingest = MessageIngest(
+    batch_size=int(os.getenv("INGEST_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("INGEST_FLUSH_INTERVAL", "0.05")),
+    max_pending=int(os.getenv("INGEST_MAX_PENDING", "10000")),
+    id_block=int(os.getenv("INGEST_ID_BLOCK", "1000")),
+    enabled=os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes"),
+)
+
+
+async def save_message(db: AsyncSession, **values) -> models.Message:
+    """Persist a chat message now, or hand it to the write-behind ingest"""
+    if ingest.enabled:
+        values["seq"] = await sequences.next(values["chat_id"])
+        # Committed later by the flush task, which acts for no user
+        replicas.wrote(values["sender_id"])
+        return await ingest.submit(**values)
+    # Holding the chat row until commit keeps seq order equal to commit order
+    values["seq"] = await next_seq(db, values["chat_id"])
+    message = models.Message(**values)
+    db.add(message)
+    await db.flush()
+    await db.execute(LAST_MESSAGE_UPDATE, [{"chat": message.chat_id, "message": message.id}])
+    await db.commit()
+    return message
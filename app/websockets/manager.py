@@ -1,75 +1,272 @@
 from fastapi import WebSocket
-from typing import Dict, List
-import json
+from typing import Callable, Dict, Iterable, List, Optional, Set
+from dotenv import load_dotenv
+from ..monitoring.metrics import COUNT_BUCKETS, registry
+from ..monitoring.tracing import span
+from .backplane import Backplane, create_backplane
+from .connection import Connection, DROP_OLDEST
+from .frames import encode_frame
+from .replay import ReplayBuffer
+import os
+
+load_dotenv()
+
+# Backplane channels carrying "<target id>\n<json frame>" payloads; chat
+# frames of sequenced events carry "<chat id> <seq>" as the target
+CHAT_CHANNEL = "chat"
+USER_CHANNEL = "user"
+# Membership changes to apply to open sockets: "+<chat_id> <user_id> ..." or "-..."
+SUBSCRIPTION_CHANNEL = "subscription"
+
+fanout_recipients = registry.histogram(
+    "ws_fanout_recipients", "Sockets of this worker a chat frame was queued for", buckets=COUNT_BUCKETS
+)
+
+# Called with the connection and whether it is the user's first (or last) on this worker
+ConnectionListener = Callable[[Connection, bool], None]
 
 class ConnectionManager:
-    def __init__(self):
-        # Store active connections: {user_id: WebSocket}
-        self.active_connections: Dict[int, WebSocket] = {}
-        # Store chat rooms: {chat_id: List[user_id]}
-        self.chat_rooms: Dict[int, List[int]] = {}
-        # Store user's active chats: {user_id: List[chat_id]}
-        self.user_chats: Dict[int, List[int]] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: int):
+    def __init__(
+        self,
+        backplane: Optional[Backplane] = None,
+        send_queue_size: int = 256,
+        overflow_policy: str = DROP_OLDEST,
+        send_timeout: float = 10.0,
+        replay: Optional[ReplayBuffer] = None,
+    ):
+        # Store active connections: {user_id: {connection_id: Connection}}
+        self.active_connections: Dict[int, Dict[str, Connection]] = {}
+        # Store chat rooms: {chat_id: {user_id: number of the user's connections joined}};
+        # empty rooms are removed
+        self.chat_rooms: Dict[int, Dict[int, int]] = {}
+        # Store user's active chats: {user_id: Set[chat_id]}, the inverse of chat_rooms
+        self.user_chats: Dict[int, Set[int]] = {}
+        # Carries fan-out to sockets held by other workers
+        self.backplane = backplane or create_backplane(None)
+        self.backplane.subscribe(CHAT_CHANNEL, self._on_chat_frame)
+        self.backplane.subscribe(USER_CHANNEL, self._on_user_frame)
+        self.backplane.subscribe(SUBSCRIPTION_CHANNEL, self._on_subscription)
+        # Outbound queue settings applied to every new connection
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.dropped_frames = 0
+        self.slow_consumer_disconnects = 0
+        # Recent sequenced chat frames, replayed to clients that reconnect
+        self.replay = replay or ReplayBuffer()
+        self._connect_listeners: List[ConnectionListener] = []
+        self._disconnect_listeners: List[ConnectionListener] = []
+
+    def watch(self, on_connect: ConnectionListener, on_disconnect: ConnectionListener):
+        """Register callbacks run synchronously after every connect and disconnect"""
+        self._connect_listeners.append(on_connect)
+        self._disconnect_listeners.append(on_disconnect)
+
+    async def start(self):
+        await self.backplane.start()
+
+    async def stop(self):
+        await self.backplane.stop()
+
+    async def _publish(self, channel: str, target: bytes, frame: str):
+        await self.backplane.publish(channel, b"%s\n%s" % (target, frame.encode()))
+
+    async def _on_chat_frame(self, data: bytes):
+        target, frame = data.split(b"\n", 1)
+        chat_id, _, seq = target.partition(b" ")
+        frame = frame.decode()
+        if seq:
+            self.replay.record(int(chat_id), int(seq), frame)
+        await self._deliver_to_chat(int(chat_id), frame)
+
+    async def _on_user_frame(self, data: bytes):
+        user_id, frame = data.split(b"\n", 1)
+        await self._deliver_to_user(int(user_id), frame.decode())
+
+    def _count_drop(self, connection: Connection):
+        self.dropped_frames += 1
+
+    def _count_overflow(self, connection: Connection):
+        self.slow_consumer_disconnects += 1
+
+    async def connect(self, websocket: WebSocket, user_id: int, chat_ids: Iterable[int] = ()) -> Connection:
+        """Register one device of a user, joined to ``chat_ids``; a user may hold any number of connections"""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        if user_id not in self.user_chats:
-            self.user_chats[user_id] = []
+        connection = Connection(
+            websocket,
+            user_id,
+            max_queue=self.send_queue_size,
+            overflow_policy=self.overflow_policy,
+            send_timeout=self.send_timeout,
+            on_overflow=self._count_overflow,
+            on_drop=self._count_drop,
+        )
+        connection.start()
+        connections = self.active_connections.setdefault(user_id, {})
+        connections[connection.id] = connection
+        self.user_chats.setdefault(user_id, set())
+        for chat_id in chat_ids:
+            await self.join_chat(user_id, chat_id, connection)
+        for listener in self._connect_listeners:
+            listener(connection, len(connections) == 1)
+        return connection
 
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
+    async def disconnect(self, connection: Connection):
+        """Drop one connection once its writer has stopped; the user leaves rooms only with their last device"""
+        await connection.close()
+        user_id = connection.user_id
+        connections = self.active_connections.get(user_id)
+        if connections is None or connections.pop(connection.id, None) is None:
+            return
+        # Only the rooms this connection joined are touched
+        for chat_id in connection.chats:
+            self._release_room(user_id, chat_id)
+        if not connections:
             del self.active_connections[user_id]
+            self.user_chats.pop(user_id, None)
+        # Listeners still see the chats the connection was in
+        for listener in self._disconnect_listeners:
+            listener(connection, not connections)
+        connection.chats.clear()
+
+    def connections(self) -> List[Connection]:
+        return [c for conns in self.active_connections.values() for c in conns.values()]
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.active_connections
+
+    def _release_room(self, user_id: int, chat_id: int):
+        room = self.chat_rooms.get(chat_id)
+        if room is None or user_id not in room:
+            return
+        room[user_id] -= 1
+        if room[user_id] > 0:
+            return
+        del room[user_id]
+        if not room:
+            del self.chat_rooms[chat_id]
         if user_id in self.user_chats:
-            del self.user_chats[user_id]
-        # Remove user from all chat rooms
-        for chat_id in self.chat_rooms:
-            if user_id in self.chat_rooms[chat_id]:
-                self.chat_rooms[chat_id].remove(user_id)
-
-    async def join_chat(self, user_id: int, chat_id: int):
-        if chat_id not in self.chat_rooms:
-            self.chat_rooms[chat_id] = []
-        if user_id not in self.chat_rooms[chat_id]:
-            self.chat_rooms[chat_id].append(user_id)
-        if user_id not in self.user_chats:
-            self.user_chats[user_id] = []
-        if chat_id not in self.user_chats[user_id]:
-            self.user_chats[user_id].append(chat_id)
+            self.user_chats[user_id].discard(chat_id)
+
+    async def join_chat(self, user_id: int, chat_id: int, connection: Optional[Connection] = None):
+        """Join one connection to a chat, or every connection of the user if none is given"""
+        if connection is not None:
+            connections = [connection]
+        else:
+            connections = list(self.active_connections.get(user_id, {}).values())
+        for conn in connections:
+            if chat_id in conn.chats or conn.closed:
+                continue
+            conn.chats.add(chat_id)
+            room = self.chat_rooms.setdefault(chat_id, {})
+            room[user_id] = room.get(user_id, 0) + 1
+            self.user_chats.setdefault(user_id, set()).add(chat_id)
 
     async def leave_chat(self, user_id: int, chat_id: int):
-        if chat_id in self.chat_rooms and user_id in self.chat_rooms[chat_id]:
-            self.chat_rooms[chat_id].remove(user_id)
-        if user_id in self.user_chats and chat_id in self.user_chats[user_id]:
-            self.user_chats[user_id].remove(chat_id)
+        """Remove every connection of the user from a chat"""
+        for conn in self.active_connections.get(user_id, {}).values():
+            if chat_id in conn.chats:
+                conn.chats.discard(chat_id)
+                self._release_room(user_id, chat_id)
+
+    async def subscribe(self, chat_id: int, user_ids: Iterable[int]):
+        """Join every open socket of the users, on every worker, to a chat they were added to"""
+        await self._change_subscription(b"+", chat_id, list(user_ids))
+
+    async def unsubscribe(self, chat_id: int, user_ids: Iterable[int]):
+        """Stop delivering a chat to users who left it or lost access"""
+        await self._change_subscription(b"-", chat_id, list(user_ids))
+
+    async def _change_subscription(self, kind: bytes, chat_id: int, user_ids: List[int]):
+        if not user_ids:
+            return
+        await self._apply_subscription(kind, chat_id, user_ids)
+        payload = kind + b" ".join(b"%d" % target for target in [chat_id, *user_ids])
+        await self.backplane.publish(SUBSCRIPTION_CHANNEL, payload)
 
-    async def broadcast_to_chat(self, chat_id: int, message: dict):
-        if chat_id in self.chat_rooms:
-            for user_id in self.chat_rooms[chat_id]:
-                if user_id in self.active_connections:
-                    await self.active_connections[user_id].send_json(message)
+    async def _on_subscription(self, data: bytes):
+        chat_id, *user_ids = (int(value) for value in data[1:].split(b" "))
+        await self._apply_subscription(data[:1], chat_id, user_ids)
+
+    async def _apply_subscription(self, kind: bytes, chat_id: int, user_ids: List[int]):
+        for user_id in user_ids:
+            if kind == b"+":
+                await self.join_chat(user_id, chat_id)
+            else:
+                await self.leave_chat(user_id, chat_id)
+
+    async def _deliver_to_chat(self, chat_id: int, frame: str):
+        """Queue for the sockets of this worker that joined the chat; never waits on a client"""
+        recipients = 0
+        room = self.chat_rooms.get(chat_id)
+        if room:
+            for user_id in room:
+                for connection in self.active_connections.get(user_id, {}).values():
+                    connection.send(frame)
+                    recipients += 1
+        fanout_recipients.observe(recipients)
+
+    async def _deliver_to_user(self, user_id: int, frame: str):
+        for connection in self.active_connections.get(user_id, {}).values():
+            connection.send(frame)
+
+    async def broadcast_to_chat(self, chat_id: int, message: dict, seq: Optional[int] = None):
+        """Send to everyone in the chat; events with a seq are kept for replay"""
+        # Encoded once here; every local recipient and the backplane share the text
+        with span("broadcast"):
+            frame = encode_frame(message)
+            target = b"%d" % chat_id
+            if seq is not None:
+                self.replay.record(chat_id, seq, frame)
+                target += b" %d" % seq
+            await self._deliver_to_chat(chat_id, frame)
+            await self._publish(CHAT_CHANNEL, target, frame)
+
+    async def deliver_to_chat(self, chat_id: int, message: dict):
+        """Send to this worker's sockets in the chat only, for events every worker derives itself"""
+        await self._deliver_to_chat(chat_id, encode_frame(message))
 
     async def notify_chat_update(self, chat_id: int, update_type: str, chat_data: dict):
         """Notify all participants of a chat about updates"""
-        if chat_id in self.chat_rooms:
-            for user_id in self.chat_rooms[chat_id]:
-                if user_id in self.active_connections:
-                    await self.active_connections[user_id].send_json({
-                        "type": "chat_update",
-                        "update_type": update_type,
-                        "chat": chat_data
-                    })
+        await self.broadcast_to_chat(chat_id, {
+            "type": "chat_update",
+            "update_type": update_type,
+            "chat": chat_data
+        })
 
     async def notify_user_chats_update(self, user_id: int, chat_data: dict):
         """Notify a specific user about their chat list updates"""
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json({
-                "type": "chats_update",
-                "chat": chat_data
-            })
+        await self.send_personal_message({
+            "type": "chats_update",
+            "chat": chat_data
+        }, user_id)
 
     async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
+        frame = encode_frame(message)
+        await self._deliver_to_user(user_id, frame)
+        await self._publish(USER_CHANNEL, b"%d" % user_id, frame)
+
+    def metrics(self) -> dict:
+        depths = [c.depth for c in self.connections()]
+        return {
+            "users": len(self.active_connections),
+            "rooms": len(self.chat_rooms),
+            "connections": len(depths),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames,
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "replay_hits": self.replay.hits,
+            "replay_misses": self.replay.misses,
+        }
 
-manager = ConnectionManager() 
\ No newline at end of file
+manager = ConnectionManager(
+    create_backplane(os.getenv("WS_BACKPLANE_URL")),
+    send_queue_size=int(os.getenv("WS_SEND_QUEUE_SIZE", "256")),
+    overflow_policy=os.getenv("WS_OVERFLOW_POLICY", DROP_OLDEST),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "10")),
+    replay=ReplayBuffer(
+        per_chat=int(os.getenv("WS_REPLAY_BUFFER_SIZE", "256")),
+        max_chats=int(os.getenv("WS_REPLAY_MAX_CHATS", "10000")),
+    ),
+)
\ No newline at end of file
@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, select, update
+from ..auth.membership import membership
+from ..database import SessionLocal
+from ..models import models
+from .connection import Connection
+from .frames import encode_frame
+from .manager import ConnectionManager, manager
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Backplane channel carrying "+<user_id>@<node>" / "-<user_id>@<node>" transitions
+# of one worker, "!<node>" heartbeats, "?" asking every worker (or "?<node>" one
+# of them) to repeat the users it holds, and "=<user_id>@<node>" repeats
+PRESENCE_CHANNEL = "presence"
+
+# Coalesced heartbeats; never moves last_seen backwards
+LAST_SEEN_UPDATE = update(models.User.__table__).where(
+    (models.User.__table__.c.id == bindparam("user")) &
+    ((models.User.__table__.c.last_seen.is_(None)) | (models.User.__table__.c.last_seen < bindparam("seen")))
+).values(last_seen=bindparam("seen"))
+
+
+class Presence:
+    """Online state, last-seen times and typing indicators, kept in memory.
+
+    ``ConnectionManager`` reports each connect and disconnect. A user goes
+    online with their first socket on any worker and offline ``offline_grace``
+    seconds after their last one closes, so a page reload does not flap.
+    Transitions are pushed as one ``presence`` frame per chat of the subject;
+    workers learn each other's users over the backplane. Every worker sends a
+    heartbeat each ``node_ttl / 3`` seconds, and the users of one not heard
+    from for ``node_ttl`` seconds are taken offline. Heartbeats from clients
+    only stamp ``last_seen`` in memory and a background task writes all of
+    them every ``flush_interval`` seconds in one executemany. Typing
+    indicators are rate limited and never stored.
+    """
+
+    def __init__(
+        self,
+        connections: ConnectionManager,
+        session_factory=SessionLocal,
+        flush_interval: float = 30.0,
+        offline_grace: float = 5.0,
+        typing_interval: float = 2.0,
+        node_ttl: float = 30.0,
+    ):
+        self.connections = connections
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.offline_grace = offline_grace
+        self.typing_interval = typing_interval
+        self.node_ttl = node_ttl
+        # Users with sockets on other workers: {user_id: {node_id}}
+        self._remote: Dict[int, Set[bytes]] = {}
+        # When each other worker was last heard from
+        self._nodes: Dict[bytes, float] = {}
+        # Users announced online by this worker, and their pending offline timers
+        self._online: Set[int] = set()
+        self._going_offline: Dict[int, asyncio.TimerHandle] = {}
+        # Chats of the sockets closed since a user's last connect, told when they go offline
+        self._chats: Dict[int, Set[int]] = {}
+        self._last_seen: Dict[int, datetime] = {}
+        self._dirty: Set[int] = set()
+        self._typing: Dict[Tuple[int, int], float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.flushed_last_seen = 0
+        self.evicted_nodes = 0
+        connections.watch(self._on_connect, self._on_disconnect)
+        connections.backplane.subscribe(PRESENCE_CHANNEL, self._on_presence)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._heartbeat_task = asyncio.create_task(self._beat())
+        # Learn who is already connected to the other workers
+        await self._publish(b"?")
+
+    async def stop(self):
+        tasks = [task for task in (self._task, self._heartbeat_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._heartbeat_task = None
+        for handle in self._going_offline.values():
+            handle.cancel()
+        self._going_offline.clear()
+        self._chats.clear()
+        for user_id in self._online:
+            self._stamp(user_id)
+        await self.flush()
+
+    @property
+    def announced(self) -> int:
+        """Users this worker has announced online, including those in their grace period"""
+        return len(self._online)
+
+    def is_online(self, user_id: int) -> bool:
+        return self.connections.is_online(user_id) or bool(self._remote.get(user_id))
+
+    def last_seen(self, user_id: int) -> Optional[datetime]:
+        return self._last_seen.get(user_id)
+
+    def heartbeat(self, user_id: int):
+        self._stamp(user_id)
+
+    def typing(self, user_id: int, chat_id: int) -> bool:
+        """Whether a typing event may be relayed; at most one per ``typing_interval``"""
+        now = time.monotonic()
+        key = (user_id, chat_id)
+        if now - self._typing.get(key, float("-inf")) < self.typing_interval:
+            return False
+        self._typing[key] = now
+        return True
+
+    def _stamp(self, user_id: int):
+        self._last_seen[user_id] = datetime.utcnow()
+        self._dirty.add(user_id)
+
+    async def _publish(self, data: bytes):
+        await self.connections.backplane.publish(PRESENCE_CHANNEL, data)
+
+    async def _announce(self, kind: bytes, user_id: int):
+        await self._publish(kind + b"%d@" % user_id + self.connections.backplane.node_id)
+
+    def _on_connect(self, connection: Connection, first: bool):
+        user_id = connection.user_id
+        self._stamp(user_id)
+        pending = self._going_offline.pop(user_id, None)
+        if pending is not None:
+            pending.cancel()
+        self._chats.pop(user_id, None)
+        asyncio.ensure_future(self._connected(connection, announce=user_id not in self._online))
+        self._online.add(user_id)
+
+    def _on_disconnect(self, connection: Connection, last: bool):
+        user_id = connection.user_id
+        self._stamp(user_id)
+        if user_id in self._online:
+            self._chats.setdefault(user_id, set()).update(connection.chats)
+        if last and user_id in self._online:
+            self._going_offline[user_id] = asyncio.get_running_loop().call_later(
+                self.offline_grace, lambda: asyncio.ensure_future(self._went_offline(user_id))
+            )
+
+    async def _connected(self, connection: Connection, announce: bool):
+        user_id = connection.user_id
+        chat_ids = set(connection.chats)
+        try:
+            was_online = bool(self._remote.get(user_id))
+            if announce:
+                await self._announce(b"+", user_id)
+            async with self.session_factory() as db:
+                participants = await membership.participants(db, chat_ids)
+            co_members = {other for user_ids in participants.values() for other in user_ids} - {user_id}
+            # The new socket learns who of its contacts is online right now
+            connection.send(encode_frame({
+                "type": "presence_snapshot",
+                "users": [self._state(other, True) for other in co_members if self.is_online(other)],
+            }))
+            if announce and not was_online:
+                await self._notify(chat_ids, self._state(user_id, True))
+        except Exception:
+            logger.exception("Announcing presence of user %d failed", user_id)
+
+    async def _went_offline(self, user_id: int):
+        self._going_offline.pop(user_id, None)
+        if self.connections.is_online(user_id) or user_id not in self._online:
+            return
+        # Taken now: once out of _online the prune may forget last_seen at any await
+        state = self._state(user_id, False)
+        self._online.discard(user_id)
+        chat_ids = self._chats.pop(user_id, set())
+        try:
+            await self._announce(b"-", user_id)
+            if self._remote.get(user_id):
+                return
+            await self._notify(chat_ids, state)
+        except Exception:
+            logger.exception("Announcing absence of user %d failed", user_id)
+
+    def _state(self, user_id: int, online: bool) -> dict:
+        seen = self._last_seen.get(user_id)
+        return {"user_id": user_id, "online": online, "last_seen": seen.isoformat() if seen else None}
+
+    async def _notify(self, chat_ids: Iterable[int], state: dict):
+        # One frame per chat; only sockets that joined it receive the delta
+        frame = {"type": "presence", **state}
+        for chat_id in chat_ids:
+            await self.connections.broadcast_to_chat(chat_id, frame)
+
+    async def _notify_here(self, states: Dict[int, dict]):
+        """Deliver states only this worker derived, such as those of an evicted node, to its own sockets"""
+        if not states or not self.connections.chat_rooms:
+            return
+        async with self.session_factory() as db:
+            rows = (await db.execute(
+                select(models.user_chat.c.chat_id, models.user_chat.c.user_id)
+                .where(models.user_chat.c.user_id.in_(list(states)))
+            )).all()
+        for chat_id, user_id in rows:
+            if chat_id in self.connections.chat_rooms:
+                await self.connections.deliver_to_chat(chat_id, {"type": "presence", **states[user_id]})
+
+    async def _on_presence(self, data: bytes):
+        # The node id rides along so a repeated "+" is idempotent
+        kind, payload = data[:1], data[1:]
+        if kind == b"?":
+            if not payload or payload == self.connections.backplane.node_id:
+                for user_id in list(self._online):
+                    await self._announce(b"=", user_id)
+            return
+        if kind == b"!":
+            if payload not in self._nodes:
+                # New, or evicted while it was still alive: it repeats its users
+                await self._publish(b"?" + payload)
+            self._nodes[payload] = time.monotonic()
+            return
+        user_id_text, _, node = payload.partition(b"@")
+        user_id = int(user_id_text)
+        self._nodes[node] = time.monotonic()
+        was_online = self.is_online(user_id)
+        nodes = self._remote.setdefault(user_id, set())
+        if kind == b"-":
+            nodes.discard(node)
+            if not nodes:
+                del self._remote[user_id]
+            return
+        nodes.add(node)
+        if kind == b"=" and not was_online:
+            # A repeat is not broadcast to the chats by its worker, unlike a "+"
+            await self._notify_here({user_id: self._state(user_id, True)})
+
+    def _evict(self, node: bytes):
+        """Forget a worker that stopped reporting; returns the users it took offline"""
+        del self._nodes[node]
+        gone = []
+        for user_id, nodes in list(self._remote.items()):
+            nodes.discard(node)
+            if not nodes:
+                del self._remote[user_id]
+                if not self.connections.is_online(user_id):
+                    gone.append(user_id)
+        return gone
+
+    async def _beat(self):
+        while True:
+            try:
+                await self._publish(b"!" + self.connections.backplane.node_id)
+                cutoff = time.monotonic() - self.node_ttl
+                gone = []
+                for node in [n for n, at in self._nodes.items() if at < cutoff]:
+                    logger.warning("Presence: worker %s stopped reporting; its users are offline", node.decode())
+                    gone += self._evict(node)
+                    self.evicted_nodes += 1
+                await self._notify_here({user_id: self._state(user_id, False) for user_id in gone})
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+            await asyncio.sleep(self.node_ttl / 3)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch = {user_id: self._last_seen[user_id] for user_id in self._dirty}
+        self._dirty = set()
+        try:
+            async with self.session_factory() as db:
+                await db.execute(LAST_SEEN_UPDATE, [
+                    {"user": user_id, "seen": seen} for user_id, seen in batch.items()
+                ])
+                await db.commit()
+        except Exception:
+            logger.exception("Saving last_seen of %d users failed; retrying", len(batch))
+            self._dirty.update(batch)
+            return
+        self.flushed_last_seen += len(batch)
+
+    def _prune(self):
+        # Offline users and expired typing windows would otherwise accumulate;
+        # users in their offline grace period are still in _online
+        keep = self._dirty | self._online
+        for user_id in [u for u in self._last_seen if u not in keep and not self.is_online(u)]:
+            del self._last_seen[user_id]
+        cutoff = time.monotonic() - self.typing_interval
+        for key in [k for k, at in self._typing.items() if at < cutoff]:
+            del self._typing[key]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Connected users count as seen even if their client sends no pings
+            for user_id in self.connections.active_connections:
+                self._stamp(user_id)
+            await self.flush()
+            self._prune()
+
+
+presence = Presence(
+    manager,
+    flush_interval=float(os.getenv("PRESENCE_FLUSH_INTERVAL", "30")),
+    offline_grace=float(os.getenv("PRESENCE_OFFLINE_GRACE", "5")),
+    typing_interval=float(os.getenv("TYPING_MIN_INTERVAL", "2")),
+    node_ttl=float(os.getenv("PRESENCE_NODE_TTL", "30")),
+)
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, update
+from ..database import SessionLocal
+from ..models import models
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Moves a cursor forward only; a late, older "read" never un-reads messages
+READ_CURSOR_UPDATE = update(models.user_chat).where(
+    (models.user_chat.c.user_id == bindparam("user")) &
+    (models.user_chat.c.chat_id == bindparam("chat")) &
+    (models.user_chat.c.last_read_message_id < bindparam("message"))
+).values(last_read_message_id=bindparam("message"))
+
+
+class ReadCursors:
+    """Per-(user, chat) last read message ids, written in batches.
+
+    Clients report reads far more often than anyone needs them persisted, so
+    ``advance`` only records the highest id in memory and a background task
+    writes all of them every ``flush_interval`` seconds in one executemany.
+    A crash loses at most that interval of read progress.
+    """
+
+    def __init__(self, session_factory=SessionLocal, flush_interval: float = 1.0):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushed_cursors = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def advance(self, user_id: int, chat_id: int, message_id: int) -> bool:
+        """Record a read; False if an equal or later one is already pending"""
+        key = (user_id, chat_id)
+        if self._pending.get(key, 0) >= message_id:
+            return False
+        self._pending[key] = message_id
+        return True
+
+    def has_pending(self, user_id: int) -> bool:
+        return any(key[0] == user_id for key in self._pending)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            async with self.session_factory() as db:
+                await db.execute(READ_CURSOR_UPDATE, [
+                    {"user": user_id, "chat": chat_id, "message": message_id}
+                    for (user_id, chat_id), message_id in batch.items()
+                ])
+                await db.commit()
+        except Exception:
+            logger.exception("Saving %d read cursors failed; retrying", len(batch))
+            for key, message_id in batch.items():
+                if self._pending.get(key, 0) < message_id:
+                    self._pending[key] = message_id
+            return
+        self.flushed_cursors += len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+read_cursors = ReadCursors(flush_interval=float(os.getenv("READ_CURSOR_FLUSH_INTERVAL", "1")))
@@ -0,0 +1,117 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from ..storage.signing import sign_url
+
+if TYPE_CHECKING:
+    # Annotations only: the connection manager imports this without a database
+    from ..models import models
+
+# Attachment fields sent only for messages that carry a file
+ATTACHMENT_FIELDS = (
+    "file_url", "filetype", "filename", "file_size",
+    "thumbnail_url", "blurhash", "media_width", "media_height",
+)
+
+
+def message_event(message: "models.Message", username: str) -> dict:
+    """The ``message`` frame of a chat message, live or replayed"""
+    data = {
+        "id": message.id,
+        "seq": message.seq,
+        "content": message.content,
+        "created_at": message.timestamp.isoformat(),
+        "sender_id": message.sender_id,
+        "chat_id": message.chat_id,
+        "sender": {"id": message.sender_id, "username": username},
+    }
+    if message.file_url:
+        for field in ATTACHMENT_FIELDS:
+            data[field] = getattr(message, field)
+        data["file_url"] = sign_url(data["file_url"])
+        data["thumbnail_url"] = sign_url(data["thumbnail_url"])
+    return {"type": "message", "message": data}
+
+
+class ChatLog:
+    """Frames of one chat ordered by seq, all above ``floor``.
+
+    Seqs can be missing: the backplane drops frames while Redis is
+    disconnected or a local socket is full, and frames relayed by other
+    workers may arrive slightly out of order.
+    """
+
+    def __init__(self, floor: int):
+        self.floor = floor
+        self.seqs: List[int] = []
+        self.frames: List[str] = []
+
+    def add(self, seq: int, frame: str, capacity: int):
+        if seq <= self.floor:
+            return
+        i = bisect_left(self.seqs, seq)
+        if i < len(self.seqs) and self.seqs[i] == seq:
+            return
+        self.seqs.insert(i, seq)
+        self.frames.insert(i, frame)
+        if len(self.seqs) > capacity:
+            self.floor = self.seqs[0]
+            del self.seqs[0], self.frames[0]
+
+    def after(self, seq: int) -> List[Tuple[int, str]]:
+        i = bisect_right(self.seqs, seq)
+        return list(zip(self.seqs[i:], self.frames[i:]))
+
+    def complete_after(self, seq: int) -> bool:
+        """Whether every frame after ``seq`` up to the newest one is here"""
+        if seq < self.floor:
+            return False
+        i = bisect_right(self.seqs, seq)
+        if i == len(self.seqs):
+            return True
+        # Distinct sorted seqs run without a gap iff they span exactly their count
+        return self.seqs[i] == seq + 1 and self.seqs[-1] - self.seqs[i] == len(self.seqs) - 1 - i
+
+
+class ReplayBuffer:
+    """Bounded in-memory log of recent sequenced frames per chat.
+
+    Every worker records the frames it delivers, including those relayed by
+    the backplane, so a client reconnecting to any worker can be sent what it
+    missed without touching the database. A chat keeps its newest
+    ``per_chat`` frames and the ``max_chats`` most recently active chats are
+    kept. Anything older, or a stretch with a frame this worker never got,
+    is answered from the database.
+    """
+
+    def __init__(self, per_chat: int = 256, max_chats: int = 10_000):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, ChatLog]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, chat_id: int, seq: int, frame: str):
+        log = self._chats.get(chat_id)
+        if log is None:
+            # Nothing before the first frame seen here is known to be complete
+            log = self._chats[chat_id] = ChatLog(seq - 1)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        log.add(seq, frame, self.per_chat)
+
+    def since(self, chat_id: int, last_seq: int) -> Optional[List[str]]:
+        """Frames after ``last_seq``, or None if the buffer cannot vouch for all of them"""
+        log = self._chats.get(chat_id)
+        if log is None or not log.complete_after(last_seq):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [frame for _, frame in log.after(last_seq)]
+
+    def recent(self, chat_id: int, last_seq: int) -> Dict[int, str]:
+        """Whatever is buffered after ``last_seq``, complete or not"""
+        log = self._chats.get(chat_id)
+        return dict(log.after(last_seq)) if log is not None else {}
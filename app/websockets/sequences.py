@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from typing import Dict, List, Set
+from sqlalchemy import bindparam, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import SessionLocal
+from ..models import models
+
+logger = logging.getLogger(__name__)
+
+chats = models.Chat.__table__
+
+# Reserves ``count`` sequence numbers of a chat; the row lock orders concurrent writers
+NEXT_SEQ = (
+    update(chats)
+    .where(chats.c.id == bindparam("chat"))
+    .values(last_seq=chats.c.last_seq + bindparam("count"))
+    .returning(chats.c.last_seq)
+)
+
+
+async def next_seq(db: AsyncSession, chat_id: int, count: int = 1) -> int:
+    """Reserve sequence numbers in the caller's transaction; returns the last one"""
+    seq = await db.scalar(NEXT_SEQ, {"chat": chat_id, "count": count})
+    if seq is None:
+        raise LookupError(f"Chat {chat_id} does not exist")
+    return seq
+
+
+class ChatSequences:
+    """Per-chat sequence numbers for messages written behind.
+
+    Each allocation is a short committed UPDATE ... RETURNING, so numbers are
+    unique across workers. Requests for a chat that arrive while its
+    allocation is in flight wait and are served together by the next one,
+    which keeps a busy chat at one round trip per batch instead of per
+    message.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._waiting: Dict[int, List[asyncio.Future]] = {}
+        self._allocating: Set[int] = set()
+
+    async def next(self, chat_id: int) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(chat_id, []).append(future)
+        if chat_id not in self._allocating:
+            self._allocating.add(chat_id)
+            asyncio.ensure_future(self._allocate(chat_id))
+        return await future
+
+    async def _allocate(self, chat_id: int):
+        try:
+            while self._waiting.get(chat_id):
+                futures = self._waiting.pop(chat_id)
+                try:
+                    async with self.session_factory() as db:
+                        last = await next_seq(db, chat_id, len(futures))
+                        await db.commit()
+                except Exception as e:
+                    logger.warning("Reserving %d sequence numbers of chat %d failed: %s", len(futures), chat_id, e)
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                # Handed out in arrival order
+                for seq, future in zip(range(last - len(futures) + 1, last + 1), futures):
+                    if not future.done():
+                        future.set_result(seq)
+        finally:
+            self._allocating.discard(chat_id)
+
+
+sequences = ChatSequences()
@@ -0,0 +1,74 @@
+"""CPU cost of one chat broadcast as the room grows.
+
+Compares encoding the frame once per recipient (what ``send_json`` per socket
+did) with ``ConnectionManager.broadcast_to_chat``, which encodes once and
+queues the same text for every recipient.
+
+    python -m benchmarks.broadcast_encoding
+"""
+import asyncio
+import json
+import time
+
+from app.websockets.frames import orjson
+from app.websockets.manager import ConnectionManager
+
+ROOM_SIZES = (10, 100, 1000, 2000)
+MESSAGES = 200
+
+FRAME = {
+    "type": "message",
+    "message": {
+        "id": 123456,
+        "content": "Hey everyone, the deploy went out and the dashboards look healthy",
+        "created_at": "2024-05-01T12:00:00.000000",
+        "sender_id": 42,
+        "chat_id": 7,
+        "sender": {"username": "alice"},
+    },
+}
+
+
+class NullWebSocket:
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+
+def per_recipient(room_size: int) -> float:
+    start = time.process_time()
+    for _ in range(MESSAGES):
+        for _ in range(room_size):
+            json.dumps(FRAME, separators=(",", ":"))
+    return (time.process_time() - start) / MESSAGES
+
+
+async def encode_once(room_size: int) -> float:
+    manager = ConnectionManager(send_queue_size=MESSAGES + 1)
+    connections = []
+    for user_id in range(room_size):
+        connection = await manager.connect(NullWebSocket(), user_id)
+        await manager.join_chat(user_id, 1, connection)
+        connections.append(connection)
+    start = time.process_time()
+    for _ in range(MESSAGES):
+        await manager.broadcast_to_chat(1, FRAME)
+    elapsed = (time.process_time() - start) / MESSAGES
+    for connection in connections:
+        await manager.disconnect(connection)
+    return elapsed
+
+
+async def main():
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'room':>6} {'per-recipient us':>18} {'encode-once us':>16} {'speedup':>8}")
+    for room_size in ROOM_SIZES:
+        before = per_recipient(room_size)
+        after = await encode_once(room_size)
+        print(f"{room_size:>6} {before * 1e6:>18.1f} {after * 1e6:>16.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""Helpers shared by the benchmarks that drive a running server."""
+import json
+import os
+import urllib.parse
+import urllib.request
+
+from alembic import command
+from alembic.config import Config
+
+PASSWORD = "bench-password"
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "alembic.ini")
+
+
+def migrate():
+    """Bring the database named by DATABASE_URL to the latest revision; the app no longer creates tables"""
+    command.upgrade(Config(ALEMBIC_INI), "head")
+
+
+def request(url: str, data=None, token: str = None, form: bool = False):
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    body = None
+    if data is not None:
+        if form:
+            body = urllib.parse.urlencode(data).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        else:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=body, headers=headers)
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def login(base_url: str, username: str) -> str:
+    token = request(f"{base_url}/token", {"username": username, "password": PASSWORD}, form=True)
+    return token["access_token"]
+
+
+def register(base_url: str, prefix: str, index: int):
+    """Create ``<prefix><index>`` and return (user id, access token)"""
+    username = f"{prefix}{index}"
+    user = request(f"{base_url}/users/", {
+        "username": username,
+        "email": f"{username}@bench.example.com",
+        "password": PASSWORD,
+    })
+    return user["id"], login(base_url, username)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
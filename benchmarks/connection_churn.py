@@ -0,0 +1,73 @@
+"""Connection churn in ConnectionManager: a mass reconnect after a deploy.
+
+Connects N users who each join a handful of rooms, then disconnects and
+reconnects all of them, reporting the cost per operation. Disconnect only
+touches the rooms a user joined, so the per-disconnect cost stays flat as
+the number of rooms grows.
+
+    python -m benchmarks.connection_churn [connections] [rooms]
+"""
+import asyncio
+import random
+import sys
+import time
+
+from app.websockets.manager import ConnectionManager
+
+ROOMS_PER_USER = 5
+
+
+class NullWebSocket:
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+async def connect_all(manager: ConnectionManager, memberships):
+    connections = []
+    for user_id, chat_ids in memberships.items():
+        connection = await manager.connect(NullWebSocket(), user_id)
+        for chat_id in chat_ids:
+            await manager.join_chat(user_id, chat_id, connection)
+        connections.append(connection)
+    return connections
+
+
+async def disconnect_all(manager: ConnectionManager, connections):
+    for connection in connections:
+        await manager.disconnect(connection)
+
+
+async def main(connections: int, rooms: int):
+    rng = random.Random(0)
+    memberships = {
+        user_id: rng.sample(range(rooms), ROOMS_PER_USER)
+        for user_id in range(connections)
+    }
+    manager = ConnectionManager()
+    joins = connections * ROOMS_PER_USER
+    print(f"{connections} connections, {rooms} rooms, {ROOMS_PER_USER} rooms per user")
+    for round_no in range(2):
+        start = time.perf_counter()
+        sockets = await connect_all(manager, memberships)
+        connected = time.perf_counter() - start
+        start = time.perf_counter()
+        await disconnect_all(manager, sockets)
+        disconnected = time.perf_counter() - start
+        print(
+            f"round {round_no + 1}: connect+join {connected:.2f}s "
+            f"({connected / joins * 1e6:.1f} us/join), "
+            f"disconnect {disconnected:.2f}s ({disconnected / connections * 1e6:.1f} us/disconnect), "
+            f"rooms left {len(manager.chat_rooms)}"
+        )
+
+
+if __name__ == "__main__":
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    asyncio.run(main(connections, rooms))
@@ -0,0 +1,89 @@
+"""Login throughput and event-loop responsiveness during a login storm.
+
+Registers ``--users`` accounts against a running server, then has
+``--concurrency`` clients log in ``--logins`` times in total while one
+WebSocket client sends a ping every ``--ping-interval`` seconds. Password
+hashing that blocks the event loop shows up as a long tail on the ping
+round trips; login throughput and latency percentiles are printed too.
+
+    uvicorn app.main:app --workers 1 &
+    python -m benchmarks.login_storm --users 20 --concurrency 32 --logins 500
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from urllib.error import HTTPError
+
+import websockets
+
+from benchmarks.common import login, percentile, register
+
+
+async def main(args):
+    prefix = f"storm{uuid.uuid4().hex[:6]}_"
+    users = await asyncio.gather(*[
+        asyncio.to_thread(register, args.base_url, prefix, i) for i in range(args.users)
+    ])
+    pinger_token = users[0][1]
+    ws_url = args.base_url.replace("http", "ws", 1)
+
+    login_latencies = []
+    ping_latencies = []
+    rejected = 0
+    remaining = iter(range(args.logins))
+    done = asyncio.Event()
+
+    async def ping():
+        async with websockets.connect(f"{ws_url}/ws?token={pinger_token}") as ws:
+            while not done.is_set():
+                sent = time.perf_counter()
+                await ws.send(json.dumps({"type": "ping"}))
+                while json.loads(await ws.recv()).get("type") != "pong":
+                    pass
+                ping_latencies.append(time.perf_counter() - sent)
+                await asyncio.sleep(args.ping_interval)
+
+    async def storm():
+        nonlocal rejected
+        for n in remaining:
+            username = f"{prefix}{n % args.users}"
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(login, args.base_url, username)
+            except HTTPError as e:
+                # 503 means the hashing queue was full; anything else is a real failure
+                if e.code != 503:
+                    raise
+                rejected += 1
+                continue
+            login_latencies.append(time.perf_counter() - started)
+
+    pinger = asyncio.create_task(ping())
+    await asyncio.sleep(args.ping_interval * 5)
+    baseline = len(ping_latencies)
+    start = time.perf_counter()
+    await asyncio.gather(*[storm() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await pinger
+
+    print(f"concurrency={args.concurrency} logins={len(login_latencies)} rejected={rejected} "
+          f"elapsed={elapsed:.2f}s throughput={len(login_latencies) / elapsed:.1f} logins/s")
+    for pct in (50, 95, 99):
+        print(f"login p{pct}: {percentile(login_latencies, pct) * 1000:.1f} ms")
+    during = ping_latencies[baseline:] or ping_latencies
+    for pct in (50, 95, 99):
+        print(f"ping p{pct}: {percentile(during, pct) * 1000:.1f} ms")
+    print(f"ping max: {max(during) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--ping-interval", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
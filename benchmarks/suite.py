@@ -0,0 +1,425 @@
+"""End-to-end benchmark suite: REST latency, query counts and WebSocket fan-out.
+
+Seeds ``--users`` users, ``--chats`` group chats of ``--members`` each and
+``--messages`` messages per chat straight into the database named by
+DATABASE_URL (a throwaway SQLite file when unset), serves the app with
+uvicorn on a background thread and drives it over real HTTP and WebSocket
+connections from this one:
+
+* every REST endpoint in ``ENDPOINTS`` is called sequentially to count the
+  SQL statements it executes, then concurrently to measure latency;
+* ``--clients`` WebSockets connect, ``--senders`` of them send
+  ``--ws-messages`` messages each, and every receiver records the
+  send-to-receive latency of each broadcast.
+
+The results are one JSON document (``--output``, default stdout) so runs
+can be stored and compared; a short summary goes to stderr. Clients and
+server share one process, so absolute latencies are pessimistic: compare
+runs made with the same parameters on the same machine.
+
+    python -m benchmarks.suite --users 2000 --chats 200 --clients 2000 --output run.json
+    DATABASE_URL=postgresql://user:pw@localhost/bench python -m benchmarks.suite
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+
+_work_dir = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_work_dir}/suite.db")
+os.environ.setdefault("SECRET_KEY", "benchmark-suite")
+os.environ.setdefault("STORAGE_URL", os.path.join(_work_dir, "uploads"))
+os.environ.setdefault("MEDIA_PREVIEWS", "false")
+# Every receiver must get every broadcast for the latency numbers to mean anything
+os.environ.setdefault("WS_SEND_QUEUE_SIZE", "100000")
+
+import uvicorn
+import websockets
+from sqlalchemy import bindparam, event, func, insert, select, update
+
+from app.auth import auth
+from app.database import SessionLocal, engine
+from app.main import app
+from app.models import models
+from app.websockets.manager import manager
+from benchmarks.common import PASSWORD, migrate, percentile
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima "
+    "mike november oscar papa quebec romeo sierra tango uniform victor whiskey"
+).split()
+INSERT_BATCH = 5000
+
+
+class ServerThread(threading.Thread):
+    """uvicorn with its own event loop, so the clients do not share one with the app"""
+
+    def __init__(self, port: int):
+        super().__init__(daemon=True)
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.loop = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    def start_and_wait(self):
+        self.start()
+        while not self.server.started:
+            if not self.is_alive():
+                raise RuntimeError("Server failed to start")
+            time.sleep(0.05)
+
+    def call(self, coroutine):
+        """Run a coroutine on the server's loop, where the engine's connections live"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def summarize(samples) -> dict:
+    """Latency percentiles in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    # Each in-process WebSocket costs two descriptors: the client's and the server's
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def seed(args, rng: random.Random) -> dict:
+    """Bulk-insert the data set; returns ids, memberships and tokens"""
+    prefix = f"suite{uuid.uuid4().hex[:6]}_"
+    hashed = auth.get_password_hash(PASSWORD)
+    users_table = models.User.__table__
+    chats_table = models.Chat.__table__
+    messages_table = models.Message.__table__
+    async with SessionLocal() as db:
+        await db.execute(insert(users_table), [
+            {"username": f"{prefix}{i}", "email": f"{prefix}{i}@bench.example.com",
+             "hashed_password": hashed, "is_active": True}
+            for i in range(args.users)
+        ])
+        user_ids = list(await db.scalars(
+            select(users_table.c.id).where(users_table.c.username.like(f"{prefix}%")).order_by(users_table.c.id)
+        ))
+        chat_ids = list(await db.scalars(
+            insert(chats_table).returning(chats_table.c.id, sort_by_parameter_order=True),
+            [{"name": f"{prefix}chat{n}", "is_group": True, "last_seq": 0} for n in range(args.chats)],
+        ))
+        members = {chat_id: rng.sample(user_ids, min(args.members, len(user_ids))) for chat_id in chat_ids}
+        await db.execute(insert(models.user_chat), [
+            {"user_id": user_id, "chat_id": chat_id}
+            for chat_id, chat_members in members.items() for user_id in chat_members
+        ])
+        start = datetime.utcnow() - timedelta(days=1)
+        rows = [
+            {"chat_id": chat_id, "sender_id": rng.choice(chat_members), "seq": seq, "is_read": False,
+             "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 8))),
+             "timestamp": start + timedelta(seconds=seq)}
+            for chat_id, chat_members in members.items() for seq in range(1, args.messages + 1)
+        ]
+        for i in range(0, len(rows), INSERT_BATCH):
+            await db.execute(insert(messages_table), rows[i:i + INSERT_BATCH])
+        last_ids = (await db.execute(
+            select(messages_table.c.chat_id, func.max(messages_table.c.id))
+            .where(messages_table.c.chat_id.in_(chat_ids)).group_by(messages_table.c.chat_id)
+        )).all()
+        if last_ids:
+            await db.execute(
+                update(chats_table).where(chats_table.c.id == bindparam("chat"))
+                .values(last_message_id=bindparam("message"), last_seq=args.messages),
+                [{"chat": chat_id, "message": message_id} for chat_id, message_id in last_ids],
+            )
+        await db.commit()
+    tokens = {
+        user_id: auth.create_access_token({"sub": f"{prefix}{i}", "uid": user_id}, timedelta(hours=2))
+        for i, user_id in enumerate(user_ids)
+    }
+    chats_of = {}
+    for chat_id, chat_members in members.items():
+        for user_id in chat_members:
+            chats_of.setdefault(user_id, []).append(chat_id)
+    return {"prefix": prefix, "user_ids": user_ids, "members": members, "chats_of": chats_of, "tokens": tokens}
+
+
+def http(base_url: str, method: str, path: str, token: str, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method, headers={
+        "Authorization": f"Bearer {token}", "Content-Type": "application/json",
+    })
+    try:
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+# name -> (method, path, body) for a member (user id, chat id, word)
+ENDPOINTS = {
+    "GET /chats/": lambda u, c, w: ("GET", "/chats/", None),
+    "GET /chats/{id}": lambda u, c, w: ("GET", f"/chats/{c}", None),
+    "GET /chats/{id}/messages/": lambda u, c, w: ("GET", f"/chats/{c}/messages/", None),
+    "POST /chats/{id}/messages/": lambda u, c, w: ("POST", f"/chats/{c}/messages/", {"content": w, "chat_id": c}),
+    "GET /search/messages": lambda u, c, w: ("GET", f"/search/messages?q={w}", None),
+    "GET /users/search/": lambda u, c, w: ("GET", f"/users/search/?query={w[:2]}", None),
+}
+
+
+async def bench_rest(args, base_url: str, data: dict, counter: StatementCounter, rng: random.Random) -> dict:
+    pairs = [(user_id, chat_id) for chat_id, chat_members in data["members"].items() for user_id in chat_members]
+    results = {}
+    for name, build in ENDPOINTS.items():
+        def call():
+            user_id, chat_id = rng.choice(pairs)
+            method, path, body = build(user_id, chat_id, rng.choice(WORDS))
+            return http(base_url, method, path, data["tokens"][user_id], body)
+
+        # Sequential, so every statement counted belongs to this request
+        statements = []
+        for _ in range(args.query_samples):
+            before = counter.count
+            await asyncio.to_thread(call)
+            statements.append(counter.count - before)
+
+        latencies = []
+        errors = 0
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def timed():
+            nonlocal errors
+            async with slots:
+                started = time.perf_counter()
+                status = await asyncio.to_thread(call)
+                latencies.append(time.perf_counter() - started)
+                errors += status >= 400
+
+        started = time.perf_counter()
+        await asyncio.gather(*(timed() for _ in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            **summarize(latencies),
+            "errors": errors,
+            "requests_per_s": round(args.requests / elapsed, 1),
+            "statements_median": sorted(statements)[len(statements) // 2] if statements else None,
+            "statements_max": max(statements, default=None),
+        }
+        print(f"  {name:<28} p50={results[name]['p50_ms']}ms p99={results[name]['p99_ms']}ms "
+              f"statements={results[name]['statements_median']}", file=sys.stderr)
+    return results
+
+
+async def bench_websocket(args, ws_url: str, data: dict, counter: StatementCounter, server: ServerThread) -> dict:
+    users = [user_id for user_id in data["user_ids"] if user_id in data["chats_of"]]
+    if not users:
+        return {}
+    client_users = [users[i % len(users)] for i in range(args.clients)]
+    subscribers = {}
+    for user_id in client_users:
+        for chat_id in data["chats_of"][user_id]:
+            subscribers[chat_id] = subscribers.get(chat_id, 0) + 1
+
+    latencies = []
+    expected = 0
+    all_received = asyncio.Event()
+    connect_times = []
+    slots = asyncio.Semaphore(args.connect_concurrency)
+
+    def on_frame(text: str):
+        received = time.perf_counter()
+        frame = json.loads(text)
+        if frame.get("type") != "message":
+            return
+        content = frame["message"].get("content") or ""
+        if content.startswith("bench:"):
+            latencies.append(received - float(content.split(":", 2)[1]))
+            if expected and len(latencies) >= expected:
+                all_received.set()
+
+    async def connect(user_id: int):
+        async with slots:
+            started = time.perf_counter()
+            ws = await websockets.connect(f"{ws_url}/ws?token={data['tokens'][user_id]}", max_queue=None)
+            connect_times.append(time.perf_counter() - started)
+        return ws
+
+    async def receive(ws):
+        try:
+            async for text in ws:
+                on_frame(text)
+        except websockets.ConnectionClosed:
+            pass
+
+    sockets = await asyncio.gather(*(connect(user_id) for user_id in client_users))
+    readers = [asyncio.create_task(receive(ws)) for ws in sockets]
+    # Let the server finish subscribing and sending presence snapshots
+    await asyncio.sleep(1.0)
+
+    # Each sender cycles through its own chats
+    plan = [
+        (ws, [data["chats_of"][user_id][n % len(data["chats_of"][user_id])] for n in range(args.ws_messages)])
+        for user_id, ws in list(zip(client_users, sockets))[:args.senders]
+    ]
+    expected = sum(subscribers[chat_id] for _, chats in plan for chat_id in chats)
+    interval = 1.0 / args.rate if args.rate else 0.0
+
+    async def send(ws, chats):
+        for chat_id in chats:
+            await ws.send(json.dumps({
+                "type": "message", "chat_id": chat_id, "content": f"bench:{time.perf_counter()}:x",
+            }))
+            if interval:
+                await asyncio.sleep(interval)
+
+    statements_before = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*(send(ws, chats) for ws, chats in plan))
+    send_elapsed = time.perf_counter() - started
+    try:
+        await asyncio.wait_for(all_received.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    statements = counter.count - statements_before
+
+    async def read_metrics():
+        return manager.metrics()
+
+    # Read while the sockets are still open, so queue depths are meaningful
+    server_metrics = server.call(read_metrics())
+    for ws in sockets:
+        await ws.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    sent = sum(len(chats) for _, chats in plan)
+    return {
+        "clients": len(sockets),
+        "connect": summarize(connect_times),
+        "sent": sent,
+        "sent_per_s": round(sent / send_elapsed, 1) if send_elapsed else None,
+        "expected_deliveries": expected,
+        "delivered": len(latencies),
+        "deliveries_per_s": round(len(latencies) / elapsed, 1),
+        "latency": summarize(latencies),
+        "statements_per_message": round(statements / sent, 2) if sent else None,
+        "server": server_metrics,
+    }
+
+
+async def run(args) -> dict:
+    raise_fd_limit()
+    rng = random.Random(args.seed)
+    counter = StatementCounter()
+    port = free_port()
+    server = ServerThread(port)
+    server.start_and_wait()
+    try:
+        print(f"seeding {args.users} users, {args.chats} chats, {args.messages} messages/chat", file=sys.stderr)
+        started = time.perf_counter()
+        data = server.call(seed(args, rng))
+        seed_seconds = time.perf_counter() - started
+        print("REST", file=sys.stderr)
+        rest = await bench_rest(args, f"http://127.0.0.1:{port}", data, counter, rng)
+        print(f"WebSocket: {args.clients} clients, {args.senders} senders", file=sys.stderr)
+        fan_out = await bench_websocket(args, f"ws://127.0.0.1:{port}", data, counter, server)
+        if fan_out:
+            print(f"  delivered {fan_out['delivered']}/{fan_out['expected_deliveries']} "
+                  f"p50={fan_out['latency'].get('p50_ms')}ms p99={fan_out['latency'].get('p99_ms')}ms",
+                  file=sys.stderr)
+    finally:
+        server.stop()
+    return {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat() + "Z",
+            "commit": git_commit(),
+            "database": engine.dialect.name,
+            "python": platform.python_version(),
+            "parameters": vars(args),
+        },
+        "seed": {"seconds": round(seed_seconds, 3), "users": args.users, "chats": args.chats,
+                 "messages": args.chats * args.messages},
+        "rest": rest,
+        "websocket": fan_out,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--members", type=int, default=20, help="participants per chat")
+    parser.add_argument("--messages", type=int, default=200, help="seeded messages per chat")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per REST endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="REST requests in flight")
+    parser.add_argument("--query-samples", type=int, default=10, help="sequential requests counted per endpoint")
+    parser.add_argument("--clients", type=int, default=1000, help="WebSocket connections")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--ws-messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second per sender; 0 is unthrottled")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for deliveries")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    migrate()
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,92 @@
+"""Send-to-receive latency on the WebSocket path under concurrent senders.
+
+Registers ``--senders`` users plus one listener against a running server,
+puts them all in one group chat and has every sender push ``--messages``
+messages as fast as the server accepts them. The listener timestamps each
+broadcast it receives; latency percentiles and throughput are printed.
+The listener receives every message, so run the server with a
+``WS_SEND_QUEUE_SIZE`` above ``senders * messages`` or frames will be dropped.
+
+    uvicorn app.main:app --workers 1 &
+    python -m benchmarks.ws_send_latency --senders 50 --messages 100
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import websockets
+
+from benchmarks.common import percentile, register, request
+
+
+async def main(args):
+    prefix = f"bench{uuid.uuid4().hex[:6]}_"
+    users = await asyncio.gather(*[
+        asyncio.to_thread(register, args.base_url, prefix, i) for i in range(args.senders + 1)
+    ])
+    _, listener_token = users[0]
+    chat = await asyncio.to_thread(request, f"{args.base_url}/chats/", {
+        "name": f"{prefix}room",
+        "is_group": True,
+        "participant_ids": [user_id for user_id, _ in users[1:]],
+    }, listener_token)
+    chat_id = chat["id"]
+    ws_url = args.base_url.replace("http", "ws", 1)
+
+    expected = args.senders * args.messages
+    latencies = []
+    sent_at = {}
+    done = asyncio.Event()
+
+    async def listen(ready: asyncio.Event):
+        # Subscribed to the chat by the server at connect
+        async with websockets.connect(f"{ws_url}/ws?token={listener_token}") as ws:
+            ready.set()
+            while len(latencies) < expected:
+                frame = json.loads(await ws.recv())
+                if frame.get("type") != "message":
+                    continue
+                key = frame["message"]["content"]
+                if key in sent_at:
+                    latencies.append(time.perf_counter() - sent_at.pop(key))
+            done.set()
+
+    async def send(token: str, index: int):
+        async with websockets.connect(f"{ws_url}/ws?token={token}") as ws:
+            for n in range(args.messages):
+                key = f"{index}:{n}"
+                sent_at[key] = time.perf_counter()
+                await ws.send(json.dumps({"type": "message", "chat_id": chat_id, "content": key}))
+            await done.wait()
+
+    ready = asyncio.Event()
+    listener = asyncio.create_task(listen(ready))
+    await ready.wait()
+    start = time.perf_counter()
+    senders = [asyncio.create_task(send(token, i)) for i, (_, token) in enumerate(users[1:])]
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"timed out with {len(latencies)}/{expected} messages received")
+    elapsed = time.perf_counter() - start
+    for task in senders + [listener]:
+        task.cancel()
+    await asyncio.gather(*senders, listener, return_exceptions=True)
+
+    if not latencies:
+        return
+    print(f"senders={args.senders} messages={len(latencies)} elapsed={elapsed:.2f}s "
+          f"throughput={len(latencies) / elapsed:.0f} msg/s")
+    for pct in (50, 95, 99):
+        print(f"p{pct}: {percentile(latencies, pct) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(main(parser.parse_args()))
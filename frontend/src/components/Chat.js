@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useRef, useCallback, memo } from 'react';
+import React, { useState, useEffect, useLayoutEffect, useRef, useCallback, memo } from 'react';
 import {
   Box,
   Drawer,
@@ -52,6 +52,7 @@ import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { format } from 'date-fns';
 import UserSearch from './UserSearch';
+import { blurhashToDataURL } from '../utils/blurhash';
 import DirectMessage from './DirectMessage';
 import ResponsiveLayout from './ResponsiveLayout';
 import Settings from './Settings';
@@ -65,6 +66,9 @@ import InsertEmoticonIcon from '@mui/icons-material/InsertEmoticon';
 
 const API_URL = '/api';
 const WS_URL = `ws://${window.location.host}/ws`;
+// Matches the server's TYPING_MIN_INTERVAL; an indicator fades if not repeated
+const TYPING_INTERVAL = 2000;
+const TYPING_TIMEOUT = 5000;
 
 const drawerWidth = 340;
 
@@ -173,7 +177,10 @@ const MessageList = React.memo(function MessageList({ messages, user }) {
           new Date(message.created_at) - new Date(messages[idx - 1].created_at) > 5 * 60 * 1000;
         lastSenderId = message.sender_id;
         lastTimestamp = message.created_at;
+        // The server hands out signed URLs, since media tags cannot send the Authorization header
         const fileUrl = message.file_url ? `${API_URL}${message.file_url}` : null;
+        const thumbnailUrl = message.thumbnail_url ? `${API_URL}${message.thumbnail_url}` : null;
+        const placeholder = blurhashToDataURL(message.blurhash);
         return (
           <Box
             key={message.id}
@@ -250,20 +257,25 @@ const MessageList = React.memo(function MessageList({ messages, user }) {
                     }}
                   >
                     <img
-                      src={fileUrl}
+                      src={thumbnailUrl || fileUrl}
                       alt={message.filename || ''}
                       style={{
                         width: '100%',
                         display: 'block',
                         borderRadius: 0,
                         margin: 0,
+                        aspectRatio: message.media_width && message.media_height
+                          ? `${message.media_width} / ${message.media_height}`
+                          : undefined,
+                        backgroundImage: placeholder ? `url(${placeholder})` : undefined,
+                        backgroundSize: 'cover',
                       }}
                       onClick={() => setOpenImage(fileUrl)}
                     />
                   </Paper>
                 ) : null}
                 {fileUrl && message.filetype?.startsWith('video/') && (
-                  <video controls src={fileUrl} style={{ maxWidth: 160, borderRadius: 6, marginTop: 6 }} />
+                  <video controls preload="metadata" poster={thumbnailUrl || undefined} src={fileUrl} style={{ maxWidth: 160, borderRadius: 6, marginTop: 6 }} />
                 )}
                 {fileUrl && !message.filetype?.startsWith('image/') && !message.filetype?.startsWith('video/') && (
                   <Box sx={{ display: 'flex', alignItems: 'center', mt: 1 }}>
@@ -339,6 +351,20 @@ function Chat() {
   const [showScrollToBottom, setShowScrollToBottom] = useState(false);
   const { t } = useTranslation();
   const [openImage, setOpenImage] = useState(null);
+  // {user_id: {online, last_seen}} for contacts, and {chat_id: {user_id: expiry}} while they type
+  const [presence, setPresence] = useState({});
+  const [typing, setTyping] = useState({});
+  const lastTypingSent = useRef(0);
+  // Highest seq seen per chat, sent on reconnect to get only what was missed,
+  // and sent messages the server has not acknowledged yet
+  const lastSeq = useRef({});
+  const unacked = useRef({});
+  // Cursor of the next older page of the open chat, null once its history is all loaded
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const openChatId = useRef(null);
+  const scrollHeightBeforeOlder = useRef(null);
+  const lastMessageId = useRef(null);
 
   useEffect(() => {
     console.log('Chat mounted');
@@ -347,6 +373,8 @@ function Chat() {
   }, []);
 
   useEffect(() => {
+    openChatId.current = selectedChat?.id ?? null;
+    setOlderCursor(null);
     if (selectedChat) {
       console.log('Selected chat changed:', selectedChat);
       fetchMessages(selectedChat.id);
@@ -362,7 +390,8 @@ function Chat() {
     }
     if (!user?.id) return;
     let closed = false;
-    const wsUrl = `${WS_URL}/${user.id}`;
+    // The server authenticates the handshake and subscribes the socket to every chat of the user
+    const wsUrl = `${WS_URL}?token=${encodeURIComponent(token)}`;
     const websocket = new WebSocket(wsUrl);
     console.log('WebSocket instance created');
 
@@ -371,6 +400,11 @@ function Chat() {
       console.log('WebSocket connected');
       setIsConnected(true);
       setError(null);
+      if (Object.keys(lastSeq.current).length > 0) {
+        websocket.send(JSON.stringify({ type: 'resume', chats: lastSeq.current }));
+      }
+      // The server drops resends it already saved
+      Object.values(unacked.current).forEach(payload => websocket.send(JSON.stringify(payload)));
     };
     websocket.onclose = () => {
       if (closed) return;
@@ -389,6 +423,14 @@ function Chat() {
       console.log('WebSocket message received:', data);
       switch (data.type) {
         case 'message': handleNewMessage(data.message); break;
+        case 'message_updated': handleMessageUpdated(data.message); break;
+        case 'read': handleReadEvent(data.chat_id, data.message_id); break;
+        case 'presence_snapshot': handlePresence(data.users); break;
+        case 'presence': handlePresence([data]); break;
+        case 'typing': handleTyping(data.chat_id, data.user_id); break;
+        case 'ack': delete unacked.current[data.client_id]; break;
+        case 'resync': handleResync(data.chat_id); break;
+        case 'resumed': break;
         case 'chat_update': handleChatUpdate(data.update_type, data.chat); break;
         case 'chats_update': handleChatsUpdate(data.chat); break;
         case 'error': console.error('WebSocket error:', data.message); setError(data.message); break;
@@ -403,16 +445,6 @@ function Chat() {
     };
   }, [user.id, navigate]);
 
-  useEffect(() => {
-    if (!ws || ws.readyState !== WebSocket.OPEN) return;
-    chats.forEach(chat => {
-      ws.send(JSON.stringify({ type: 'join_chat', chat_id: chat.id }));
-    });
-    if (selectedChat) {
-      ws.send(JSON.stringify({ type: 'join_chat', chat_id: selectedChat.id }));
-    }
-  }, [ws, chats, selectedChat]);
-
   useEffect(() => {
     setIsSidebarOpen(!isMobile);
   }, [isMobile]);
@@ -422,6 +454,7 @@ function Chat() {
       console.log('Fetching chats...');
       const response = await axios.get(`${API_URL}/chats/`);
       console.log('Chats response:', response.data);
+      response.data.forEach(chat => noteSeq(chat.id, chat.last_message?.seq));
       setChats(response.data);
     } catch (error) {
       console.error('Error fetching chats:', error);
@@ -470,28 +503,86 @@ function Chat() {
     }
   };
 
+  const noteSeq = (chatId, seq) => {
+    if (seq && seq > (lastSeq.current[chatId] || 0)) lastSeq.current[chatId] = seq;
+  };
+
+  // Too much was missed to replay; reload instead
+  const handleResync = (chatId) => {
+    fetchChats();
+    if (selectedChat?.id === chatId) fetchMessages(chatId);
+  };
+
   const fetchMessages = async (chatId) => {
     try {
       console.log('Fetching messages for chat:', chatId);
       const response = await axios.get(`${API_URL}/chats/${chatId}/messages/`);
       console.log('Messages response:', response.data);
-      setMessages(response.data);
+      response.data.messages.forEach(msg => noteSeq(chatId, msg.seq));
+      if (openChatId.current !== chatId) return;
+      setMessages(response.data.messages);
+      setOlderCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Error fetching messages:', error);
     }
   };
 
-  const handleInputChange = useCallback((e) => setNewMessage(e.target.value), []);
+  // The page before the oldest loaded message; keyset-paginated by the server
+  const fetchOlderMessages = async () => {
+    const chatId = selectedChat?.id;
+    if (!chatId || olderCursor == null || loadingOlder) return;
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API_URL}/chats/${chatId}/messages/`, {
+        params: { before_id: olderCursor },
+      });
+      if (openChatId.current !== chatId) return;
+      if (messagesContainerRef.current) {
+        scrollHeightBeforeOlder.current = messagesContainerRef.current.scrollHeight;
+      }
+      setMessages(prevMessages => {
+        const loaded = new Set(prevMessages.map(msg => msg.id));
+        return [...response.data.messages.filter(msg => !loaded.has(msg.id)), ...prevMessages];
+      });
+      setOlderCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error fetching older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  // Keep the messages that were on screen in place when older ones are added above
+  useLayoutEffect(() => {
+    const container = messagesContainerRef.current;
+    if (container && scrollHeightBeforeOlder.current != null) {
+      container.scrollTop += container.scrollHeight - scrollHeightBeforeOlder.current;
+      scrollHeightBeforeOlder.current = null;
+    }
+  }, [messages]);
+
+  const handleInputChange = useCallback((e) => {
+    setNewMessage(e.target.value);
+    // The server drops repeats too; this just keeps them off the wire
+    const now = Date.now();
+    if (selectedChat && ws && ws.readyState === WebSocket.OPEN && now - lastTypingSent.current > TYPING_INTERVAL) {
+      lastTypingSent.current = now;
+      ws.send(JSON.stringify({ type: 'typing', chat_id: selectedChat.id }));
+    }
+  }, [ws, selectedChat]);
   const handleSendMessage = useCallback((e) => {
     e.preventDefault();
     if (!newMessage.trim()) return;
     try {
       if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
+        const payload = {
           type: 'message',
           content: newMessage,
-          chat_id: selectedChat.id
-        }));
+          chat_id: selectedChat.id,
+          client_id: `${user.id}-${Date.now()}-${Math.random().toString(36).slice(2)}`
+        };
+        unacked.current[payload.client_id] = payload;
+        ws.send(JSON.stringify(payload));
         setNewMessage('');
         scrollToBottom();
       } else {
@@ -503,9 +594,12 @@ function Chat() {
   }, [ws, newMessage, selectedChat]);
 
   useEffect(() => {
-    if (messages.length > 0 && messages[messages.length - 1].sender_id === user?.id) {
+    // Only a new message of the user's own; not older pages or updates
+    const last = messages[messages.length - 1];
+    if (last && last.id !== lastMessageId.current && last.sender_id === user?.id) {
       scrollToBottom();
     }
+    lastMessageId.current = last?.id;
   }, [messages, user]);
 
   const scrollToBottom = () => {
@@ -517,14 +611,18 @@ function Chat() {
   useEffect(() => {
     const container = messagesContainerRef.current;
     if (!container) return;
-    const handleScroll = () => {
+    const handleScroll = (event) => {
       const atBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 64;
       setShowScrollToBottom(!atBottom);
+      // Only when the user scrolls up, not when the messages first render
+      if (event && container.scrollTop < 64) {
+        fetchOlderMessages();
+      }
     };
     container.addEventListener('scroll', handleScroll);
     handleScroll();
     return () => container.removeEventListener('scroll', handleScroll);
-  }, [messages]);
+  }, [messages, olderCursor, loadingOlder]);
 
   const handleNewChatClick = (event) => {
     setNewChatMenuAnchor(event.currentTarget);
@@ -663,6 +761,12 @@ function Chat() {
 
   const handleNewMessage = (message) => {
     console.log('Received new message:', message, 'Current selectedChat:', selectedChat);
+    noteSeq(message.chat_id, message.seq);
+    setChats(prevChats => prevChats.map(chat => {
+      if (chat.id !== message.chat_id) return chat;
+      const unread = message.sender_id !== user?.id && chat.id !== selectedChat?.id;
+      return { ...chat, last_message: message, unread_count: (chat.unread_count || 0) + (unread ? 1 : 0) };
+    }));
     setMessages(prevMessages => {
       // Avoid duplicates
       if (prevMessages.some(msg => msg.id === message.id)) {
@@ -672,6 +776,73 @@ function Chat() {
     });
   };
 
+  // Read on this or another of the user's devices
+  const handleReadEvent = (chatId, messageId) => {
+    setChats(prevChats => prevChats.map(chat => (
+      chat.id === chatId && (chat.last_read_message_id || 0) < messageId
+        ? { ...chat, last_read_message_id: messageId, unread_count: 0 }
+        : chat
+    )));
+  };
+
+  // The open chat is read up to its newest message; the server batches these
+  useEffect(() => {
+    if (!selectedChat || messages.length === 0 || !ws || ws.readyState !== WebSocket.OPEN) return;
+    const last = messages[messages.length - 1];
+    const chat = chats.find(c => c.id === selectedChat.id);
+    if (last.chat_id !== selectedChat.id || (chat && (chat.last_read_message_id || 0) >= last.id)) return;
+    ws.send(JSON.stringify({ type: 'read', chat_id: selectedChat.id, message_id: last.id }));
+    handleReadEvent(selectedChat.id, last.id);
+  }, [messages, selectedChat, ws]);
+
+  const withoutTypist = (prev, userId, chatId = null) => {
+    const next = {};
+    Object.entries(prev).forEach(([id, typists]) => {
+      next[id] = { ...typists };
+      if ((chatId === null || Number(id) === chatId) && next[id][userId] !== undefined) delete next[id][userId];
+    });
+    return next;
+  };
+
+  const handlePresence = (users) => {
+    setPresence(prev => {
+      const next = { ...prev };
+      users.forEach(u => { next[u.user_id] = { online: u.online, last_seen: u.last_seen }; });
+      return next;
+    });
+    // Someone who went away is no longer typing
+    users.filter(u => !u.online).forEach(u => setTyping(prev => withoutTypist(prev, u.user_id)));
+  };
+
+  const handleTyping = (chatId, userId) => {
+    if (userId === user?.id) return;
+    const expires = Date.now() + TYPING_TIMEOUT;
+    setTyping(prev => ({ ...prev, [chatId]: { ...(prev[chatId] || {}), [userId]: expires } }));
+    setTimeout(() => {
+      setTyping(prev => (prev[chatId]?.[userId] === expires ? withoutTypist(prev, userId, chatId) : prev));
+    }, TYPING_TIMEOUT);
+  };
+
+  const chatStatus = (chat) => {
+    if (!chat) return '';
+    const typists = Object.keys(typing[chat.id] || {});
+    if (typists.length > 0) {
+      const names = typists.map(id => chat.participants?.find(p => p.id === Number(id))?.username).filter(Boolean);
+      return `${names.join(', ')} ${t('typing...')}`;
+    }
+    if (chat.is_group) return t('Group Chat');
+    const other = chat.participants?.find(p => p.id !== user?.id);
+    const state = other && presence[other.id];
+    if (state?.online) return t('Online');
+    const lastSeen = state?.last_seen || other?.last_seen;
+    return lastSeen ? `${t('Last seen')} ${format(new Date(lastSeen), 'dd.MM HH:mm')}` : t('Direct Message');
+  };
+
+  // Fields filled in later, e.g. an attachment's thumbnail once it is rendered
+  const handleMessageUpdated = (update) => {
+    setMessages(prevMessages => prevMessages.map(msg => (msg.id === update.id ? { ...msg, ...update } : msg)));
+  };
+
   const handleFileSelect = async (e) => {
     const file = e.target.files[0];
     if (!file || !selectedChat) return;
@@ -826,13 +997,13 @@ function Chat() {
                     {chat.name}
                   </Typography>
                   <Typography variant="caption" color="text.secondary" sx={{ ml: 1 }}>
-                    {chat.last_message_time ? format(new Date(chat.last_message_time), 'HH:mm') : ''}
+                    {chat.last_message ? format(new Date(chat.last_message.timestamp || chat.last_message.created_at), 'HH:mm') : ''}
                   </Typography>
                 </Box>
               }
               secondary={
                 <Typography noWrap variant="body2" color="text.secondary">
-                  {chat.last_message || t('No messages yet')}
+                  {chat.last_message ? (chat.last_message.filename || chat.last_message.content) : t('No messages yet')}
                 </Typography>
               }
               primaryTypographyProps={{ noWrap: true }}
@@ -915,7 +1086,7 @@ function Chat() {
           <Box sx={{ flexGrow: 1 }}>
             <Typography variant="h6" fontWeight={500} noWrap>{selectedChat ? selectedChat.name : t('Select a chat')}</Typography>
             <Typography variant="caption" color="text.secondary" noWrap>
-              {selectedChat?.is_group ? t('Group Chat') : t('Direct Message')}
+              {chatStatus(selectedChat)}
             </Typography>
           </Box>
           <Tooltip title={t('Pinned message')}><IconButton color="inherit"><PushPinIcon /></IconButton></Tooltip>
@@ -957,6 +1128,16 @@ function Chat() {
             }} 
             ref={messagesContainerRef}
           >
+            {olderCursor != null && (
+              <Button
+                size="small"
+                onClick={fetchOlderMessages}
+                disabled={loadingOlder}
+                sx={{ alignSelf: 'center', mt: 1 }}
+              >
+                {loadingOlder ? t('Loading...') : t('Load older messages')}
+              </Button>
+            )}
             {messages.length === 0 ? (
               <Box sx={{ 
                 flexGrow: 1, 
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import {
   Dialog,
   DialogTitle,
@@ -21,6 +21,7 @@ function UserSearch({ open, onClose, onUserSelect, currentChat }) {
   const [searchResults, setSearchResults] = useState([]);
   const [error, setError] = useState('');
   const [isLoading, setIsLoading] = useState(false);
+  const searchTimer = useRef(null);
 
   const searchUsers = async (query) => {
     if (!query.trim()) {
@@ -32,7 +33,7 @@ function UserSearch({ open, onClose, onUserSelect, currentChat }) {
     setError('');
 
     try {
-      const response = await axios.get(`http://localhost:8000/users/search/?query=${query}`);
+      const response = await axios.get(`http://localhost:8000/users/search/?query=${encodeURIComponent(query.trim())}&limit=20`);
       // Filter out users who are already in the chat
       const filteredResults = response.data.filter(
         user => !currentChat.participants.some(p => p.id === user.id)
@@ -49,8 +50,10 @@ function UserSearch({ open, onClose, onUserSelect, currentChat }) {
   const handleSearch = (e) => {
     const query = e.target.value;
     setSearchQuery(query);
+    // One request once typing pauses, not one per keystroke
+    clearTimeout(searchTimer.current);
     if (query.trim()) {
-      searchUsers(query);
+      searchTimer.current = setTimeout(() => searchUsers(query), 250);
     } else {
       setSearchResults([]);
     }
@@ -25,10 +25,15 @@ const resources = {
       'Direct Message': 'Direct Message',
       'Start a private conversation': 'Start a private conversation',
       'Group Chat': 'Group Chat',
+      'Online': 'Online',
+      'Last seen': 'Last seen',
+      'typing...': 'typing...',
       'Create a group conversation': 'Create a group conversation',
       'No chats yet. Start a new conversation!': 'No chats yet. Start a new conversation!',
       'Select a chat': 'Select a chat',
       'No messages yet. Start the conversation!': 'No messages yet. Start the conversation!',
+      'Load older messages': 'Load older messages',
+      'Loading...': 'Loading...',
       'Type a message...': 'Type a message...',
       'Select a chat to start messaging': 'Select a chat to start messaging',
       'Choose an existing conversation or start a new one': 'Choose an existing conversation or start a new one',
@@ -72,10 +77,15 @@ const resources = {
       'Direct Message': 'Личное сообщение',
       'Start a private conversation': 'Начать личную переписку',
       'Group Chat': 'Групповой чат',
+      'Online': 'В сети',
+      'Last seen': 'Был(а) в сети',
+      'typing...': 'печатает...',
       'Create a group conversation': 'Создать групповой чат',
       'No chats yet. Start a new conversation!': 'Пока нет чатов. Начните новый разговор!',
       'Select a chat': 'Выберите чат',
       'No messages yet. Start the conversation!': 'Пока нет сообщений. Начните переписку!',
+      'Load older messages': 'Загрузить более ранние сообщения',
+      'Loading...': 'Загрузка...',
       'Type a message...': 'Введите сообщение...',
       'Select a chat to start messaging': 'Выберите чат для переписки',
       'Choose an existing conversation or start a new one': 'Выберите существующий чат или начните новый',
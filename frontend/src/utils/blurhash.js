@@ -0,0 +1,79 @@
+// BlurHash decoder (https://blurha.sh) for attachment placeholders
+const ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+
+const decode83 = (str) => {
+  let value = 0;
+  for (const c of str) value = value * 83 + ALPHABET.indexOf(c);
+  return value;
+};
+
+const sRGBToLinear = (value) => {
+  const v = value / 255;
+  return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4);
+};
+
+const linearToSRGB = (value) => {
+  const v = Math.max(0, Math.min(1, value));
+  return v <= 0.0031308 ? Math.round(v * 12.92 * 255) : Math.round((1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255);
+};
+
+const signPow = (value, exp) => Math.sign(value) * Math.pow(Math.abs(value), exp);
+
+export const decodeBlurhash = (hash, width, height) => {
+  const size = decode83(hash[0]);
+  const numY = Math.floor(size / 9) + 1;
+  const numX = (size % 9) + 1;
+  const maxValue = (decode83(hash[1]) + 1) / 166;
+  const colors = new Array(numX * numY);
+  const dc = decode83(hash.substring(2, 6));
+  colors[0] = [sRGBToLinear(dc >> 16), sRGBToLinear((dc >> 8) & 255), sRGBToLinear(dc & 255)];
+  for (let i = 1; i < colors.length; i++) {
+    const value = decode83(hash.substring(4 + i * 2, 6 + i * 2));
+    colors[i] = [
+      signPow((Math.floor(value / (19 * 19)) - 9) / 9, 2) * maxValue,
+      signPow(((Math.floor(value / 19) % 19) - 9) / 9, 2) * maxValue,
+      signPow(((value % 19) - 9) / 9, 2) * maxValue,
+    ];
+  }
+  const pixels = new Uint8ClampedArray(width * height * 4);
+  for (let y = 0; y < height; y++) {
+    for (let x = 0; x < width; x++) {
+      let r = 0, g = 0, b = 0;
+      for (let j = 0; j < numY; j++) {
+        for (let i = 0; i < numX; i++) {
+          const basis = Math.cos((Math.PI * x * i) / width) * Math.cos((Math.PI * y * j) / height);
+          const color = colors[i + j * numX];
+          r += color[0] * basis;
+          g += color[1] * basis;
+          b += color[2] * basis;
+        }
+      }
+      const offset = 4 * (x + y * width);
+      pixels[offset] = linearToSRGB(r);
+      pixels[offset + 1] = linearToSRGB(g);
+      pixels[offset + 2] = linearToSRGB(b);
+      pixels[offset + 3] = 255;
+    }
+  }
+  return pixels;
+};
+
+const dataURLs = new Map();
+
+// A tiny image of the placeholder, stretched by CSS behind the loading thumbnail
+export const blurhashToDataURL = (hash, width = 32, height = 32) => {
+  if (!hash) return null;
+  if (!dataURLs.has(hash)) {
+    try {
+      const canvas = document.createElement('canvas');
+      canvas.width = width;
+      canvas.height = height;
+      const context = canvas.getContext('2d');
+      context.putImageData(new ImageData(decodeBlurhash(hash, width, height), width, height), 0, 0);
+      dataURLs.set(hash, canvas.toDataURL());
+    } catch (err) {
+      dataURLs.set(hash, null);
+    }
+  }
+  return dataURLs.get(hash);
+};
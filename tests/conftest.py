@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+# The app reads its settings at import time
+_db_dir = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_db_dir}/tests.db")
+os.environ.setdefault("SECRET_KEY", "tests")
+os.environ.setdefault("STORAGE_URL", os.path.join(_db_dir, "uploads"))
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from benchmarks.common import migrate
+
+
+@pytest.fixture(scope="session")
+def database():
+    migrate()
+    return os.environ["DATABASE_URL"]
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    """The app in-process; one instance, since its engine and background tasks live on one loop"""
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def register(client):
+    """Create a user and return (user id, auth headers)"""
+    def register(username):
+        user = client.post("/users/", json={
+            "username": username, "email": f"{username}@tests.example.com", "password": "pw",
+        })
+        assert user.status_code == 200, user.text
+        token = client.post("/token", data={"username": username, "password": "pw"}).json()["access_token"]
+        return user.json()["id"], {"Authorization": f"Bearer {token}"}
+
+    return register
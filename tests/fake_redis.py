@@ -0,0 +1,76 @@
+"""A minimal server speaking the Redis protocol: AUTH, PING, PUBLISH and SUBSCRIBE"""
+import asyncio
+from typing import List, Optional, Set
+
+
+def _bulk(data: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        raise ValueError(f"Expected an array, got {line!r}")
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class FakeRedis:
+    def __init__(self):
+        self.port: Optional[int] = None
+        self.published: List[bytes] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._subscribers: dict = {}
+
+    @property
+    def subscribers(self) -> int:
+        return sum(len(writers) for writers in self._subscribers.values())
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", self.port or 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Close the listener and every connection, like a restarting server"""
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._writers.clear()
+        self._subscribers.clear()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while (command := await _read_command(reader)) is not None:
+                name = command[0].upper()
+                if name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        self._subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(b"*3\r\n" + _bulk(b"subscribe") + _bulk(channel) + b":1\r\n")
+                elif name == b"PUBLISH":
+                    channel, message = command[1], command[2]
+                    self.published.append(message)
+                    receivers = self._subscribers.get(channel, set())
+                    for subscriber in receivers:
+                        subscriber.write(b"*3\r\n" + _bulk(b"message") + _bulk(channel) + _bulk(message))
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif name in (b"AUTH", b"PING"):
+                    writer.write(b"+OK\r\n" if name == b"AUTH" else b"+PONG\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for writers in self._subscribers.values():
+                writers.discard(writer)
+            self._writers.discard(writer)
+            writer.close()
+
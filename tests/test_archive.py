@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import database
+from app.database import to_async_url
+from app.models import models
+from app.storage.archive import MessageArchive, blocks, messages, partitions
+from app.storage.storage import LocalStorage
+from benchmarks.common import migrate
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    """Sessions on a database of its own: archiving takes whole id ranges"""
+    url = to_async_url(f"sqlite:///{tmp_path}/archive.db")
+    monkeypatch.setattr(database, "ASYNC_DATABASE_URL", url)
+    migrate()
+    engine = create_async_engine(url)
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+def test_cold_ranges_are_archived_and_stay_readable(sessions, tmp_path):
+    async def scenario():
+        archive = MessageArchive(
+            LocalStorage(str(tmp_path / "store")), session_factory=sessions,
+            partition_size=10, partitions_ahead=1, archive_after=timedelta(days=1), block_rows=3,
+        )
+        old = datetime.utcnow() - timedelta(days=10)
+        async with sessions() as db:
+            sender = (await db.execute(insert(models.User).values(username="archivist"))).inserted_primary_key[0]
+            chat = (await db.execute(insert(models.Chat).values(name="old"))).inserted_primary_key[0]
+            other = (await db.execute(insert(models.Chat).values(name="other"))).inserted_primary_key[0]
+            await db.commit()
+        await archive.maintain_partitions()
+        async with sessions() as db:
+            await db.execute(insert(messages), [
+                dict(id=i, chat_id=chat if i <= 7 else other, sender_id=sender, content=f"m{i}", seq=i, timestamp=old)
+                for i in range(1, 10)
+            ])
+            # The range holding the newest message is never archived
+            await db.execute(insert(messages).values(
+                id=12, chat_id=chat, sender_id=sender, content="m12", seq=12, timestamp=datetime.utcnow(),
+            ))
+            await db.commit()
+
+        await archive.archive_cold()
+
+        async with sessions() as db:
+            live = list(await db.scalars(select(messages.c.id).order_by(messages.c.id)))
+            ranges = (await db.execute(select(partitions.c.low_id, partitions.c.state, partitions.c.row_count)
+                                      .order_by(partitions.c.low_id))).all()
+            indexed = (await db.execute(select(blocks.c.chat_id, blocks.c.first_id, blocks.c.last_id)
+                                       .order_by(blocks.c.chat_id, blocks.c.first_id))).all()
+            page = list(await db.scalars(select(models.Message).where(models.Message.chat_id == chat)
+                                         .order_by(models.Message.id.desc()).limit(5)))
+            newest = await archive.with_archived(db, chat, page, None, None, 5)
+            older = await archive.history(db, chat, 4, None, 5)
+            forward = await archive.with_archived(db, chat, [], None, 5, 3)
+            found = await archive.find(db, {chat: 5})
+        return chat, other, live, ranges, indexed, newest, older, forward, found
+
+    chat, other, live, ranges, indexed, newest, older, forward, found = asyncio.run(scenario())
+    assert live == [12]
+    assert ranges[0] == (0, "archived", 9)
+    assert all(state == "live" for _, state, _ in ranges[1:])
+    # Blocks of at most block_rows messages of one chat
+    assert indexed == [(chat, 1, 3), (chat, 4, 6), (chat, 7, 7), (other, 8, 9)]
+    assert [m.id for m in newest] == [12, 7, 6, 5, 4]
+    assert [m.id for m in older] == [3, 2, 1]
+    assert [m.id for m in forward] == [6, 7]
+    assert found[5].content == "m5" and found[5].sender.username == "archivist"
+
+
+def test_deleted_chats_are_purged_with_their_archive_blocks(sessions, tmp_path):
+    async def scenario():
+        archive = MessageArchive(LocalStorage(str(tmp_path / "store")), session_factory=sessions, purge_batch=2)
+        async with sessions() as db:
+            sender = (await db.execute(insert(models.User).values(username="purger"))).inserted_primary_key[0]
+            kept = (await db.execute(insert(models.Chat).values(name="kept"))).inserted_primary_key[0]
+            gone = (await db.execute(insert(models.Chat).values(
+                name="gone", deleted_at=datetime.utcnow() - timedelta(minutes=5),
+            ))).inserted_primary_key[0]
+            fresh = (await db.execute(insert(models.Chat).values(
+                name="just deleted", deleted_at=datetime.utcnow(),
+            ))).inserted_primary_key[0]
+            for chat in (kept, gone, gone, gone, gone, gone, fresh):
+                await db.execute(insert(messages).values(chat_id=chat, sender_id=sender, content="x"))
+            await db.execute(insert(partitions).values(low_id=-10, high_id=0, state="archived"))
+            await db.execute(insert(blocks), [
+                dict(chat_id=chat, first_id=-5, last_id=-1, partition_low_id=-10, offset=0, length=1, count=5)
+                for chat in (kept, gone)
+            ])
+            await db.commit()
+
+        await archive.purge_deleted_chats()
+
+        async with sessions() as db:
+            chats = set(await db.scalars(select(models.Chat.id)))
+            counts = dict((await db.execute(
+                select(messages.c.chat_id, func.count()).group_by(messages.c.chat_id)
+            )).all())
+            block_chats = set(await db.scalars(select(blocks.c.chat_id)))
+        return archive, kept, gone, fresh, chats, counts, block_chats
+
+    archive, kept, gone, fresh, chats, counts, block_chats = asyncio.run(scenario())
+    assert gone not in chats and {kept, fresh} <= chats
+    assert counts == {kept: 1, fresh: 1}
+    assert block_chats == {kept}
+    assert archive.purged_rows == 5
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.auth.auth import BCRYPT_ROUNDS, PasswordHasher
+from app.database import to_async_url
+from app.models import models
+
+
+def test_cancelled_caller_keeps_the_slot_until_the_hash_finishes():
+    async def scenario():
+        hasher = PasswordHasher(workers=1, max_concurrency=1, queue_timeout=0.05)
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_hash():
+            started.set()
+            finish.wait(5)
+            return "hashed"
+
+        request = asyncio.create_task(hasher._run(slow_hash))
+        await asyncio.to_thread(started.wait, 5)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        # bcrypt is still running for the abandoned request, so the pool is full
+        with pytest.raises(HTTPException) as rejected:
+            await hasher._run(str, "next")
+        assert rejected.value.status_code == 503
+        finish.set()
+        assert await hasher._run(str, "next") == "next"
+        hasher.shutdown()
+        return hasher.rejected
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_login_upgrades_a_hash_with_outdated_rounds(client, register, database):
+    user_id, _ = register("rehash_on_login")
+    old_rounds = BCRYPT_ROUNDS + 1
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=old_rounds).hash("pw")
+
+    async def stored_hash(new_hash=None):
+        engine = create_async_engine(to_async_url(database))
+        async with async_sessionmaker(engine)() as db:
+            if new_hash:
+                await db.execute(update(models.User).where(models.User.id == user_id).values(hashed_password=new_hash))
+                await db.commit()
+            hashed = await db.scalar(select(models.User.hashed_password).where(models.User.id == user_id))
+        await engine.dispose()
+        return hashed
+
+    assert asyncio.run(stored_hash(old_hash)) == old_hash
+    response = client.post("/token", data={"username": "rehash_on_login", "password": "pw"})
+    assert response.status_code == 200, response.text
+
+    upgraded = asyncio.run(stored_hash())
+    assert upgraded != old_hash
+    assert upgraded.split("$")[2] == "%02d" % BCRYPT_ROUNDS
+    # The upgraded hash still accepts the same password
+    assert client.post("/token", data={"username": "rehash_on_login", "password": "pw"}).status_code == 200
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from app.websockets.backplane import RedisBackplane
+from tests.fake_redis import FakeRedis
+
+
+async def eventually(predicate, timeout: float = 3.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def backplane(port: int, received: list) -> RedisBackplane:
+    bus = RedisBackplane(f"redis://:secret@127.0.0.1:{port}")
+    bus.RECONNECT_DELAY_SECONDS = 0.05
+
+    async def handler(data: bytes):
+        received.append(data)
+
+    bus.subscribe("chat", handler)
+    await bus.start()
+    return bus
+
+
+def test_frames_cross_instances_and_survive_a_server_restart():
+    async def scenario():
+        server = FakeRedis()
+        await server.start()
+        got_a, got_b = [], []
+        a = await backplane(server.port, got_a)
+        b = await backplane(server.port, got_b)
+        await eventually(lambda: server.subscribers == 2 and a._connected.is_set() and b._connected.is_set())
+
+        await a.publish("chat", b"from a")
+        await b.publish("chat", b"from b")
+        await b.publish("other", b"nobody listens")
+        await eventually(lambda: got_a and got_b)
+        # Publishers never hear their own frames
+        assert got_a == [b"from b"]
+        assert got_b == [b"from a"]
+
+        await server.stop()
+        await eventually(lambda: not a._connected.is_set())
+        # While disconnected frames are dropped, not queued
+        await a.publish("chat", b"lost")
+        await server.start()
+        await eventually(lambda: server.subscribers == 2 and a._connected.is_set() and b._connected.is_set())
+
+        await a.publish("chat", b"after restart")
+        await eventually(lambda: len(got_b) == 2)
+        assert got_b == [b"from a", b"after restart"]
+        assert b"lost" not in b"".join(server.published)
+
+        await a.stop()
+        await b.stop()
+        await server.stop()
+
+    asyncio.run(scenario())
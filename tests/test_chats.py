@@ -0,0 +1,55 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import engine, get_db
+from app.main import app
+from app.websockets.manager import manager
+
+
+def test_concurrent_direct_chat_requests_share_one_chat(client, register, monkeypatch):
+    alice_id, alice = register("direct_alice")
+    bob_id, bob = register("direct_bob")
+    barrier = asyncio.Barrier(2)
+
+    class RacingSession(AsyncSession):
+        async def scalar(self, statement, *args, **kwargs):
+            result = await super().scalar(statement, *args, **kwargs)
+            if "direct_chats" in str(statement) and not self.info.get("raced"):
+                # Both requests see no chat for the pair before either creates one
+                self.info["raced"] = True
+                await asyncio.wait_for(barrier.wait(), 5)
+            return result
+
+    async def racing_db():
+        async with RacingSession(engine, expire_on_commit=False) as db:
+            yield db
+
+    subscribed = []
+    subscribe = manager.subscribe
+
+    async def recording_subscribe(chat_id, user_ids):
+        subscribed.append((chat_id, sorted(user_ids)))
+        await subscribe(chat_id, user_ids)
+
+    monkeypatch.setattr(manager, "subscribe", recording_subscribe)
+    app.dependency_overrides[get_db] = racing_db
+    try:
+        with ThreadPoolExecutor(2) as pool:
+            responses = list(pool.map(
+                lambda request: client.post(request[0], headers=request[1]),
+                [(f"/chats/direct/{bob_id}", alice), (f"/chats/direct/{alice_id}", bob)],
+            ))
+    finally:
+        del app.dependency_overrides[get_db]
+
+    assert [response.status_code for response in responses] == [200, 200], [r.text for r in responses]
+    chat_id = responses[0].json()["id"]
+    assert responses[1].json()["id"] == chat_id
+    # The request that lost the race still subscribes the pair to the winner's chat
+    assert subscribed == [(chat_id, sorted([alice_id, bob_id]))] * 2
+    # Both are members of that chat, and asking again returns it
+    for headers, other_id in ((alice, bob_id), (bob, alice_id)):
+        assert client.get(f"/chats/{chat_id}/messages/", headers=headers).status_code == 200
+        assert client.post(f"/chats/direct/{other_id}", headers=headers).json()["id"] == chat_id
@@ -0,0 +1,35 @@
+import asyncio
+
+from app.websockets.connection import Connection
+
+
+class InstantWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def test_close_waits_for_the_writer_to_exit():
+    async def scenario():
+        for _ in range(100):
+            websocket = InstantWebSocket()
+            connection = Connection(websocket, user_id=1)
+            connection.start()
+            for n in range(20):
+                connection.send(f"m{n}")
+            # Lands mid-send on some rounds, where wait_for may swallow the cancel
+            await asyncio.sleep(0)
+            closing = asyncio.ensure_future(connection.close(4000))
+            done, _ = await asyncio.wait({closing}, timeout=1)
+            assert done, "close is stuck waiting for the writer"
+            assert connection._writer.done()
+            assert websocket.close_code == 4000
+            assert not connection.send("late")
+
+    asyncio.run(scenario())
@@ -0,0 +1,72 @@
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from app.storage.signing import MEDIA_URL_TTL, sign_url
+
+
+def upload(client, register, name, data=b"attachment bytes", filetype="text/plain"):
+    _, headers = register(name)
+    chat = client.post("/chats/", json={"name": name, "is_group": True, "participant_ids": []}, headers=headers).json()
+    response = client.post(
+        f"/chats/{chat['id']}/messages/upload", files={"file": ("notes.txt", data, filetype)}, headers=headers,
+    )
+    assert response.status_code == 200, response.text
+    return chat["id"], headers, response.json()
+
+
+def test_signed_urls_download_without_the_session_token(client, register):
+    chat_id, headers, message = upload(client, register, "files_signed")
+    url = message["file_url"]
+    path, query = urlsplit(url).path, parse_qs(urlsplit(url).query)
+    assert "token" not in query and set(query) == {"expires", "signature"}
+    assert client.get(url).content == b"attachment bytes"
+    # The history hands out the same URL, so the browser cache holds
+    history = client.get(f"/chats/{chat_id}/messages/", headers=headers).json()["messages"]
+    assert history[0]["file_url"] == url
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers=headers).status_code == 200
+    tampered = url[:-1] + ("0" if url[-1] != "0" else "1")
+    assert client.get(tampered).status_code == 403
+    expired = sign_url(path, now=time.time() - 3 * MEDIA_URL_TTL)
+    assert client.get(expired).status_code == 403
+    # A signature is bound to its chat
+    other_chat = path.replace(f"/chats/{chat_id}/", f"/chats/{chat_id + 1}/")
+    assert client.get(other_chat + "?" + urlsplit(url).query).status_code == 403
+
+
+def test_downloads_answer_ranges_and_conditional_requests(client, register):
+    data = bytes(range(256)) * 4
+    _, headers, message = upload(client, register, "files_ranges", data, "application/octet-stream")
+    url = message["file_url"]
+    etag = f'"{urlsplit(url).path.rsplit("/", 1)[-1]}"'
+
+    whole = client.get(url)
+    assert whole.status_code == 200
+    assert whole.content == data
+    assert whole.headers["etag"] == etag
+    assert "immutable" in whole.headers["cache-control"]
+    assert whole.headers["accept-ranges"] == "bytes"
+    assert whole.headers["content-disposition"].startswith("attachment")
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": f'W/{etag}, "other"'}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+    part = client.get(url, headers={"Range": "bytes=10-19"})
+    assert part.status_code == 206
+    assert part.content == data[10:20]
+    assert part.headers["content-range"] == f"bytes 10-19/{len(data)}"
+    suffix = client.get(url, headers={"Range": "bytes=-5"})
+    assert suffix.status_code == 206 and suffix.content == data[-5:]
+    open_ended = client.get(url, headers={"Range": f"bytes={len(data) - 3}-"})
+    assert open_ended.content == data[-3:]
+
+    unsatisfiable = client.get(url, headers={"Range": f"bytes={len(data)}-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == f"bytes */{len(data)}"
+    # A Range for another version of the file is ignored
+    stale = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert stale.status_code == 200 and stale.content == data
+    # Several ranges are answered with the whole file
+    assert client.get(url, headers={"Range": "bytes=0-1,5-6"}).status_code == 200
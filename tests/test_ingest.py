@@ -0,0 +1,91 @@
+import asyncio
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.database import to_async_url
+from app.models import models
+from app.websockets.ingest import MessageIngest
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def flush(ingest: MessageIngest, rows):
+    await ingest.start()
+    for values in rows:
+        await ingest.submit(**values)
+    await ingest.stop()
+
+
+def test_rejected_row_is_dropped_and_the_rest_written(database):
+    async def scenario():
+        engine = create_async_engine(to_async_url(database))
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        async with sessions() as db:
+            chat_id = (await db.execute(insert(models.Chat).values(name="ingest", last_seq=3))).inserted_primary_key[0]
+            await db.commit()
+        ingest = MessageIngest(session_factory=sessions, batch_size=10, flush_interval=0.01, max_pending=5)
+        # The second row repeats the first one's seq, which the unique (chat_id, seq) index rejects
+        await flush(ingest, [
+            dict(content="first", chat_id=chat_id, sender_id=1, seq=1),
+            dict(content="duplicate seq", chat_id=chat_id, sender_id=1, seq=1),
+            dict(content="third", chat_id=chat_id, sender_id=1, seq=2),
+        ])
+        async with sessions() as db:
+            written = list(await db.scalars(
+                select(models.Message.content).where(models.Message.chat_id == chat_id).order_by(models.Message.id)
+            ))
+        await engine.dispose()
+        return ingest, written
+
+    ingest, written = run(scenario())
+    assert written == ["first", "third"]
+    assert ingest.pending == 0
+    assert ingest.flushed_rows == 2
+    assert ingest.dropped_rows == 1
+    assert [row["content"] for row, _ in ingest.dead_letters] == ["duplicate seq"]
+    # Every slot is free again
+    assert ingest._slots._value == 5
+
+
+def test_unreachable_database_keeps_rows_pending(database, tmp_path):
+    async def scenario():
+        engine = create_async_engine(to_async_url(database))
+        ingest = MessageIngest(session_factory=async_sessionmaker(engine), flush_interval=0.01)
+        for content in ("a", "b"):
+            await ingest.submit(content=content, chat_id=1, sender_id=1, seq=None)
+        # The ids are reserved; now the database goes away
+        unreachable = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite")
+        ingest.session_factory = async_sessionmaker(unreachable)
+        await ingest._flush()
+        await engine.dispose()
+        await unreachable.dispose()
+        return ingest
+
+    ingest = run(scenario())
+    assert ingest.pending == 2
+    assert ingest.dropped_rows == 0
+    assert ingest.failed_flushes == 1
+
+
+def test_failed_id_reservation_gives_the_slot_back(tmp_path):
+    async def scenario():
+        unreachable = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite")
+        ingest = MessageIngest(session_factory=async_sessionmaker(unreachable), max_pending=2)
+        failures = 0
+        for _ in range(3):
+            try:
+                await asyncio.wait_for(ingest.submit(content="x", chat_id=1, sender_id=1, seq=None), 1)
+            except asyncio.TimeoutError:
+                raise AssertionError("submit is stuck waiting for a slot")
+            except Exception:
+                failures += 1
+        await unreachable.dispose()
+        return ingest, failures
+
+    ingest, failures = run(scenario())
+    assert failures == 3
+    assert ingest.pending == 0
+    assert ingest._slots._value == 2
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.database import to_async_url
+from app.models import models
+from app.storage import blurhash, media as media_module
+from app.storage.media import MediaProcessor, PreviewJob, render_preview, thumbnail_key
+from app.storage.storage import LocalStorage, content_key
+from app.websockets.ingest import MessageIngest
+
+
+class RecordingManager:
+    def __init__(self):
+        self.broadcasts = []
+
+    async def broadcast_to_chat(self, chat_id, message, seq=None):
+        self.broadcasts.append((chat_id, message))
+
+
+def decode83(value: str) -> int:
+    result = 0
+    for char in value:
+        result = result * 83 + blurhash.ALPHABET.index(char)
+    return result
+
+
+def test_blurhash_header_and_average_colour():
+    placeholder = blurhash.encode([(255, 0, 0)] * 16, 4, 4)
+    # 4x3 components: size flag, maximum AC value, DC colour, then 11 AC terms of 2 characters
+    assert len(placeholder) == 1 + 1 + 4 + 2 * 11
+    assert decode83(placeholder[0]) == (4 - 1) + (3 - 1) * 9
+    assert decode83(placeholder[2:6]) == 0xFF0000
+    # Averaged in linear light: half of white is sRGB 188, not 128
+    assert decode83(blurhash.encode([(0, 0, 0), (255, 255, 255)] * 2, 2, 2, 1, 1)[2:6]) == 0xBCBCBC
+
+
+def test_thumbnail_fits_the_edge_and_keeps_the_original_size(tmp_path):
+    source, target = tmp_path / "photo.png", tmp_path / "thumb.jpg"
+    image = Image.new("RGB", (640, 480), (0, 128, 255))
+    image.paste((255, 255, 255), (0, 0, 320, 480))
+    image.save(source)
+
+    preview = render_preview(str(source), "image", str(target), 160, None)
+
+    assert (preview["media_width"], preview["media_height"]) == (640, 480)
+    with Image.open(target) as thumbnail:
+        assert thumbnail.format == "JPEG"
+        assert thumbnail.size == (160, 120)
+    assert len(preview["blurhash"]) == 28
+    # Two halves of different colours leave horizontal detail
+    assert preview["blurhash"][6:] != "fQ" * 11
+
+
+def test_rotated_photos_report_their_displayed_size(tmp_path):
+    source, target = tmp_path / "rotated.jpg", tmp_path / "thumb.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("RGB", (400, 200), (10, 20, 30)).save(source, exif=exif)
+
+    preview = render_preview(str(source), "image", str(target), 100, None)
+
+    assert (preview["media_width"], preview["media_height"]) == (200, 400)
+    with Image.open(target) as thumbnail:
+        assert thumbnail.size == (50, 100)
+
+
+def run_preview(database, tmp_path, monkeypatch, flushed: bool, saved: bool = True):
+    """Render and record the preview of one uploaded image; returns (row, broadcasts, ingest)"""
+    async def scenario():
+        engine = create_async_engine(to_async_url(database))
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        storage = LocalStorage(str(tmp_path / "store"))
+        source = tmp_path / "upload.png"
+        Image.new("RGB", (64, 32), (200, 50, 50)).save(source)
+        file_hash = hashlib.sha256(source.read_bytes()).hexdigest()
+        shutil.copy(source, tmp_path / "staged")
+        await storage.put(content_key(file_hash), str(tmp_path / "staged"))
+
+        recorder = RecordingManager()
+        ingest = MessageIngest(session_factory=sessions, flush_interval=0.01)
+        monkeypatch.setattr(media_module, "manager", recorder)
+        monkeypatch.setattr(media_module, "ingest", ingest)
+        processor = MediaProcessor(storage, session_factory=sessions)
+        processor._executor = ThreadPoolExecutor(1)
+
+        async with sessions() as db:
+            chat_id = (await db.execute(insert(models.Chat).values(name="previews"))).inserted_primary_key[0]
+            await db.commit()
+        values = dict(content="upload.png", chat_id=chat_id, sender_id=1, seq=None,
+                      file_url=f"/chats/{chat_id}/files/{file_hash}", file_hash=file_hash, filetype="image/png")
+        if flushed:
+            async with sessions() as db:
+                message_id = (await db.execute(insert(models.Message).values(**values))).inserted_primary_key[0]
+                await db.commit()
+        elif saved:
+            message_id = (await ingest.submit(**values)).id
+        else:
+            message_id = 10_000_000
+
+        processing = asyncio.ensure_future(processor._process(PreviewJob(message_id, chat_id, file_hash, "image")))
+        if not flushed and saved:
+            await asyncio.sleep(0.2)
+            # Nothing is announced while the row only exists in memory
+            assert not processing.done() and recorder.broadcasts == []
+            await ingest.start()
+            await ingest.stop()
+        await asyncio.wait_for(processing, 5)
+        processor._executor.shutdown()
+
+        async with sessions() as db:
+            row = (await db.execute(select(models.Message).where(models.Message.id == message_id))).scalar()
+        await engine.dispose()
+        return message_id, file_hash, storage, row, recorder.broadcasts
+
+    return asyncio.run(scenario())
+
+
+def assert_recorded_then_broadcast(message_id, file_hash, storage, row, broadcasts):
+    assert row.thumbnail_url.endswith(f"/files/{file_hash}/thumbnail")
+    assert (row.media_width, row.media_height) == (64, 32)
+    assert row.blurhash
+    with Image.open(storage.path(thumbnail_key(file_hash))) as thumbnail:
+        assert thumbnail.size == (64, 32)
+    [(chat_id, event)] = broadcasts
+    assert event["type"] == "message_updated"
+    assert event["message"]["id"] == message_id
+    assert event["message"]["blurhash"] == row.blurhash
+    # Stored unsigned, announced with a signed URL
+    assert event["message"]["thumbnail_url"].startswith(row.thumbnail_url + "?expires=")
+
+
+def test_preview_is_recorded_then_broadcast(database, tmp_path, monkeypatch):
+    assert_recorded_then_broadcast(*run_preview(database, tmp_path, monkeypatch, flushed=True))
+
+
+def test_preview_of_an_unflushed_message_waits_for_its_row(database, tmp_path, monkeypatch):
+    assert_recorded_then_broadcast(*run_preview(database, tmp_path, monkeypatch, flushed=False))
+
+
+def test_preview_of_a_message_never_saved_is_not_broadcast(database, tmp_path, monkeypatch, caplog):
+    with caplog.at_level(logging.WARNING, logger="app.storage.media"):
+        _, _, _, row, broadcasts = run_preview(database, tmp_path, monkeypatch, flushed=False, saved=False)
+    assert row is None
+    assert broadcasts == []
+    assert "was not saved" in caplog.text
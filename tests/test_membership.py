@@ -0,0 +1,47 @@
+import asyncio
+
+from app.auth.cache import MISSING
+from app.auth.membership import MembershipCache
+from app.websockets.backplane import InMemoryBackplane
+
+
+def test_membership_changes_take_effect_despite_the_cache(client, register):
+    _, owner = register("members_owner")
+    guest_id, guest = register("members_guest")
+    chat = client.post("/chats/", json={"name": "members", "is_group": True, "participant_ids": []},
+                       headers=owner).json()
+    url = f"/chats/{chat['id']}/messages/"
+
+    # Twice: the second answer comes from the cached negative
+    assert client.get(url, headers=guest).status_code == 403
+    assert client.get(url, headers=guest).status_code == 403
+    assert client.post(f"/chats/{chat['id']}/participants/{guest_id}", headers=owner).status_code == 200
+    assert client.get(url, headers=guest).status_code == 200
+    assert client.get(url, headers=guest).status_code == 200
+    assert client.post(f"/chats/{chat['id']}/leave", headers=guest).status_code == 200
+    assert client.get(url, headers=guest).status_code == 403
+
+
+def test_invalidations_reach_the_other_workers():
+    async def scenario():
+        hub = []
+        caches = []
+        for _ in range(2):
+            backplane = InMemoryBackplane(hub)
+            await backplane.start()
+            cache = MembershipCache()
+            cache.attach(backplane)
+            cache.remember(1, [10, 11], cache.epoch)
+            cache.remember(2, [10], cache.epoch)
+            caches.append(cache)
+        here, there = caches
+        await here.invalidate(10, 1)
+        one_user = [there._cache.get((user_id, chat_id)) for user_id, chat_id in ((1, 10), (1, 11), (2, 10))]
+        await here.invalidate(10)
+        whole_chat = there._cache.get((2, 10))
+        return one_user, whole_chat
+
+    (removed, other_chat, other_user), whole_chat = asyncio.run(scenario())
+    assert removed is MISSING
+    assert other_chat is True and other_user is True
+    assert whole_chat is MISSING
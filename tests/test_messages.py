@@ -0,0 +1,44 @@
+def post_messages(client, headers, chat_id, count):
+    ids = []
+    for n in range(count):
+        response = client.post(f"/chats/{chat_id}/messages/", json={"content": f"m{n}", "chat_id": chat_id},
+                               headers=headers)
+        assert response.status_code == 200, response.text
+        ids.append(response.json()["id"])
+    return ids
+
+
+def test_history_pages_back_and_forward_by_id(client, register):
+    _, headers = register("pages_owner")
+    chat = client.post("/chats/", json={"name": "pages", "is_group": True, "participant_ids": []},
+                       headers=headers).json()
+    url = f"/chats/{chat['id']}/messages/"
+    ids = post_messages(client, headers, chat["id"], 7)
+
+    newest = client.get(url, params={"limit": 3}, headers=headers).json()
+    assert [m["id"] for m in newest["messages"]] == ids[4:]
+    assert newest["next_cursor"] == ids[4]
+    older = client.get(url, params={"limit": 3, "before_id": newest["next_cursor"]}, headers=headers).json()
+    assert [m["id"] for m in older["messages"]] == ids[1:4]
+    oldest = client.get(url, params={"limit": 3, "before_id": older["next_cursor"]}, headers=headers).json()
+    assert [m["id"] for m in oldest["messages"]] == ids[:1]
+    assert oldest["next_cursor"] is None
+
+    # Forward from a cursor, oldest first, as a client catching up does
+    forward = client.get(url, params={"limit": 4, "after_id": ids[1]}, headers=headers).json()
+    assert [m["id"] for m in forward["messages"]] == ids[2:6]
+    assert forward["next_cursor"] == ids[5]
+    rest = client.get(url, params={"limit": 4, "after_id": forward["next_cursor"]}, headers=headers).json()
+    assert [m["id"] for m in rest["messages"]] == ids[6:]
+    assert rest["next_cursor"] is None
+
+
+def test_history_rejects_two_cursors_and_outsiders(client, register):
+    _, headers = register("pages_member")
+    _, outsider = register("pages_outsider")
+    chat = client.post("/chats/", json={"name": "closed", "is_group": True, "participant_ids": []},
+                       headers=headers).json()
+    url = f"/chats/{chat['id']}/messages/"
+    assert client.get(url, params={"before_id": 5, "after_id": 1}, headers=headers).status_code == 400
+    assert client.get(url, params={"limit": 500}, headers=headers).status_code == 422
+    assert client.get(url, headers=outsider).status_code == 403
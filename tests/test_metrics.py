@@ -0,0 +1,63 @@
+from app.monitoring.metrics import Registry
+from app.monitoring.middleware import http_duration, http_requests
+from app.routers import metrics as metrics_router
+
+
+def test_histogram_buckets_are_cumulative_and_end_at_inf():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", ["route"], buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(seconds, "/a")
+
+    assert registry.render().splitlines() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 3.65',
+        'latency_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["path"])
+    requests.inc('say "hi"\\\nbye', value=2)
+    registry.gauge("open", "Open things", lambda: 1.5)
+
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{path="say \\"hi\\"\\\\\\nbye"} 2\n'
+        "# HELP open Open things\n"
+        "# TYPE open gauge\n"
+        "open 1.5\n"
+    )
+
+
+def test_metrics_endpoint_requires_the_token_when_set(client, monkeypatch):
+    monkeypatch.setattr(metrics_router, "METRICS_TOKEN", "scrape-secret")
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Basic scrape-secret"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == Registry.CONTENT_TYPE
+    assert "# TYPE http_requests_total counter" in response.text
+
+
+def test_requests_are_recorded_under_their_path_template(client, register):
+    _, headers = register("metrics_route")
+    chat_id = client.post("/chats/", json={"name": "metrics", "participant_ids": []}, headers=headers).json()["id"]
+    route = "/chats/{chat_id}"
+    before = http_requests._values.get(("GET", route, "200"), 0)
+
+    assert client.get(f"/chats/{chat_id}", headers=headers).status_code == 200
+    assert http_requests._values[("GET", route, "200")] == before + 1
+    assert ("GET", route) in http_duration._series
+    assert not any(labels[1] == f"/chats/{chat_id}" for labels in http_requests._values)
+
+    client.get("/no/such/path")
+    assert http_requests._values[("GET", "unmatched", "404")] >= 1
@@ -0,0 +1,53 @@
+import asyncio
+
+from app.websockets.backplane import InMemoryBackplane
+from app.websockets.manager import ConnectionManager
+from app.websockets.presence import Presence
+
+
+def worker(hub, node_ttl):
+    return Presence(ConnectionManager(InMemoryBackplane(hub)), node_ttl=node_ttl)
+
+
+async def start(*workers):
+    for presence in workers:
+        await presence.connections.backplane.start()
+        await presence.start()
+
+
+def test_users_of_a_worker_that_stops_reporting_go_offline():
+    async def scenario():
+        hub = []
+        a, b = worker(hub, 0.3), worker(hub, 0.3)
+        await start(a, b)
+        a._online.add(5)
+        await a._announce(b"+", 5)
+        assert b.is_online(5)
+        # Crashed: no "-" and no more heartbeats
+        a._heartbeat_task.cancel()
+        await a.connections.backplane.stop()
+        await asyncio.sleep(0.5)
+        assert not b.is_online(5)
+        assert b.evicted_nodes == 1
+        await a.stop()
+        await b.stop()
+
+    asyncio.run(scenario())
+
+
+def test_an_evicted_worker_that_reports_again_repeats_its_users():
+    async def scenario():
+        hub = []
+        a, b = worker(hub, 0.3), worker(hub, 0.3)
+        await start(a, b)
+        a._online.add(5)
+        await a._announce(b"+", 5)
+        # As if its heartbeats had been delayed past the TTL
+        b._evict(a.connections.backplane.node_id)
+        assert not b.is_online(5)
+        await asyncio.sleep(0.2)
+        assert b.is_online(5)
+        await a.stop()
+        await b.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,35 @@
+import asyncio
+
+from app.auth.auth import _on_principal_invalidation, principal_cache
+from app.auth.cache import MISSING
+
+
+def token_of(headers):
+    return headers["Authorization"].removeprefix("Bearer ")
+
+
+def test_profile_changes_drop_the_cached_principal(client, register):
+    user_id, headers = register("principal_before")
+    token = token_of(headers)
+    assert client.get("/users/me/", headers=headers).status_code == 200
+    assert principal_cache.get(token).username == "principal_before"
+
+    response = client.put("/users/me", json={"username": "principal_after"}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert principal_cache.get(token) is MISSING
+    # The same token now resolves to the renamed user
+    assert client.get("/users/me/", headers=headers).json()["username"] == "principal_after"
+    assert principal_cache.get(token).username == "principal_after"
+
+    # As when another worker handled the change
+    asyncio.run(_on_principal_invalidation(b"%d" % user_id))
+    assert principal_cache.get(token) is MISSING
+
+
+def test_wrong_password_change_keeps_the_cached_principal(client, register):
+    _, headers = register("principal_kept")
+    token = token_of(headers)
+    client.get("/users/me/", headers=headers)
+    response = client.put("/users/me", json={"current_password": "wrong", "new_password": "x"}, headers=headers)
+    assert response.status_code == 400
+    assert principal_cache.get(token).username == "principal_kept"
@@ -0,0 +1,59 @@
+from sqlalchemy import event
+
+from app.database import engine
+
+CHAT_COUNTS = (1, 10, 50)
+PARTICIPANTS = 5
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def measure(self, call):
+        # Once to warm the principal and membership caches, then counted
+        call()
+        self.count = 0
+        response = call()
+        assert response.status_code == 200, response.text
+        return self.count
+
+
+def test_chat_endpoints_run_the_same_statements_however_many_chats(client, register):
+    results = {}
+    with StatementCounter() as counter:
+        for chats in CHAT_COUNTS:
+            owner_id, headers = register(f"counts_owner{chats}")
+            others = [register(f"counts_member{chats}_{i}")[0] for i in range(PARTICIPANTS)]
+            chat_ids = []
+            for n in range(chats):
+                chat = client.post("/chats/", json={
+                    "name": f"chat{n}", "is_group": True, "participant_ids": others,
+                }, headers=headers).json()
+                chat_ids.append(chat["id"])
+                client.post(f"/chats/{chat['id']}/messages/", json={"content": "hi", "chat_id": chat["id"]},
+                            headers=headers)
+            results[chats] = {
+                "GET /chats/": counter.measure(lambda: client.get("/chats/", headers=headers)),
+                "GET /chats/{id}": counter.measure(lambda: client.get(f"/chats/{chat_ids[-1]}", headers=headers)),
+                "POST /chats/": counter.measure(lambda: client.post("/chats/", json={
+                    "name": "extra", "is_group": True, "participant_ids": others,
+                }, headers=headers)),
+                "POST /chats/direct/{id}": counter.measure(
+                    lambda: client.post(f"/chats/direct/{others[0]}", headers=headers)
+                ),
+            }
+
+    for endpoint in results[CHAT_COUNTS[0]]:
+        counts = {chats: results[chats][endpoint] for chats in CHAT_COUNTS}
+        assert len(set(counts.values())) == 1, f"{endpoint} statements grow with the number of chats: {counts}"
@@ -0,0 +1,107 @@
+"""Query plans of the hot queries: every one must be answered from an index.
+
+Runs EXPLAIN QUERY PLAN on the migrated test database for the statements
+the routers, the WebSocket handlers and the background writers issue on
+every request, and fails when a plan scans a whole table.
+"""
+import asyncio
+import re
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.auth.membership import participants_query
+from app.database import to_async_url
+from app.models import models
+from app.search.search import search_index
+from app.storage.archive import blocks, messages
+from app.websockets.presence import LAST_SEEN_UPDATE
+from app.websockets.read_cursors import READ_CURSOR_UPDATE
+
+USER_ID, CHAT_ID = 1, 1
+cursor = models.user_chat.c
+
+
+def hot_queries():
+    """(name, statement, parameters) of the statements worth an index"""
+    message = models.Message
+    return [
+        ("login", select(models.User).where(models.User.username == "alice"), {}),
+        ("register", select(models.User).where(models.User.email == "alice@example.com"), {}),
+        ("user search", search_index.user_search("ali", 10), {}),
+        ("membership", select(cursor.user_id).where(
+            (cursor.user_id == USER_ID) & (cursor.chat_id == CHAT_ID)).limit(1), {}),
+        ("socket chats", select(cursor.chat_id).where(cursor.user_id == USER_ID), {}),
+        ("user's chats", select(models.Chat, cursor.last_read_message_id)
+            .join(models.user_chat, cursor.chat_id == models.Chat.id)
+            .where(cursor.user_id == USER_ID), {}),
+        ("chat participants", select(models.User, cursor.chat_id)
+            .join(models.user_chat, cursor.user_id == models.User.id)
+            .where(cursor.chat_id.in_([1, 2, 3])), {}),
+        ("last messages", select(message).where(message.id.in_([1, 2, 3])), {}),
+        ("unread counts", select(message.chat_id, func.count())
+            .join(models.user_chat, (cursor.chat_id == message.chat_id) & (cursor.user_id == USER_ID))
+            .where(message.id > cursor.last_read_message_id, message.sender_id != USER_ID)
+            .group_by(message.chat_id), {}),
+        ("history page", select(message).where(message.chat_id == CHAT_ID, message.id < 1000)
+            .order_by(message.id.desc()).limit(51), {}),
+        ("history forward", select(message).where(message.chat_id == CHAT_ID, message.id > 1000)
+            .order_by(message.id.asc()).limit(51), {}),
+        ("replay", select(message).where(message.chat_id == CHAT_ID, message.seq > 10)
+            .order_by(message.seq).limit(101), {}),
+        ("oldest live seq", select(func.min(message.seq)).where(message.chat_id == CHAT_ID), {}),
+        ("message search", select(message).join(
+            models.user_chat, (cursor.chat_id == message.chat_id) & (cursor.user_id == USER_ID)
+        ).where(search_index.message_filter("hello")).order_by(message.id.desc()).limit(21), {}),
+        ("attachment", select(message.filename, message.filetype)
+            .where((message.chat_id == CHAT_ID) & (message.file_hash == "0" * 64)).limit(1), {}),
+        ("direct pair", select(models.DirectChat.chat_id).where(
+            models.DirectChat.user_low_id == 1, models.DirectChat.user_high_id == 2), {}),
+        ("direct by chat", select(models.DirectChat).where(models.DirectChat.chat_id == CHAT_ID), {}),
+        ("presence participants", participants_query([1, 2, 3]), {}),
+        ("presence chats", select(cursor.chat_id, cursor.user_id).where(cursor.user_id.in_([1, 2, 3])), {}),
+        ("read cursor", READ_CURSOR_UPDATE, {"user": USER_ID, "chat": CHAT_ID, "message": 10}),
+        ("last seen", LAST_SEEN_UPDATE, {"user": USER_ID, "seen": datetime.utcnow()}),
+        ("archived history", select(blocks).where(blocks.c.chat_id == CHAT_ID, blocks.c.first_id < 1000)
+            .order_by(blocks.c.first_id.desc()), {}),
+        ("archived blocks of chat", select(blocks.c.chat_id).where(blocks.c.chat_id == CHAT_ID).limit(1), {}),
+        ("archived blocks of range", select(blocks).where(blocks.c.partition_low_id == 0), {}),
+        ("deleted chats", select(models.Chat.id).where(models.Chat.deleted_at < datetime.utcnow()).limit(100), {}),
+        ("purge batch", select(messages.c.id).where(messages.c.chat_id == CHAT_ID).limit(1000), {}),
+    ]
+
+
+# "SCAN messages" reads the table, "SCAN messages USING COVERING INDEX ..." the whole index;
+# FTS5 tables, subqueries and constant rows are fine
+SQLITE_FULL_SCAN = re.compile(r"\bSCAN (?!CONSTANT ROW)(?!\(subquery)(?!\S+ VIRTUAL TABLE)\S+")
+
+
+@pytest.fixture(scope="module")
+def plans(database):
+    async def explain():
+        engine = create_async_engine(to_async_url(database))
+
+        # The app's own statements, compiled and bound as usual, only prefixed
+        @event.listens_for(engine.sync_engine, "before_cursor_execute", retval=True)
+        def _explain(conn, cursor, statement, parameters, context, executemany):
+            return "EXPLAIN QUERY PLAN " + statement, parameters
+
+        found = {}
+        async with engine.connect() as conn:
+            await conn.run_sync(search_index.detect)
+            for name, statement, parameters in hot_queries():
+                # (id, parent, notused, detail) per step
+                found[name] = [row[-1] for row in (await conn.execute(statement, parameters)).all()]
+            await conn.rollback()
+        await engine.dispose()
+        return found
+
+    return asyncio.run(explain())
+
+
+@pytest.mark.parametrize("name", [name for name, _, _ in hot_queries()])
+def test_hot_query_is_answered_from_an_index(plans, name):
+    scans = [line for line in plans[name] if SQLITE_FULL_SCAN.search(line)]
+    assert not scans, f"{name} scans a whole table: {plans[name]}"
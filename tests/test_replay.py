@@ -0,0 +1,83 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.database import to_async_url
+from app.models import models
+from app.routers.websockets import replay_since
+from app.websockets.replay import ReplayBuffer
+
+
+def test_contiguous_frames_are_replayed_from_memory():
+    buffer = ReplayBuffer(per_chat=10)
+    for seq in (1, 2, 3):
+        buffer.record(7, seq, f"m{seq}")
+    assert buffer.since(7, 1) == ["m2", "m3"]
+    assert buffer.since(7, 3) == []
+
+
+def test_a_missing_frame_sends_resumes_before_it_to_the_database():
+    buffer = ReplayBuffer(per_chat=10)
+    # Frame 3 was dropped by the backplane
+    for seq in (1, 2, 4, 5):
+        buffer.record(7, seq, f"m{seq}")
+    assert buffer.since(7, 1) is None
+    assert buffer.since(7, 2) is None
+    assert buffer.since(7, 4) == ["m5"]
+    # Until it arrives late
+    buffer.record(7, 3, "m3")
+    assert buffer.since(7, 1) == ["m2", "m3", "m4", "m5"]
+
+
+def test_trimmed_frames_are_not_vouched_for():
+    buffer = ReplayBuffer(per_chat=2)
+    for seq in (1, 2, 3):
+        buffer.record(7, seq, f"m{seq}")
+    assert buffer.since(7, 0) is None
+    assert buffer.since(7, 1) == ["m2", "m3"]
+
+
+def test_the_connection_manager_imports_without_a_database():
+    # The WebSocket benchmarks run the manager alone, with no DATABASE_URL
+    env = {key: value for key, value in os.environ.items() if key != "DATABASE_URL"}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [sys.executable, "-c", "import app.websockets.manager"], cwd=root, env=env, check=True,
+    )
+
+
+def test_resuming_behind_archived_messages_asks_for_a_resync(database):
+    async def scenario():
+        engine = create_async_engine(to_async_url(database))
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        async with sessions() as db:
+            sender_id = (await db.execute(insert(models.User).values(username="replayer"))).inserted_primary_key[0]
+            chat_id = (await db.execute(insert(models.Chat).values(name="replay", last_seq=5))).inserted_primary_key[0]
+            ids = []
+            for seq in range(1, 6):
+                ids.append((await db.execute(insert(models.Message).values(
+                    content=f"m{seq}", chat_id=chat_id, sender_id=sender_id, seq=seq, timestamp=datetime.utcnow(),
+                ))).inserted_primary_key[0])
+            # Seqs 1-3 were archived: only their block index rows are left
+            await db.execute(insert(models.MessagePartition).values(low_id=-1000, high_id=-999, state="archived"))
+            await db.execute(insert(models.ArchivedBlock).values(
+                chat_id=chat_id, first_id=ids[0], last_id=ids[2], partition_low_id=-1000, offset=0, length=1, count=3,
+            ))
+            await db.execute(delete(models.Message).where(models.Message.id.in_(ids[:3])))
+            await db.commit()
+            results = [await replay_since(db, ReplayBuffer(), chat_id, last_seq, 100) for last_seq in (0, 1, 2, 3, 5)]
+        await engine.dispose()
+        return results
+
+    behind, inside, at_edge, live, current = asyncio.run(scenario())
+    assert behind is None
+    assert inside is None
+    assert at_edge is None
+    assert [json.loads(frame)["message"]["content"] for frame in live] == ["m4", "m5"]
+    assert current == []
@@ -0,0 +1,99 @@
+import asyncio
+
+from app.replicas import ReplicaRouter
+from app.websockets.backplane import InMemoryBackplane, create_backplane
+
+
+def router(urls, **options):
+    return ReplicaRouter(urls, create_backplane(None), **options)
+
+
+async def served_by(replicas: ReplicaRouter, user_id=None):
+    async with replicas.session(user_id) as db:
+        return db.info.get("replica", "primary")
+
+
+def test_reads_rotate_over_the_healthy_replicas(tmp_path):
+    async def scenario():
+        replicas = router([f"sqlite:///{tmp_path}/a.db", f"sqlite:///{tmp_path}/b.db"])
+        await replicas.check()
+        served = [await served_by(replicas) for _ in range(4)]
+        await replicas.stop()
+        return replicas, served
+
+    replicas, served = asyncio.run(scenario())
+    names = [replica.name for replica in replicas.replicas]
+    assert served == names * 2
+    assert replicas.replica_reads == 4
+    assert replicas.primary_reads == 0
+
+
+def test_a_replica_failing_its_check_is_skipped(tmp_path):
+    async def scenario():
+        # SQLite cannot create a database in a directory that does not exist
+        replicas = router([f"sqlite:///{tmp_path}/a.db", f"sqlite:///{tmp_path}/missing/b.db"])
+        await replicas.check()
+        served = [await served_by(replicas) for _ in range(3)]
+        await replicas.stop()
+        return replicas, served
+
+    replicas, served = asyncio.run(scenario())
+    good, bad = replicas.replicas
+    assert bad.checked and not bad.healthy
+    assert served == [good.name] * 3
+
+
+def test_an_unreachable_replica_falls_back_to_the_primary(tmp_path):
+    async def scenario():
+        replicas = router([f"sqlite:///{tmp_path}/missing/a.db"])
+        # Healthy at its last check, gone since
+        replicas.replicas[0].healthy = True
+        first = await served_by(replicas)
+        second = await served_by(replicas)
+        await replicas.stop()
+        return replicas, first, second
+
+    replicas, first, second = asyncio.run(scenario())
+    assert (first, second) == ("primary", "primary")
+    assert not replicas.replicas[0].healthy
+    # Taken out of rotation by the first failure; the second read never tries it
+    assert replicas.fallbacks == 1
+    assert replicas.primary_reads == 2
+
+
+def test_writers_read_from_the_primary_until_the_window_ends(tmp_path):
+    async def scenario():
+        replicas = router([f"sqlite:///{tmp_path}/a.db"], window=0.2)
+        await replicas.check()
+        replicas.wrote(7)
+        writer = await served_by(replicas, 7)
+        other = await served_by(replicas, 8)
+        await asyncio.sleep(0.3)
+        expired = await served_by(replicas, 7)
+        await replicas.stop()
+        return replicas, writer, other, expired
+
+    replicas, writer, other, expired = asyncio.run(scenario())
+    name = replicas.replicas[0].name
+    assert writer == "primary"
+    assert other == name
+    assert expired == name
+
+
+def test_other_workers_hear_of_a_write():
+    async def scenario():
+        # Two workers sharing an in-memory hub
+        hub = []
+        backplanes = [InMemoryBackplane(hub), InMemoryBackplane(hub)]
+        for backplane in backplanes:
+            await backplane.start()
+        writer = ReplicaRouter(["sqlite://"], backplanes[0], window=5)
+        reader = ReplicaRouter(["sqlite://"], backplanes[1], window=5)
+        writer.wrote(7)
+        await asyncio.gather(*writer._announcements)
+        sticky = reader.is_sticky(7), reader.is_sticky(8)
+        await writer.stop()
+        await reader.stop()
+        return sticky
+
+    assert asyncio.run(scenario()) == (True, False)
@@ -0,0 +1,61 @@
+from app.search.search import search_index
+
+
+def chat_with(client, headers, name, *contents):
+    chat = client.post("/chats/", json={"name": name, "is_group": True, "participant_ids": []},
+                       headers=headers).json()
+    ids = [
+        client.post(f"/chats/{chat['id']}/messages/", json={"content": content, "chat_id": chat["id"]},
+                    headers=headers).json()["id"]
+        for content in contents
+    ]
+    return chat["id"], ids
+
+
+def found(client, headers, q, **params):
+    response = client.get("/search/messages", params={"q": q, **params}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_message_search_matches_words_in_the_callers_chats(client, register):
+    _, alice = register("search_alice")
+    _, bob = register("search_bob")
+    chat_id, (lunch, dinner, both) = chat_with(
+        client, alice, "search", "Zanzibarian lunch plans", "zanzibarian dinner", "lunch or dinner in Zanzibarian style",
+    )
+    other_chat, _ = chat_with(client, alice, "search other", "zanzibarian breakfast")
+    _, bobs = chat_with(client, bob, "search private", "zanzibarian lunch at bob's")
+
+    # The index is kept up to date as messages are written
+    assert search_index.messages == "fts5"
+    ids = lambda page: [m["id"] for m in page["messages"]]
+    # Every word must occur, in any case, the last one as a prefix
+    assert ids(found(client, alice, "ZANZIBARIAN lunch", chat_id=chat_id)) == [both, lunch]
+    assert ids(found(client, alice, "zanzibarian din", chat_id=chat_id)) == [both, dinner]
+    # Across the caller's chats only: bob's message is never returned
+    assert len(found(client, alice, "zanzibarian")["messages"]) == 4
+    assert ids(found(client, bob, "zanzibarian lunch")) == bobs
+    assert client.get("/search/messages", params={"q": "x", "chat_id": other_chat}, headers=bob).status_code == 403
+    # Query syntax is stripped rather than interpreted: NOT is just a word here
+    assert ids(found(client, alice, '"zanzibarian" NOT lunch*', chat_id=chat_id)) == []
+    assert found(client, alice, '"*"')["messages"] == []
+
+
+def test_message_search_pages_newest_first(client, register):
+    _, headers = register("search_pager")
+    chat_id, ids = chat_with(client, headers, "search pages", *(f"quokkaword {n}" for n in range(5)))
+    first = found(client, headers, "quokkaword", chat_id=chat_id, limit=3)
+    assert [m["id"] for m in first["messages"]] == ids[:-4:-1]
+    second = found(client, headers, "quokkaword", chat_id=chat_id, limit=3, before_id=first["next_cursor"])
+    assert [m["id"] for m in second["messages"]] == ids[1::-1]
+    assert second["next_cursor"] is None
+
+
+def test_user_search_ranks_exact_and_prefix_matches_first(client, register):
+    _, headers = register("walrusbeta")
+    register("walrus")
+    register("walrusalpha")
+    register("xwalrus")
+    response = client.get("/users/search/", params={"query": "Walrus"}, headers=headers)
+    assert [user["username"] for user in response.json()] == ["walrus", "walrusbeta", "walrusalpha"]
@@ -0,0 +1,49 @@
+import asyncio
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi import HTTPException, UploadFile
+
+from app.storage.storage import LocalStorage, content_key, save_upload
+
+
+def blobs(root):
+    return sorted(
+        os.path.relpath(os.path.join(folder, name), root)
+        for folder, _, names in os.walk(root) if ".staging" not in folder
+        for name in names
+    )
+
+
+def store(storage, data, max_size=1024):
+    upload = UploadFile(io.BytesIO(data), filename="a.bin")
+    return asyncio.run(save_upload(upload, storage, max_size, chunk_size=7))
+
+
+def test_identical_uploads_share_one_blob(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    data = b"the same bytes, uploaded twice"
+    first = store(storage, data)
+    second = store(storage, data)
+    other = store(storage, b"different bytes")
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert (first.sha256, first.key, first.size) == (sha256, content_key(sha256), len(data))
+    assert not first.deduplicated
+    assert second.deduplicated and second.key == first.key
+    assert not other.deduplicated
+    assert blobs(str(tmp_path)) == sorted([first.key, other.key])
+    with open(storage.path(first.key), "rb") as f:
+        assert f.read() == data
+    assert os.listdir(storage.staging_dir()) == []
+
+
+def test_oversized_upload_leaves_nothing_behind(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    with pytest.raises(HTTPException) as error:
+        store(storage, b"x" * 100, max_size=50)
+    assert error.value.status_code == 413
+    assert blobs(str(tmp_path)) == []
+    assert os.listdir(storage.staging_dir()) == []
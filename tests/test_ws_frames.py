@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+from app.auth.auth import Principal
+from app.auth.membership import membership
+from app.websockets.presence import presence
+from app.routers import websockets
+from app.routers.websockets import handle_frame
+from app.websockets.manager import ConnectionManager
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.sent = []
+        self.chats = set()
+        self.closed = False
+
+    def send(self, frame):
+        self.sent.append(frame)
+        return True
+
+
+def test_message_with_a_malformed_chat_id_or_content_never_reaches_the_database():
+    principal = Principal(id=1, username="alice", is_active=True)
+    connection = RecordingConnection()
+    frames = [
+        {"type": "message", "chat_id": "5", "content": "hi"},
+        {"type": "message", "chat_id": True, "content": "hi"},
+        {"type": "message", "chat_id": -3, "content": "hi"},
+        {"type": "message", "chat_id": 5, "content": {"text": "hi"}},
+        {"type": "message", "chat_id": 5, "content": ""},
+    ]
+    for frame in frames:
+        # No session: any query would fail on None
+        asyncio.run(handle_frame(None, connection, principal, frame))
+    assert connection.sent == []
+
+
+def test_resume_answers_malformed_entries_with_resync_and_keeps_going(monkeypatch):
+    monkeypatch.setattr(websockets, "manager", ConnectionManager())
+    principal = Principal(id=1, username="alice", is_active=True)
+    connection = RecordingConnection()
+    membership.remember(1, [9001, 9002], membership.epoch)
+    frame = {"type": "resume", "chats": {"x": 3, "9001": "3", "-2": 0, "9002": -1}}
+    asyncio.run(handle_frame(None, connection, principal, frame))
+    sent = [json.loads(data) for data in connection.sent]
+    assert sent == [
+        {"type": "resync", "chat_id": "x"},
+        {"type": "resync", "chat_id": 9001},
+        {"type": "resync", "chat_id": "-2"},
+        {"type": "resync", "chat_id": 9002},
+    ]
+
+
+class RecordingManager:
+    def __init__(self):
+        self.broadcasts = []
+        self.joined = []
+
+    async def broadcast_to_chat(self, chat_id, message, seq=None):
+        self.broadcasts.append((chat_id, message))
+
+    async def join_chat(self, user_id, chat_id, connection=None):
+        self.joined.append((user_id, chat_id))
+
+
+def test_typing_is_checked_for_membership_before_the_rate_limit(monkeypatch):
+    recorder = RecordingManager()
+    monkeypatch.setattr(websockets, "manager", recorder)
+    principal = Principal(id=2, username="bob", is_active=True)
+    connection = RecordingConnection()
+    membership.remember(2, [9101], membership.epoch)
+    # A cached "not a member" answer, as a query would have left behind
+    membership._cache.put((2, 9102), False, group=9102)
+
+    for chat_id in ("9101", True, 9102):
+        asyncio.run(handle_frame(None, connection, principal, {"type": "typing", "chat_id": chat_id}))
+    assert recorder.broadcasts == []
+    assert not any(user_id == 2 for user_id, _ in presence._typing)
+
+    for _ in range(2):
+        asyncio.run(handle_frame(None, connection, principal, {"type": "typing", "chat_id": 9101}))
+    # The repeat falls inside the rate limit
+    assert recorder.broadcasts == [(9101, {"type": "typing", "chat_id": 9101, "user_id": 2})]
+
+
+def test_join_chat_needs_an_integer_id_of_a_chat_the_user_is_in(monkeypatch):
+    recorder = RecordingManager()
+    monkeypatch.setattr(websockets, "manager", recorder)
+    principal = Principal(id=3, username="carol", is_active=True)
+    connection = RecordingConnection()
+    membership.remember(3, [9201], membership.epoch)
+    membership._cache.put((3, 9202), False, group=9202)
+
+    for chat_id in ("9201", 9201.0, None, 9202, 9201):
+        asyncio.run(handle_frame(None, connection, principal, {"type": "join_chat", "chat_id": chat_id}))
+    assert recorder.joined == [(3, 9201)]